@@ -0,0 +1,278 @@
+import argparse
+import datetime
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from decimal import Decimal
+import pymongo
+import bson
+import codec_options
+from row_decoder import RowDecoder
+from schema_graph import *
+
+# makes a document shaped like a typical migrated row with a few embedded children
+def make_document(i):
+    return {
+        'id': i,
+        'name': 'record %d' % i,
+        'amount': Decimal('%d.25' % i),
+        'created': datetime.date(2020, 1, 1 + i % 28),
+        'children': [{'id': j, 'value': 'child %d' % j} for j in range(3)],
+    }
+
+# times inserting num documents with one insert_one call per document (the original migration path)
+def bench_insert_one(db, num):
+    collection = db.get_collection('bench_insert_one', codec_options=codec_options.get())
+    start = time.perf_counter()
+    for i in range(num):
+        collection.insert_one(make_document(i))
+    return time.perf_counter() - start
+
+# times inserting num documents through the batched writer used by Schema.map
+def bench_bulk_writer(db, num, batch_size, batch_bytes):
+    writer = BulkWriter(db, batch_size, batch_bytes)
+    start = time.perf_counter()
+    for i in range(num):
+        writer.insert('bench_bulk_writer', make_document(i))
+    writer.flush()
+    return time.perf_counter() - start
+
+# times exporting num documents to files in a scratch directory with the same batches as bench_bulk_writer
+def bench_file_sink(num, batch_size, batch_bytes, file_format, compress):
+    directory = tempfile.mkdtemp()
+    try:
+        writer = BulkWriter(FileSink(directory, file_format, compress), batch_size, batch_bytes)
+        start = time.perf_counter()
+        for i in range(num):
+            writer.insert('bench_file_sink', make_document(i))
+        writer.flush()
+        writer.sink.close()
+        return time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory)
+
+# the columns of the table used by the row decoding benchmark, and a row of it as pymysql reads it
+ROW_COLUMNS = [('id', 'int'), ('name', 'varchar'), ('amount', 'decimal'), ('price', 'decimal'), ('created', 'date'),
+    ('updated', 'datetime'), ('quantity', 'int'), ('note', 'text')]
+
+def make_row(i):
+    return (i, 'record %d' % i, Decimal('%d.25' % i), Decimal('19.99'), datetime.date(2020, 1, 1 + i % 28),
+        datetime.datetime(2020, 1, 1, 12, i % 60), i % 100, 'note for record %d' % i)
+
+# stands in for a pymysql cursor, which is only used for the names of the columns
+class RowCursor:
+    description = [(name, None, None, None, None, None, None) for name, _data_type in ROW_COLUMNS]
+
+# reads rows into dictionaries the way pymysql's DictCursor does and encodes them with the codecs
+# (the original migration path)
+def decode_dict_rows(rows):
+    names = [column[0] for column in RowCursor.description]
+    records = [dict(zip(names, row)) for row in rows]
+    return [bson.encode(record, codec_options=codec_options.get()) for record in records]
+
+# reads tuple rows into records and converts them with a RowDecoder before encoding them without the codecs
+def decode_typed_rows(rows, decoder=RowDecoder('bench_rows', ROW_COLUMNS)):
+    records = decoder.records(RowCursor, rows)
+    for record in records:
+        decoder.convert(record)
+    return [bson.encode(record) for record in records]
+
+# returns the rows decoded per second and the most memory allocated while decoding them in bytes per row
+def bench_decode(decode, rows):
+    start = time.perf_counter()
+    decode(rows)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        decode(rows)
+        return len(rows) / seconds, tracemalloc.get_traced_memory()[1] / len(rows)
+    finally:
+        tracemalloc.stop()
+
+def rows_benchmark(args):
+    rows = [make_row(i) for i in range(args.num)]
+    for name, decode in [('dict rows and codecs', decode_dict_rows), ('typed rows', decode_typed_rows)]:
+        rows_per_second, bytes_per_row = bench_decode(decode, rows)
+        print('%-28s %10.0f rows/sec %10.0f bytes/row' % (name, rows_per_second, bytes_per_row))
+
+# fills a scratch database with a collection of num documents that each reference num_refs other collections
+def make_ref_collections(db, num, num_refs, num_targets):
+    db.drop_collection('bench_parents')
+    writer = BulkWriter(db)
+    for i in range(num):
+        document = {'id': i}
+        for j in range(num_refs):
+            document['fk%d' % j] = (i * (j + 1)) % num_targets
+        writer.insert('bench_parents', document)
+    for j in range(num_refs):
+        db.drop_collection('bench_target_%d' % j)
+        for i in range(num_targets):
+            writer.insert('bench_target_%d' % j, {'key': i})
+    writer.flush()
+    return [ManyToOneRef('bench_target_%d' % j, 'key', ['bench_parents'], 'id', 'fk%d' % j) for j in range(num_refs)]
+
+# times adding refs one scan per ref (the original ref phase) against one coalesced scan for all of them
+def refs_benchmark(args):
+    client = pymongo.MongoClient(args.mongodb_host, args.mongodb_port)
+    db = client[args.mongodb_database]
+    try:
+        refs = make_ref_collections(db, args.num, args.num_refs, args.num_targets)
+        start = time.perf_counter()
+        num_updated = sum(add_refs(db, [ref]) for ref in refs)
+        separate = time.perf_counter() - start
+        print('%-28s %8.2f sec %10d document writes' % ('one scan per ref', separate, num_updated))
+
+        refs = make_ref_collections(db, args.num, args.num_refs, args.num_targets)
+        start = time.perf_counter()
+        num_updated = add_refs(db, refs)
+        coalesced = time.perf_counter() - start
+        print('%-28s %8.2f sec %10d document writes' % ('one scan for all refs', coalesced, num_updated))
+    finally:
+        client.drop_database(args.mongodb_database)
+
+def insert_benchmark(args):
+    client = pymongo.MongoClient(args.mongodb_host, args.mongodb_port)
+    db = client[args.mongodb_database]
+    try:
+        results = [('insert_one', bench_insert_one(db, args.num))]
+        for batch_size in args.batch_sizes:
+            results.append(('insert_many batch=%d' % batch_size,
+                bench_bulk_writer(db, args.num, batch_size, args.batch_bytes)))
+        for file_format in FILE_FORMATS:
+            for compress in [False, True]:
+                results.append(('%s file%s' % (file_format, ' gzip' if compress else ''),
+                    bench_file_sink(args.num, max(args.batch_sizes), args.batch_bytes, file_format, compress)))
+        for name, seconds in results:
+            print('%-28s %10.0f docs/sec' % (name, args.num / seconds))
+    finally:
+        client.drop_database(args.mongodb_database)
+
+# builds a random schema graph without connecting to a database
+# the foreign keys form a tree with num_extra_fkeys more added, each of which makes an undirected cycle
+def make_graph(num_tables, num_extra_fkeys, seed):
+    rand = random.Random(seed)
+    # a nonzero current_id skips reading the tables from MySQL
+    graph = Graph(None, 'bench', current_id=1)
+    nodes = [Node(graph, 'table%d' % i, 'id', rand.randint(20, 500), rand.randint(1, 10000)) for i in range(num_tables)]
+    fkeys = set((i, rand.randrange(i)) for i in range(1, num_tables))
+    while len(fkeys) < num_tables - 1 + num_extra_fkeys:
+        i = rand.randrange(1, num_tables)
+        fkeys.add((i, rand.randrange(i)))
+    for k, (i, j) in enumerate(sorted(fkeys)):
+        null_fk_count = rand.choice([0, 0, 0, rand.randint(0, nodes[i].num_rows)])
+        nodes[i].add_fkey(graph, 'fk%d' % k, nodes[j], null_fk_count)
+    return graph
+
+# the graph the planning benchmark searches, either generated or read from a snapshot
+def plan_graph(args):
+    if args.snapshot:
+        return Graph(None, None, snapshot=args.snapshot)
+    return make_graph(args.tables, args.extra_fkeys, args.seed)
+
+# returns the memory allocated by make_candidates in bytes per candidate
+def candidate_bytes(make_candidates, num):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        candidates = make_candidates(num)
+        return (tracemalloc.get_traced_memory()[0] - before) / len(candidates)
+    finally:
+        tracemalloc.stop()
+
+# compares the memory used by candidates in the schema search kept as copies of the graph (how the search
+# used to work) against compact states, then times planning in one process and split between several
+def plan_benchmark(args):
+    graph = plan_graph(args)
+    if args.save_snapshot:
+        graph.save_snapshot(args.save_snapshot)
+    edges = list(graph.edges.values())
+    space = SearchSpace(graph)
+
+    # candidates one step from the start of the search, each with one edge reversed
+    def graph_copies(num):
+        copies = []
+        for i in range(num):
+            copy = graph.copy_graph()
+            copy.edges[edges[i % len(edges)].id].reverse(copy)
+            copies.append(copy)
+        return copies
+
+    def states(num):
+        return [space.initial.reverse(i % len(edges)) for i in range(num)]
+
+    print('%-28s %10.0f bytes/candidate' % ('graph copies', candidate_bytes(graph_copies, args.candidates)))
+    print('%-28s %10.0f bytes/candidate' % ('compact states', candidate_bytes(states, args.candidates)))
+
+    # options are found as they are looked at, so len runs the whole search
+    start = time.perf_counter()
+    num_opts = len(graph.get_opts())
+    print('%-28s %10.2f sec %10d options' % ('planning', time.perf_counter() - start, num_opts))
+    print(graph.states)
+
+    # the same search split between more processes, which finds the same options in the same order
+    for workers in args.workers:
+        graph = plan_graph(args)
+        start = time.perf_counter()
+        num_opts = len(graph.get_opts(workers=workers))
+        print('%-28s %10.2f sec %10d options' % ('planning workers=%d' % workers, time.perf_counter() - start,
+            num_opts))
+
+    if args.top:
+        graph = plan_graph(args)
+        start = time.perf_counter()
+        num_opts = len(graph.get_opts(top=args.top))
+        print('%-28s %10.2f sec %10d options' % ('planning best %d' % args.top, time.perf_counter() - start,
+            num_opts))
+        print(graph.states)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for Mongo Migrator')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    insert = subparsers.add_parser('insert',
+        help='Compare insert_one against batched insert_many and exporting to files')
+    insert.add_argument('--mongodb-host', default='localhost', help='MongoDB host')
+    insert.add_argument('--mongodb-port', default=27017, type=int, help='MongoDB port')
+    insert.add_argument('--mongodb-database', default='mongo_migrator_bench',
+        help='Scratch database (dropped afterwards)')
+    insert.add_argument('--num', default=20000, type=int, help='Number of documents to insert')
+    insert.add_argument('--batch-sizes', default=[100, 1000, 5000], type=int, nargs='+',
+        help='Batch sizes to test')
+    insert.add_argument('--batch-bytes', default=DEFAULT_BATCH_BYTES, type=int, help='Batch size limit in bytes')
+    insert.set_defaults(func=insert_benchmark)
+
+    refs = subparsers.add_parser('refs', help='Compare adding refs one at a time against coalescing them')
+    refs.add_argument('--mongodb-host', default='localhost', help='MongoDB host')
+    refs.add_argument('--mongodb-port', default=27017, type=int, help='MongoDB port')
+    refs.add_argument('--mongodb-database', default='mongo_migrator_bench',
+        help='Scratch database (dropped afterwards)')
+    refs.add_argument('--num', default=20000, type=int, help='Number of referencing documents')
+    refs.add_argument('--num-refs', default=5, type=int, help='Number of refs into the referencing collection')
+    refs.add_argument('--num-targets', default=1000, type=int, help='Number of documents in each referenced collection')
+    refs.set_defaults(func=refs_benchmark)
+
+    rows = subparsers.add_parser('rows',
+        help='Compare decoding rows into dictionaries and converting them with the codecs against typed rows')
+    rows.add_argument('--num', default=20000, type=int, help='Number of rows to decode')
+    rows.set_defaults(func=rows_benchmark)
+
+    plan = subparsers.add_parser('plan', help='Measure memory per candidate and time taken by the schema search')
+    plan.add_argument('--tables', default=10, type=int, help='Number of tables in the generated schema')
+    plan.add_argument('--extra-fkeys', default=3, type=int,
+        help='Number of foreign keys in the generated schema beyond those that connect the tables')
+    plan.add_argument('--seed', default=0, type=int, help='Random seed used to generate the schema')
+    plan.add_argument('--snapshot', help='Plan the tables saved in this snapshot file instead of a generated schema')
+    plan.add_argument('--save-snapshot', help='Save the schema being planned to this snapshot file')
+    plan.add_argument('--candidates', default=10000, type=int, help='Number of candidates to measure memory with')
+    plan.add_argument('--top', default=5, type=int, help='Also time a search for only this many of the best options')
+    plan.add_argument('--workers', default=[2, 4], type=int, nargs='*',
+        help='Also time the search split between each of these numbers of processes')
+    plan.set_defaults(func=plan_benchmark)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+from decimal import Decimal
+from bson.objectid import ObjectId
+
+# the format of saved checkpoints, which is changed whenever what they hold changes
+CHECKPOINT_VERSION = 1
+
+# progress through the ref phase is saved at most this often, finished tasks are saved as soon as they finish
+SAVE_SECONDS = 10
+
+# default name of the collection MongoCheckpoint keeps checkpoints in
+DEFAULT_CHECKPOINT_COLLECTION = 'mongo_migrator_checkpoint'
+
+# records how far a migration has got so it can be resumed after a failure (see Schema.map)
+# a migration is split into tasks (see Schema.collection_tasks and Schema.ref_tasks), and the checkpoint keeps
+# the key ranges each collection was split into, the tasks that have finished, and the last document each
+# unfinished ref task has updated
+# the state is saved as a dictionary by a subclass, and may be updated by several worker threads at once
+class Checkpoint:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = None
+        self.resumed = False
+        self.last_save = 0
+
+    # starts recording a new migration of the schema, replacing anything saved before
+    def start(self, schema):
+        with self.lock:
+            self.state = {
+                'version': CHECKPOINT_VERSION,
+                'database': schema.graph.db_name,
+                'schema': schema_signature(schema),
+                'ranges': {},
+                'done': [],
+                'refs': {},
+            }
+            self.save_state()
+
+    # reads the saved progress of a migration of the schema
+    # raises ValueError if nothing is saved or it was saved for a different schema
+    def resume(self, schema):
+        with self.lock:
+            state = self.load()
+            if state == None:
+                raise ValueError('There is no checkpoint to resume from')
+            if state.get('version') != CHECKPOINT_VERSION:
+                raise ValueError('The checkpoint was saved by a different version of Mongo Migrator')
+            if state['database'] != schema.graph.db_name or state['schema'] != schema_signature(schema):
+                raise ValueError('The checkpoint was saved for a different schema or database')
+            self.state = state
+            self.resumed = True
+
+    # the key ranges a collection was split into (see Collection.key_ranges), or None if they aren't known yet
+    def key_ranges(self, collection_name):
+        with self.lock:
+            ranges = self.state['ranges'].get(collection_name)
+        if ranges == None:
+            return None
+        return [None if key_range == None else tuple(load_key(key) for key in key_range) for key_range in ranges]
+
+    def set_key_ranges(self, collection_name, key_ranges):
+        ranges = [None if key_range == None else [dump_key(key) for key in key_range] for key_range in key_ranges]
+        with self.lock:
+            self.state['ranges'][collection_name] = ranges
+            self.save_state()
+
+    def is_done(self, task_name):
+        with self.lock:
+            return task_name in self.state['done']
+
+    def set_done(self, task_name):
+        with self.lock:
+            self.state['done'].append(task_name)
+            self.state['refs'].pop(task_name, None)
+            self.save_state()
+
+    # the id of the last document a ref task updated, or None if it hasn't started
+    def ref_position(self, task_name):
+        with self.lock:
+            position = self.state['refs'].get(task_name)
+        return None if position == None else ObjectId(position)
+
+    # records the id of the last document a ref task updated, saving it if it hasn't been saved for a while
+    def set_ref_position(self, task_name, document_id):
+        with self.lock:
+            self.state['refs'][task_name] = str(document_id)
+            if time.time() - self.last_save >= SAVE_SECONDS:
+                self.save_state()
+
+    def save_state(self):
+        self.save(self.state)
+        self.last_save = time.time()
+
+    # returns the saved state, or None if there isn't one
+    def load(self):
+        raise NotImplementedError
+
+    def save(self, state):
+        raise NotImplementedError
+
+    def __str__(self):
+        with self.lock:
+            if self.state == None:
+                return 'Checkpoint: not started'
+            return 'Checkpoint: %d tasks done, %d ref tasks in progress' % (len(self.state['done']),
+                len(self.state['refs']))
+
+    __repr__ = __str__
+
+# a checkpoint saved to a JSON file, which is replaced whole so a crash while saving leaves the last one
+class FileCheckpoint(Checkpoint):
+    def __init__(self, path):
+        super().__init__()
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self, state):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp_path, self.path)
+
+# a checkpoint saved as a document in a MongoDB collection, with the migrated database's name as its id
+class MongoCheckpoint(Checkpoint):
+    def __init__(self, db, collection_name=DEFAULT_CHECKPOINT_COLLECTION):
+        super().__init__()
+        self.collection = db.get_collection(collection_name)
+        self.name = db.name
+
+    def load(self):
+        document = self.collection.find_one({'_id': self.name})
+        if document == None:
+            return None
+        document.pop('_id')
+        return document
+
+    def save(self, state):
+        self.collection.replace_one({'_id': self.name}, state, upsert=True)
+
+# the formats of the key values that JSON has no type for, tagged with their type when they are saved
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+DATE_FORMAT = '%Y-%m-%d'
+
+# a key value as it is saved in a checkpoint
+def dump_key(value):
+    if isinstance(value, Decimal):
+        return {'decimal': str(value)}
+    if isinstance(value, datetime.datetime):
+        return {'datetime': value.strftime(DATETIME_FORMAT)}
+    if isinstance(value, datetime.date):
+        return {'date': value.strftime(DATE_FORMAT)}
+    if isinstance(value, datetime.timedelta):
+        return {'timedelta': [value.days, value.seconds, value.microseconds]}
+    if isinstance(value, bytes):
+        return {'bytes': value.hex()}
+    return value
+
+# a key value saved by dump_key
+def load_key(value):
+    if not isinstance(value, dict):
+        return value
+    if 'decimal' in value:
+        return Decimal(value['decimal'])
+    if 'datetime' in value:
+        return datetime.datetime.strptime(value['datetime'], DATETIME_FORMAT)
+    if 'date' in value:
+        return datetime.datetime.strptime(value['date'], DATE_FORMAT).date()
+    if 'timedelta' in value:
+        return datetime.timedelta(*value['timedelta'])
+    return bytes.fromhex(value['bytes'])
+
+# identifies a schema by a hash of how it is shown, which includes every collection, embed and ref
+def schema_signature(schema):
+    return hashlib.sha256(str(schema).encode('utf-8')).hexdigest()
@@ -0,0 +1,476 @@
+# compact graph states used while searching for schema options
+# copying a Graph rebuilds every Node and Edge, which used to be most of the work of the search
+# here the parts of the graph that never change (tables, foreign keys, null counts, row sizes) are stored
+# once in a SearchSpace, and a candidate graph is a GraphState holding bitsets of which edges are reversed
+# and which are refs, plus a Layout of its nodes and edges that is shared with every other state that has
+# the same nodes and edges and is only rebuilt when a node is duplicated
+
+# sorts nodes and edges by their origin (see Graph.signature)
+# original nodes and edges come first in ID order, followed by duplicates and their edges
+# layouts list nodes and edges in this order so that equivalent states have equal bitsets
+def order_key(origin):
+    if original_id(origin) != None:
+        return (0, origin[1])
+    return (1, repr(origin))
+
+# the ID of an original node or edge, or None for a duplicate
+def original_id(origin):
+    return origin[1] if isinstance(origin[1], int) else None
+
+# the ID of the original edge an edge was copied from
+# copies made when a node is duplicated have the origin of the edge they were copied from as their first part
+def original_edge_id(origin):
+    while original_id(origin) == None:
+        origin = origin[0]
+    return origin[1]
+
+# iterates over the positions of the bits set in mask, lowest first
+def bits(mask):
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+# finds the bridges of an undirected graph, which are the edges that aren't part of any cycle
+# edges is a list of pairs of node numbers from 0 to num_nodes - 1, and may include parallel edges and loops
+# returns the set of positions in edges of the bridges
+# this is Tarjan's bridge finding algorithm, so it takes time linear in the size of the graph, and it keeps
+# its own stack rather than recursing so that it works for long chains of tables
+def find_bridges(num_nodes, edges):
+    adjacent = [[] for _i in range(num_nodes)]
+    for edge, (a, b) in enumerate(edges):
+        adjacent[a].append((b, edge))
+        adjacent[b].append((a, edge))
+    # order is the order nodes are first reached in, and low is the earliest node reachable from a node's
+    # subtree through an edge that isn't the one the subtree was entered by
+    order = [None] * num_nodes
+    low = [None] * num_nodes
+    bridges = set()
+    count = 0
+    for root in range(num_nodes):
+        if order[root] != None:
+            continue
+        order[root] = low[root] = count
+        count += 1
+        # each entry is a node, the edge it was reached by, and the edges it still has to look at
+        stack = [(root, None, iter(adjacent[root]))]
+        while stack:
+            node, via, remaining = stack[-1]
+            for next_node, edge in remaining:
+                if edge == via:
+                    continue
+                if order[next_node] == None:
+                    order[next_node] = low[next_node] = count
+                    count += 1
+                    stack.append((next_node, edge, iter(adjacent[next_node])))
+                    break
+                low[node] = min(low[node], order[next_node])
+            else:
+                stack.pop()
+                if stack:
+                    parent = stack[-1][0]
+                    low[parent] = min(low[parent], low[node])
+                    if low[node] > order[parent]:
+                        bridges.add(via)
+    return bridges
+
+# the tables and foreign keys of a graph, shared by every state searched from it
+class SearchSpace:
+
+    # graph is a Graph whose nodes are all original tables
+    # the space holds no database connection, so it can be sent to the worker processes of a parallel search
+    def __init__(self, graph):
+        self.tables = []
+        self.dont_dup = []
+        self.fkeys = []
+        self.layouts = {}
+        self.current_id = graph.current_id
+        # where each table (by name) and foreign key (by original edge ID) is in tables and fkeys
+        self.table_index = {}
+        self.fkey_index = {}
+        for node in sorted(graph.nodes.values(), key=lambda node: order_key(node.origin)):
+            self.table_index[node.name] = len(self.tables)
+            self.tables.append((node.name, node.pk, node.rowsize, node.num_rows, node.unique_key))
+            self.dont_dup.append(node.dont_dup)
+        for edge in sorted(graph.edges.values(), key=lambda edge: order_key(edge.origin)):
+            self.fkey_index[edge.id] = len(self.fkeys)
+            self.fkeys.append((edge.fkey_col, edge.fkey_table, edge.null_fk_count))
+        self.initial = self.graph_state(graph)
+
+    # layouts are built again by whichever process needs them, and the initial state isn't needed there
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['layouts'] = {}
+        del state['initial']
+        return state
+
+    # makes the state of a graph, which may be any graph reached from the one the space was made from
+    def graph_state(self, graph):
+        nodes = {}
+        edges = {}
+        reversed_edges = set()
+        ref_edges = set()
+        for node in graph.nodes.values():
+            nodes[node.origin] = self.table_index[node.name]
+        for edge in graph.edges.values():
+            # edges are stored the way round they were before being reversed
+            from_node, to_node = (edge.to_node, edge.from_node) if edge.reversed else (edge.from_node, edge.to_node)
+            edges[edge.origin] = (self.fkey_index[original_edge_id(edge.origin)], from_node.origin, to_node.origin)
+            if edge.reversed:
+                reversed_edges.add(edge.origin)
+            if edge.reference:
+                ref_edges.add(edge.origin)
+        steps = ()
+        for step in graph.steps:
+            steps = (steps, step)
+        return self.make_state(nodes, edges, reversed_edges, ref_edges, steps, len(graph.steps))
+
+    # makes a state from nodes, a dict of node origin to table, and edges, a dict of edge origin to
+    # foreign key and from and to node origins
+    def make_state(self, nodes, edges, reversed_edges, ref_edges, steps, depth):
+        layout = self.layout((frozenset(nodes.items()), frozenset(edges.items())))
+        reversed_bits = 0
+        for origin in reversed_edges:
+            reversed_bits |= 1 << layout.edge_index[origin]
+        ref_bits = 0
+        for origin in ref_edges:
+            ref_bits |= 1 << layout.edge_index[origin]
+        state = GraphState(layout, reversed_bits, ref_bits, steps, depth)
+        state.check_nodes()
+        return state
+
+    # makes a state from what GraphState.pack returned, which may have been in another process
+    def unpack(self, packed):
+        key, reversed_bits, ref_bits, steps, depth = packed
+        state = GraphState(self.layout(key), reversed_bits, ref_bits, steps, depth)
+        state.check_nodes()
+        return state
+
+    # states with the same nodes and edges share one layout
+    def layout(self, key):
+        layout = self.layouts.get(key)
+        if layout == None:
+            layout = Layout(self, key, dict(key[0]), dict(key[1]))
+            self.layouts[key] = layout
+        return layout
+
+# the nodes and edges of a graph state
+# nodes and edges are numbered in order_key order, and each edge is the bit with its number in the bitsets
+class Layout:
+    __slots__ = ('space', 'key', 'node_origins', 'node_tables', 'edge_origins', 'edge_fkeys', 'edge_from',
+        'edge_to', 'edge_index', 'from_masks', 'to_masks', 'loops')
+
+    def __init__(self, space, key, nodes, edges):
+        self.space = space
+        self.key = key
+        self.node_origins = tuple(sorted(nodes, key=order_key))
+        self.node_tables = tuple(nodes[origin] for origin in self.node_origins)
+        node_index = {origin: i for i, origin in enumerate(self.node_origins)}
+        self.edge_origins = tuple(sorted(edges, key=order_key))
+        self.edge_index = {origin: i for i, origin in enumerate(self.edge_origins)}
+        self.edge_fkeys = tuple(edges[origin][0] for origin in self.edge_origins)
+        self.edge_from = tuple(node_index[edges[origin][1]] for origin in self.edge_origins)
+        self.edge_to = tuple(node_index[edges[origin][2]] for origin in self.edge_origins)
+
+        # for each node, the edges leaving and entering it before any are reversed
+        self.from_masks = [0] * len(self.node_origins)
+        self.to_masks = [0] * len(self.node_origins)
+        self.loops = 0
+        for i in range(len(self.edge_origins)):
+            self.from_masks[self.edge_from[i]] |= 1 << i
+            self.to_masks[self.edge_to[i]] |= 1 << i
+            if self.edge_from[i] == self.edge_to[i]:
+                self.loops |= 1 << i
+
+    def table(self, node):
+        return self.space.tables[self.node_tables[node]]
+
+# a candidate graph in the search for schema options
+# mirrors the parts of Graph used by the search, and Graph.state_graph turns a state back into a Graph
+# each state also keeps track of what makes it invalid, which is updated from the state it was made from
+# rather than worked out again for the whole graph
+class GraphState:
+    __slots__ = ('layout', 'reversed', 'reference', 'steps', 'depth', 'multi_parents', 'bad_refs', 'acyclic',
+        'cycle', 'cycle_edge')
+
+    # steps are kept as nested (previous steps, step) pairs so that states share the steps they have in common
+    # and depth is the number of steps
+    # multi_parents and bad_refs are bitsets of the nodes with multiple parents and with too many refs to them
+    # acyclic is True or False once it is known whether the state has a cycle, and cycle is the cycle found by
+    # get_cycle once it has run
+    # cycle_edge is set when the state was made from an acyclic one and any cycle must go through that edge
+    def __init__(self, layout, reversed, reference, steps, depth):
+        self.layout = layout
+        self.reversed = reversed
+        self.reference = reference
+        self.steps = steps
+        self.depth = depth
+        self.multi_parents = 0
+        self.bad_refs = 0
+        self.acyclic = None
+        self.cycle = None
+        self.cycle_edge = None
+
+    # makes a state with different edge flags that starts with what is known about this one
+    def copy_state(self, reversed, reference, step):
+        copy = GraphState(self.layout, reversed, reference, self.steps, self.depth + 1)
+        copy.multi_parents = self.multi_parents
+        copy.bad_refs = self.bad_refs
+        copy.steps = (self.steps, step(copy))
+        return copy
+
+    # the steps used to generate the state, in order
+    def step_list(self):
+        steps = []
+        node = self.steps
+        while node:
+            node, step = node
+            steps.append(step)
+        steps.reverse()
+        return steps
+
+    def num_steps(self):
+        return self.depth
+
+    def num_refs(self):
+        return bin(self.reference).count('1')
+
+    # the state as a picklable tuple for SearchSpace.unpack
+    # layouts refer back to their search space, so only the layout's key is kept
+    def pack(self):
+        return self.layout.key, self.reversed, self.reference, self.steps, self.depth
+
+    # the edges into a node as a bitset, taking reversed edges into account
+    def parent_edges(self, node):
+        layout = self.layout
+        return (layout.to_masks[node] & ~self.reversed) | (layout.from_masks[node] & self.reversed)
+
+    # the edges out of a node as a bitset, taking reversed edges into account
+    def child_edges(self, node):
+        layout = self.layout
+        return (layout.from_masks[node] & ~self.reversed) | (layout.to_masks[node] & self.reversed)
+
+    # the node an edge currently points from
+    def from_node(self, edge):
+        if self.reversed >> edge & 1:
+            return self.layout.edge_to[edge]
+        return self.layout.edge_from[edge]
+
+    # the node an edge currently points to
+    def to_node(self, edge):
+        if self.reversed >> edge & 1:
+            return self.layout.edge_from[edge]
+        return self.layout.edge_to[edge]
+
+    # called when a state is not a valid schema (either has a cycle or node with multiple parents)
+    # generates new states where each new state has one thing changed
+    # hopefully one of the new states will be valid
+    # states equivalent to one already in seen are left out
+    def generate(self, states, seen):
+        multiparent_node = self.get_multi_parent_node()
+        if multiparent_node != None:
+
+            if not self.layout.space.dont_dup[self.layout.node_tables[multiparent_node]]:
+                copy = self.duplicate(multiparent_node)
+                if seen.add(copy):
+                    states.append(copy)
+
+            problem_edges = list(bits(self.parent_edges(multiparent_node)))
+
+        else:
+            problem_edges = self.get_cycle() or []
+
+        # Try reversing an edge
+        for edge in problem_edges:
+            if not self.reversed >> edge & 1:
+                copy = self.reverse(edge)
+                if seen.add(copy):
+                    states.append(copy)
+
+        # Try making an edge a ref edge
+        for edge in problem_edges:
+            if not self.reference >> edge & 1:
+                copy = self.make_ref(edge)
+                if seen.add(copy):
+                    states.append(copy)
+
+    # returns a cycle as a list of edge numbers if the state contains one
+    def get_cycle(self):
+        if self.acyclic:
+            return None
+        if self.cycle == None:
+            tested = set()
+            for node in range(len(self.layout.node_origins)):
+                if node in tested:
+                    continue
+                self.cycle = self.cycle_search(node, tested, set(), [])
+                if self.cycle != None:
+                    break
+            self.acyclic = self.cycle == None
+        return self.cycle
+
+    def has_cycle(self):
+        if self.acyclic == None:
+            if self.cycle_edge != None:
+                # the only possible cycle goes through cycle_edge, so look for a path back from its end to its start
+                edge = self.cycle_edge
+                self.acyclic = not self.reaches(self.to_node(edge), self.from_node(edge))
+            else:
+                self.get_cycle()
+        return not self.acyclic
+
+    # checks for a path from one node to another that doesn't use ref edges
+    def reaches(self, node, target):
+        stack = [node]
+        visited = set(stack)
+        while stack:
+            node = stack.pop()
+            if node == target:
+                return True
+            for edge in bits(self.child_edges(node) & ~self.reference):
+                to_node = self.to_node(edge)
+                if not to_node in visited:
+                    visited.add(to_node)
+                    stack.append(to_node)
+        return False
+
+    # searches from a node for a cycle and returns cycle if found
+    def cycle_search(self, node, tested, visited, path):
+        if node in visited:
+            return path
+        visited.add(node)
+        tested.add(node)
+        for edge in bits(self.child_edges(node) & ~self.reference):
+            cycle = self.cycle_search(self.to_node(edge), tested, visited, path + [edge])
+            if cycle != None:
+                return cycle
+        return None
+
+    # returns a node with multiple parents if the state contains one
+    def get_multi_parent_node(self):
+        if self.multi_parents == 0:
+            return None
+        return (self.multi_parents & -self.multi_parents).bit_length() - 1
+
+    def check_nodes(self):
+        for node in range(len(self.layout.node_origins)):
+            self.check_node(node)
+
+    # works out whether a node has multiple parents or too many refs to it, after one of its edges changed
+    def check_node(self, node):
+        layout = self.layout
+        bit = 1 << node
+        parents = self.parent_edges(node)
+        # it is acceptable to have multiple parents only if all are refs
+        if parents & (parents - 1) and parents & ~self.reference:
+            self.multi_parents |= bit
+        else:
+            self.multi_parents &= ~bit
+        # don't actually count a recursive edge as a ref
+        parents &= ~layout.loops
+        if layout.space.dont_dup[layout.node_tables[node]] and parents & (parents - 1):
+            self.bad_refs |= bit
+        else:
+            self.bad_refs &= ~bit
+
+    # nodes that shouldn't be duplicated shouldn't have more than one ref to them
+    def refs_valid(self):
+        return self.bad_refs == 0
+
+    # checks that a state represents a valid MongoDB schema
+    def is_valid(self):
+        return self.multi_parents == 0 and self.bad_refs == 0 and not self.has_cycle()
+
+    # a description of the state that is the same for equivalent states however they were generated
+    # layouts are shared and number their edges the same way, so the bitsets can be compared directly
+    def signature(self):
+        return self.layout.key, self.reversed, self.reference
+
+    # describes an edge the way Edge.__str__ does
+    def edge_str(self, edge):
+        layout = self.layout
+        from_node, to_node = layout.edge_from[edge], layout.edge_to[edge]
+        if self.reversed >> edge & 1:
+            from_node, to_node = to_node, from_node
+        fkey_col, fkey_table, _null_fk_count = layout.space.fkeys[layout.edge_fkeys[edge]]
+        return "(%s -> %s) via %s.%s" % (layout.table(from_node)[0], layout.table(to_node)[0], fkey_table, fkey_col)
+
+    # returns a copy of the state with an edge reversed
+    # basically going from a one-to-many to a many-to-one relationship
+    # only the nodes at either end of the edge change, and a new cycle would have to go through the edge
+    def reverse(self, edge):
+        copy = self.copy_state(self.reversed ^ (1 << edge), self.reference,
+            lambda copy: "Reversed edge: %s" % copy.edge_str(edge))
+        copy.check_node(self.layout.edge_from[edge])
+        copy.check_node(self.layout.edge_to[edge])
+        if self.reference >> edge & 1:
+            # refs aren't part of cycles
+            copy.acyclic, copy.cycle, copy.cycle_edge = self.acyclic, self.cycle, self.cycle_edge
+        elif self.acyclic:
+            copy.cycle_edge = edge
+        elif self.cycle != None and not edge in self.cycle:
+            copy.acyclic = False
+        return copy
+
+    # returns a copy of the state with an edge converted to a ref edge
+    # only the node the edge points to changes, and no cycles are made
+    def make_ref(self, edge):
+        copy = self.copy_state(self.reversed, self.reference | (1 << edge),
+            lambda copy: "Converted edge to ref: %s" % copy.edge_str(edge))
+        copy.check_node(self.to_node(edge))
+        if self.acyclic or self.cycle_edge == edge:
+            copy.acyclic = True
+        elif self.cycle != None and not edge in self.cycle:
+            copy.acyclic = False
+        else:
+            copy.cycle_edge = self.cycle_edge
+        return copy
+
+    # returns a copy of the state with a node that has multiple parents duplicated
+    # for each parent a new node will be created that has only one parent
+    # each of the duplicates will have the same children as the original node
+    def duplicate(self, node):
+        layout = self.layout
+        name = layout.table(node)[0]
+        origin = layout.node_origins[node]
+        child_edges = self.child_edges(node)
+        # a recursive edge is removed along with the other child edges, and each duplicate gets its own
+        parent_edges = self.parent_edges(node) & ~child_edges
+
+        nodes = dict(zip(layout.node_origins, layout.node_tables))
+        del nodes[origin]
+        edges = {}
+        reversed_edges = set()
+        ref_edges = set()
+        for edge, edge_origin in enumerate(layout.edge_origins):
+            if not child_edges >> edge & 1:
+                edges[edge_origin] = (layout.edge_fkeys[edge], layout.node_origins[layout.edge_from[edge]],
+                    layout.node_origins[layout.edge_to[edge]])
+                if self.reversed >> edge & 1:
+                    reversed_edges.add(edge_origin)
+                if self.reference >> edge & 1:
+                    ref_edges.add(edge_origin)
+
+        for parent_edge in bits(parent_edges):
+            copy = (name, layout.edge_origins[parent_edge])
+            nodes[copy] = layout.node_tables[node]
+            fkey, from_origin, to_origin = edges[layout.edge_origins[parent_edge]]
+            edges[layout.edge_origins[parent_edge]] = (fkey, copy if from_origin == origin else from_origin,
+                copy if to_origin == origin else to_origin)
+            for edge in bits(child_edges):
+                edge_origin = (layout.edge_origins[edge], copy)
+                from_origin = layout.node_origins[layout.edge_from[edge]]
+                to_origin = layout.node_origins[layout.edge_to[edge]]
+                edges[edge_origin] = (layout.edge_fkeys[edge], copy if from_origin == origin else from_origin,
+                    copy if to_origin == origin else to_origin)
+                if self.reversed >> edge & 1:
+                    reversed_edges.add(edge_origin)
+                if self.reference >> edge & 1:
+                    ref_edges.add(edge_origin)
+
+        copy = layout.space.make_state(nodes, edges, reversed_edges, ref_edges,
+            (self.steps, "Duplicated node: %s" % name), self.depth + 1)
+        # any cycle in the copy would also be one in this state
+        if self.acyclic:
+            copy.acyclic = True
+        return copy
@@ -0,0 +1,303 @@
+import bisect
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# upper bounds in seconds of the buckets latencies are counted in, as Prometheus histograms count them
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# progress is shown at most this often while migrating
+PROGRESS_SECONDS = 10
+
+# the names of the metrics written for Prometheus start with this
+PROMETHEUS_PREFIX = 'mongo_migrator_'
+
+# what each metric counts, shown in the Prometheus textfile
+# counters are named with a _total suffix there, and histograms are the ones named in seconds
+METRICS = OrderedDict([
+    ('introspection_queries', 'Queries run to read the tables and foreign keys of the database'),
+    ('introspection_query_seconds', 'Time taken by each query reading the tables and foreign keys'),
+    ('plan_options', 'Schema options found by the planner'),
+    ('plan_option_seconds', 'Time the planner took to find each schema option'),
+    ('plan_states', 'Schema states explored by the planner'),
+    ('plan_pruned_states', 'Repeated schema states pruned by the planner'),
+    ('mysql_queries', 'MySQL queries run to read the rows of each table at each level of nesting'),
+    ('mysql_rows', 'MySQL rows read from each table at each level of nesting'),
+    ('mysql_query_seconds', 'Time taken by each MySQL query reading the rows of a table'),
+    ('collection_seconds', 'Time spent migrating each collection, added up over its key ranges'),
+    ('documents_written', 'Documents written to each collection'),
+    ('bytes_written', 'Bytes of BSON written to each collection'),
+    ('write_batches', 'Batches of documents written to each collection'),
+    ('write_errors', 'Batches written to each collection that had write errors'),
+    ('write_batch_seconds', 'Time taken to write each batch of documents'),
+    ('ref_prepare_seconds', 'Time taken to read the ids of the documents each ref points to'),
+    ('ref_documents_read', 'Documents read to add refs to each collection'),
+    ('ref_documents_updated', 'Documents given refs in each collection'),
+    ('ref_write_seconds', 'Time taken to write each batch of ref updates'),
+])
+
+# the number of values at or below each of a set of bounds, with their count and sum
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    # the bound of the bucket holding the q quantile of the values, or None if it is above the largest bound
+    def quantile(self, q):
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return None
+
+    # the number of values at or below each bound, ending with all of them as Prometheus lists them
+    def cumulative(self):
+        total = 0
+        results = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            results.append((bound, total))
+        return results
+
+# how many of a migration's documents have been written and how long the rest should take at the rate so far
+class Progress:
+    def __init__(self, total, interval=PROGRESS_SECONDS):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = time.perf_counter()
+        self.last_shown = self.start
+
+    # adds written documents, returning whether it is time to show the progress again
+    def advance(self, num):
+        self.done += num
+        now = time.perf_counter()
+        if now - self.last_shown < self.interval:
+            return False
+        self.last_shown = now
+        return True
+
+    # the estimated seconds left, or None until there is a rate to estimate it from
+    def eta(self):
+        if self.done == 0 or self.total == None:
+            return None
+        elapsed = time.perf_counter() - self.start
+        return max(self.total - self.done, 0) * elapsed / self.done
+
+    def __str__(self):
+        elapsed = time.perf_counter() - self.start
+        if not self.total:
+            return 'Written %d documents in %s' % (self.done, format_seconds(elapsed))
+        eta = self.eta()
+        return 'Written %d of about %d documents (%.0f%%) in %s, %s left' % (self.done, self.total,
+            100 * min(self.done / self.total, 1), format_seconds(elapsed),
+            'unknown time' if eta == None else 'about ' + format_seconds(eta))
+
+    __repr__ = __str__
+
+# counters, gauges and latency histograms of what introspection, planning and migrating did, each kept for every
+# set of labels it is recorded with, like the table and nesting level of a query
+# one instance is shared by the whole run and may be used by several worker threads at once
+# results are shown with str, or exported with write_json and write_prometheus
+class Metrics:
+    def __init__(self, show_progress=False, progress_seconds=PROGRESS_SECONDS):
+        self.lock = threading.Lock()
+        self.counters = OrderedDict()
+        self.gauges = OrderedDict()
+        self.histograms = OrderedDict()
+        self.show_progress = show_progress
+        self.progress_seconds = progress_seconds
+        self.progress = None
+        self.start = time.time()
+
+    # adds value to a counter
+    def add(self, name, value=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # sets a gauge to value
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[metric_key(name, labels)] = value
+
+    # adds a latency in seconds to a histogram
+    def observe(self, name, seconds, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram == None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    # records a MySQL query that read num_rows rows of a table for records level embeds deep, 0 being a collection
+    def query(self, table_name, level, seconds, num_rows):
+        self.add('mysql_queries', table=table_name, level=level)
+        self.add('mysql_rows', num_rows, table=table_name, level=level)
+        self.observe('mysql_query_seconds', seconds, table=table_name, level=level)
+
+    # records rows read from a query already recorded, like the windows of a scan
+    def rows(self, table_name, level, num_rows):
+        self.add('mysql_rows', num_rows, table=table_name, level=level)
+
+    # records a batch of documents written to a collection, advancing the progress
+    def batch(self, collection_name, num_documents, num_bytes, seconds, failed):
+        self.add('write_batches', collection=collection_name)
+        self.add('documents_written', num_documents, collection=collection_name)
+        self.add('bytes_written', num_bytes, collection=collection_name)
+        if failed:
+            self.add('write_errors', collection=collection_name)
+        self.observe('write_batch_seconds', seconds, collection=collection_name)
+        with self.lock:
+            show = self.progress != None and self.progress.advance(num_documents)
+        if show and self.show_progress:
+            print(self.progress)
+
+    # starts counting the progress of a migration of about total documents, or an unknown number if it is None
+    def start_progress(self, total):
+        with self.lock:
+            self.progress = Progress(total, self.progress_seconds)
+
+    # the counters added up over each value of one label, like the rows read from each table at every level
+    def totals(self, name, label):
+        totals = OrderedDict()
+        with self.lock:
+            for (metric, labels), value in self.counters.items():
+                if metric == name:
+                    value_of = dict(labels).get(label)
+                    totals[value_of] = totals.get(value_of, 0) + value
+        return totals
+
+    # everything recorded so far as a dictionary that can be saved as JSON
+    # the rows, queries and query time of each table and nesting level are added up as well
+    def report(self):
+        with self.lock:
+            report = OrderedDict([
+                ('started', time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(self.start))),
+                ('seconds', time.time() - self.start),
+                ('counters', [metric_json(name, labels, value) for (name, labels), value in self.counters.items()]),
+                ('gauges', [metric_json(name, labels, value) for (name, labels), value in self.gauges.items()]),
+                ('histograms', [metric_json(name, labels, histogram_json(histogram))
+                    for (name, labels), histogram in self.histograms.items()]),
+            ])
+            if self.progress != None:
+                report['progress'] = OrderedDict([('documents', self.progress.done),
+                    ('total', self.progress.total), ('eta_seconds', self.progress.eta())])
+        for label, key in [('table', 'tables'), ('level', 'levels')]:
+            seconds = self.histogram_totals('mysql_query_seconds', label)
+            rows = self.totals('mysql_rows', label)
+            report[key] = OrderedDict((str(value), OrderedDict([('queries', num_queries),
+                ('rows', rows.get(value, 0)), ('seconds', seconds.get(value, 0))]))
+                for value, num_queries in self.totals('mysql_queries', label).items())
+        return report
+
+    # the sums of histograms added up over each value of one label
+    def histogram_totals(self, name, label):
+        totals = {}
+        with self.lock:
+            for (metric, labels), histogram in self.histograms.items():
+                if metric == name:
+                    value_of = dict(labels).get(label)
+                    totals[value_of] = totals.get(value_of, 0) + histogram.sum
+        return totals
+
+    # saves report to a JSON file, written under another name first so it is never left half written
+    def write_json(self, path):
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.report(), f, indent=4)
+        os.replace(path + '.tmp', path)
+
+    # saves everything recorded so far in the Prometheus text format, for node_exporter's textfile collector
+    # the file is written under another name first since the collector may read it at any time
+    def write_prometheus(self, path):
+        lines = []
+        with self.lock:
+            for name, kind, samples in self.prometheus_metrics():
+                described = name[:-len('_total')] if kind == 'counter' else name
+                lines.append('# HELP %s%s %s' % (PROMETHEUS_PREFIX, name, METRICS.get(described, described)))
+                lines.append('# TYPE %s%s %s' % (PROMETHEUS_PREFIX, name, kind))
+                lines.extend(samples)
+        with open(path + '.tmp', 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+    # the name, type and sample lines of every metric, grouped by name as the text format needs
+    def prometheus_metrics(self):
+        groups = OrderedDict()
+        for (name, labels), value in self.counters.items():
+            groups.setdefault((name + '_total', 'counter'), []).append(prometheus_sample(name + '_total', labels,
+                value))
+        for (name, labels), value in self.gauges.items():
+            groups.setdefault((name, 'gauge'), []).append(prometheus_sample(name, labels, value))
+        for (name, labels), histogram in self.histograms.items():
+            samples = groups.setdefault((name, 'histogram'), [])
+            for bound, count in histogram.cumulative():
+                bucket_labels = labels + (('le', '+Inf' if bound == float('inf') else repr(bound)),)
+                samples.append(prometheus_sample(name + '_bucket', bucket_labels, count))
+            samples.append(prometheus_sample(name + '_sum', labels, histogram.sum))
+            samples.append(prometheus_sample(name + '_count', labels, histogram.count))
+        return [(name, kind, samples) for (name, kind), samples in groups.items()]
+
+    def __str__(self):
+        lines = ['Metrics:']
+        seconds = self.histogram_totals('mysql_query_seconds', 'table')
+        rows = self.totals('mysql_rows', 'table')
+        for table_name, num_queries in self.totals('mysql_queries', 'table').items():
+            lines.append('  %s: %d queries, %d rows, %.2f sec in MySQL' % (table_name, num_queries,
+                rows.get(table_name, 0), seconds.get(table_name, 0)))
+        written = self.totals('bytes_written', 'collection')
+        write_seconds = self.histogram_totals('write_batch_seconds', 'collection')
+        for collection_name, num_documents in self.totals('documents_written', 'collection').items():
+            lines.append('  %s: %d documents, %d bytes, %.2f sec writing' % (collection_name, num_documents,
+                written.get(collection_name, 0), write_seconds.get(collection_name, 0)))
+        with self.lock:
+            if self.progress != None:
+                lines.append('  %s' % self.progress)
+        return '\n'.join(lines)
+
+    __repr__ = __str__
+
+# a metric is kept for each set of labels, sorted so the order they are given in doesn't matter
+def metric_key(name, labels):
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+def metric_json(name, labels, value):
+    return OrderedDict([('name', name), ('labels', OrderedDict(labels)), ('value', value)])
+
+def histogram_json(histogram):
+    return OrderedDict([
+        ('count', histogram.count),
+        ('sum', histogram.sum),
+        ('p50', histogram.quantile(0.5)),
+        ('p95', histogram.quantile(0.95)),
+        ('p99', histogram.quantile(0.99)),
+        ('buckets', [[None if bound == float('inf') else bound, count] for bound, count in histogram.cumulative()]),
+    ])
+
+def prometheus_sample(name, labels, value):
+    text = ','.join('%s="%s"' % (label, escape_label(label_value)) for label, label_value in labels)
+    return '%s%s%s %s' % (PROMETHEUS_PREFIX, name, '{%s}' % text if text else '', repr(value))
+
+def escape_label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+# shows a number of seconds as hours, minutes and seconds
+def format_seconds(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return '%dh%02dm%02ds' % (hours, minutes, seconds)
+    if minutes:
+        return '%dm%02ds' % (minutes, seconds)
+    return '%ds' % seconds
@@ -1,6 +1,10 @@
 import argparse
+import cProfile
+import functools
 import pymysql.cursors
 import pymongo
+from checkpoint import FileCheckpoint, MongoCheckpoint
+from metrics import Metrics
 from schema_graph import *
 
 block_text = """  __  __                           __  __ _                 _             
@@ -14,41 +18,146 @@ block_text = """  __  __                           __  __ _                 _
 
 # function for choosing a schema and migrating data
 def migrate(args):
+	if args.offline:
+		return plan_offline(args)
 
-	mysql_connection = pymysql.connect(host=args.mysql_host,
+	# opens a new connection to the MySQL database
+	# the migration opens extra connections for scans that stream their results
+	connect = functools.partial(pymysql.connect, host=args.mysql_host,
 	                             port=args.mysql_port,
 	                             user=args.mysql_username,
 	                             password=args.mysql_password,
 	                             db=args.database,
 	                             cursorclass=pymysql.cursors.DictCursor)
+	mysql_connection = connect()
 
 	mongo_client = pymongo.MongoClient(args.mongodb_host, args.mongodb_port)
+	metrics = make_metrics(args)
+	profiler = cProfile.Profile() if args.profile_planner != None else None
 
 	# model the MySQL scema as a graph and generate MongoDB schema options
-	graph = Graph(mysql_connection, args.database)
-	opts = graph.get_opts()
+	graph = Graph(mysql_connection, args.database, connect=connect, row_stats=args.row_stats,
+		sample_rows=args.sample_rows, snapshot=args.snapshot, metrics=metrics)
+	print(graph.introspection)
+	opts = graph.get_opts(top=args.plan_top, time_budget=args.plan_time_budget, workers=args.plan_workers,
+		profiler=profiler)
+	# options are found as they are viewed, so this runs the search for the first page
+	opts.has(5)
+	print(graph.states)
 
 	view_schemas(0, 5, opts)
+	if profiler != None:
+		profiler.dump_stats(args.profile_planner)
 
-	if input('Would you like to migrate to MongoDB? (y/n) ').lower() == 'y':
+	# the marks of a sync are kept like a checkpoint, and once they have been recorded the chosen schema is synced
+	# instead of migrated
+	sync_store = None
+	if args.sync_file != None:
+		sync_store = FileCheckpoint(args.sync_file)
+	elif args.sync_collection != None:
+		sync_store = MongoCheckpoint(mongo_client[args.database], args.sync_collection)
+	if sync_store != None and sync_store.load() != None:
+		sync(args, opts, mongo_client, mysql_connection, sync_store)
+		return save_metrics(args, metrics)
+
+	destination = 'MongoDB' if args.output_dir == None else args.output_dir
+	if input('Would you like to migrate to %s? (y/n) ' % destination).lower() == 'y':
 		schema = opts[int(input('Which schema would you like to use? ')) - 1]
+		# with an output directory documents are exported to files instead of written to MongoDB
+		sink = None
+		if args.output_dir != None:
+			sink = FileSink(args.output_dir, args.output_format, args.compress, args.rotate_bytes)
+		# progress is recorded so a failed migration can be resumed with --resume
+		checkpoint = None
+		if args.checkpoint_file != None:
+			checkpoint = FileCheckpoint(args.checkpoint_file)
+		elif args.checkpoint_collection != None:
+			checkpoint = MongoCheckpoint(mongo_client[args.database], args.checkpoint_collection)
 		try:
-			schema.map(mongo_client)
+			# the first sync only records how far each table has got, so it is run before migrating and later
+			# syncs find the changes made during and after the migration
+			if sync_store != None:
+				schema.sync(mongo_client, sync_store, watermark=args.watermark_column, inline_refs=args.inline_refs)
+			writer = schema.map(mongo_client, batch_size=args.batch_size, batch_bytes=args.batch_bytes,
+				window_size=args.window_size, merge_join=args.merge_join,
+				cache_size=args.cache_size, cache_bytes=args.cache_bytes, preload_rows=args.preload_rows,
+				workers=args.workers, partition_rows=args.partition_rows,
+				inline_refs=args.inline_refs, sink=sink, typed_rows=args.typed_rows,
+				pipeline_queue=args.pipeline_queue, checkpoint=checkpoint, resume=args.resume, metrics=metrics)
+			if writer.errors:
+				print('%d batches had write errors' % len(writer.errors))
+			if schema.lookup_cache != None:
+				print(schema.lookup_cache)
+			if schema.pipeline != None:
+				print(schema.pipeline)
+			if sink != None:
+				print(sink)
+			if metrics != None:
+				print(metrics)
 			print('Migration complete')
 		finally:
 			mysql_connection.close()
+			# reports are saved even if the migration failed, to show how far it got
+			save_metrics(args, metrics)
+	else:
+		save_metrics(args, metrics)
+
+# function for updating the documents of a migrated schema with the changes made to MySQL since the last sync
+def sync(args, opts, mongo_client, mysql_connection, sync_store):
+	if input('Would you like to sync the changes since the last sync to MongoDB? (y/n) ').lower() == 'y':
+		schema = opts[int(input('Which schema did you migrate with? ')) - 1]
+		try:
+			schema.sync(mongo_client, sync_store, watermark=args.watermark_column, window_size=args.window_size,
+				inline_refs=args.inline_refs)
+			print('Sync complete')
+		finally:
+			mysql_connection.close()
+
+# shows the schema options for the tables saved in a snapshot, without connecting to MySQL or MongoDB
+def plan_offline(args):
+	if args.snapshot == None:
+		raise ValueError('--offline needs a --snapshot to plan from')
+	metrics = make_metrics(args)
+	profiler = cProfile.Profile() if args.profile_planner != None else None
+	graph = Graph(None, args.database, snapshot=args.snapshot, metrics=metrics)
+	print(graph.introspection)
+	opts = graph.get_opts(top=args.plan_top, time_budget=args.plan_time_budget, workers=args.plan_workers,
+		profiler=profiler)
+	opts.has(5)
+	print(graph.states)
+	view_schemas(0, 5, opts, preview=False)
+	if profiler != None:
+		profiler.dump_stats(args.profile_planner)
+	save_metrics(args, metrics)
+
+# metrics are only recorded when they are shown as progress or saved to a report
+def make_metrics(args):
+	if args.metrics_json == None and args.metrics_prometheus == None and not args.progress:
+		return None
+	return Metrics(show_progress=args.progress)
+
+# saves the metrics to the reports asked for
+def save_metrics(args, metrics):
+	if metrics == None:
+		return
+	if args.metrics_json != None:
+		metrics.write_json(args.metrics_json)
+	if args.metrics_prometheus != None:
+		metrics.write_prometheus(args.metrics_prometheus)
 
 # display mongodb schema options for the user to choose from
-def view_schemas(start, end, opts):
-	for i in range(start, min(end, len(opts))):
-		opt = opts[i]
+# previews need a MySQL connection, so they are only offered with preview set
+def view_schemas(start, end, opts, preview=True):
+	for i in range(start, end):
+		if not opts.has(i + 1):
+			break
 		print('%d)' % (i + 1))
-		print(opt)
+		print(opts[i])
 
-	if end < len(opts) and input('Would you like to view more schema options? (y/n) ').lower() == 'y':
-		return view_schemas(end, end + 5, opts)
+	if opts.has(end + 1) and input('Would you like to view more schema options? (y/n) ').lower() == 'y':
+		return view_schemas(end, end + 5, opts, preview)
 
-	while input('Would you like to preview a schema? (y/n) ').lower() == 'y':
+	while preview and input('Would you like to preview a schema? (y/n) ').lower() == 'y':
 		schema = opts[int(input('Which schema would you like to preview? ')) - 1]
 		num_records = int(input('How many records would you like to preview? '))
 		filename = input('Enter name of preview file: ')
@@ -60,12 +169,83 @@ def main():
 	parser = argparse.ArgumentParser()
 	parser.add_argument('--mysql-host', default='localhost', help='MySQL database host')
 	parser.add_argument('--mysql-port', default=3306, type=int, help='MySQL database port')
-	parser.add_argument('--mysql-username', required=True, help='MySQL username')
-	parser.add_argument('--mysql-password', required=True, help='MySQL password')
+	parser.add_argument('--mysql-username', help='MySQL username (required unless --offline)')
+	parser.add_argument('--mysql-password', help='MySQL password (required unless --offline)')
 	parser.add_argument('--mongodb-host', default='localhost', help='MongoDB host')
 	parser.add_argument('--mongodb-port', default=27017, type=int, help='MongoDB port')
+	parser.add_argument('--batch-size', default=DEFAULT_BATCH_SIZE, type=int,
+		help='Maximum number of documents per MongoDB insert batch')
+	parser.add_argument('--batch-bytes', default=DEFAULT_BATCH_BYTES, type=int,
+		help='Maximum size in bytes of a MongoDB insert batch')
+	parser.add_argument('--window-size', default=DEFAULT_WINDOW_SIZE, type=int,
+		help='Number of records whose embedded children are fetched together (0 fetches them one record at a time)')
+	parser.add_argument('--merge-join', action='store_true',
+		help='Assemble one to many embeds by merging ordered scans of each table')
+	parser.add_argument('--cache-size', default=DEFAULT_CACHE_SIZE, type=int,
+		help='Maximum number of many to one records cached during migration (0 disables the cache)')
+	parser.add_argument('--cache-bytes', default=DEFAULT_CACHE_BYTES, type=int,
+		help='Maximum size in bytes of the many to one record cache')
+	parser.add_argument('--preload-rows', default=DEFAULT_PRELOAD_ROWS, type=int,
+		help='Many to one tables with at most this many rows are cached in full before migrating (0 disables)')
+	parser.add_argument('--workers', default=1, type=int,
+		help='Number of collections to migrate in parallel, each with its own MySQL connection')
+	parser.add_argument('--partition-rows', default=DEFAULT_PARTITION_ROWS, type=int,
+		help='With more than one worker, tables are split into key ranges of about this many rows (0 disables)')
+	parser.add_argument('--inline-refs', action='store_true',
+		help='Write references while migrating, using ids derived from primary keys for referenced collections')
+	parser.add_argument('--typed-rows', action='store_true',
+		help='Read rows as tuples and convert them with decoders compiled from each table\'s column types')
+	parser.add_argument('--pipeline-queue', default=0, type=int,
+		help='Read rows, assemble documents and write them on separate threads with queues of this many windows or batches between them (0 disables)')
+	parser.add_argument('--checkpoint-file',
+		help='Record the progress of the migration in this file so that it can be resumed if it fails')
+	parser.add_argument('--checkpoint-collection',
+		help='Record the progress of the migration in this MongoDB collection so that it can be resumed if it fails')
+	parser.add_argument('--resume', action='store_true',
+		help='Resume the migration recorded by --checkpoint-file or --checkpoint-collection, skipping what it finished')
+	parser.add_argument('--sync-file',
+		help='Record how far each table has got in this file when migrating, and later sync the changes made since')
+	parser.add_argument('--sync-collection',
+		help='Record how far each table has got in this MongoDB collection when migrating, and later sync the changes made since')
+	parser.add_argument('--watermark-column',
+		help='Column holding when each row last changed (e.g. updated_at), used by --sync-file or --sync-collection to find changed rows')
+	parser.add_argument('--output-dir',
+		help='Export the migrated documents to files in this directory instead of writing them to MongoDB')
+	parser.add_argument('--output-format', default='bson', choices=FILE_FORMATS,
+		help='Format of the files written to --output-dir: BSON for mongorestore or JSON lines for mongoimport')
+	parser.add_argument('--compress', action='store_true', help='Compress the files written to --output-dir with gzip')
+	parser.add_argument('--rotate-bytes', default=0, type=int,
+		help='Start a new file for a collection after about this many bytes written to --output-dir (0 disables)')
+	parser.add_argument('--progress', action='store_true',
+		help='Show how many documents have been written and an estimate of the time left while migrating')
+	parser.add_argument('--metrics-json',
+		help='Save the queries, rows, bytes and timings recorded while planning and migrating to this JSON file')
+	parser.add_argument('--metrics-prometheus',
+		help='Save the same metrics as --metrics-json to this file in the Prometheus text format, for node_exporter\'s textfile collector')
+	parser.add_argument('--profile-planner',
+		help='Profile the search for schema options with cProfile and save its stats to this file')
+	parser.add_argument('--row-stats', default='exact', choices=ROW_STATS,
+		help='How table rows and null foreign keys are counted: exact scans, row estimates, or estimates and samples')
+	parser.add_argument('--sample-rows', default=DEFAULT_SAMPLE_ROWS, type=int,
+		help='Number of rows sampled from each table to estimate null foreign keys with --row-stats sample')
+	parser.add_argument('--snapshot',
+		help='File the database\'s tables are saved to, and read from instead of MySQL while they are unchanged')
+	parser.add_argument('--offline', action='store_true',
+		help='Show the schema options for the tables in --snapshot without connecting to MySQL or MongoDB')
+	parser.add_argument('--plan-top', default=0, type=int,
+		help='Only search for this many of the best schema options, showing each as soon as it is known (0 finds them all)')
+	parser.add_argument('--plan-time-budget', default=0, type=float,
+		help='Seconds to spend searching for schema options before offering the ones found (0 means no limit)')
+	parser.add_argument('--plan-workers', default=1, type=int,
+		help='Number of processes used to search for every schema option (not used with --plan-top)')
 	parser.add_argument('database', help='Name of the MySQL database (MongoDB databse name will match)')
 	args = parser.parse_args()
+	if not args.offline and (args.mysql_username == None or args.mysql_password == None):
+		parser.error('--mysql-username and --mysql-password are required unless --offline is set')
+	if args.resume and args.checkpoint_file == None and args.checkpoint_collection == None:
+		parser.error('--resume needs --checkpoint-file or --checkpoint-collection')
+	if args.output_dir != None and (args.sync_file != None or args.sync_collection != None):
+		parser.error('--sync-file and --sync-collection can\'t be used with --output-dir')
 	migrate(args)
 
 if __name__ == '__main__':
@@ -1,13 +1,75 @@
 import simplejson as json
+import copy
+import gzip
+import hashlib
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+import pymysql.cursors
+import bson
+from bson import json_util
+from bson.objectid import ObjectId
+from bson.decimal128 import Decimal128
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.raw_bson import RawBSONDocument
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+from pymongo.errors import BulkWriteError
 import codec_options
+from checkpoint import dump_key, load_key, schema_signature
+from pipeline import Pipeline
+from row_decoder import read_row_decoders
+from scheduler import ConnectionPool, Task, run_tasks
+
+# default limits for a single insert_many batch
+# a batch is flushed as soon as either limit is reached
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_BATCH_BYTES = 8 * 1024 * 1024
+
+# default number of parent records whose children are fetched together with a single IN query
+# a window size of 0 maps every record's children with their own queries
+DEFAULT_WINDOW_SIZE = 500
+
+# prefix of the ancestor key columns selected by the sort-merge engine
+MERGE_KEY_PREFIX = '__merge_key_'
+
+# default limits for the cache of many to one records kept during a migration
+DEFAULT_CACHE_SIZE = 100000
+DEFAULT_CACHE_BYTES = 64 * 1024 * 1024
+# many to one tables with at most this many rows are loaded into the cache before the migration starts
+DEFAULT_PRELOAD_ROWS = 1000
+
+# previews of tables without an integer key keep each row with this many times the chance needed for the number
+# of records wanted, so that they usually get them all, and then pick that many of the rows kept
+SAMPLE_OVERSHOOT = 2
+# the number of times probes for a sample of a table with an integer key are tried again when they find the same row
+SAMPLE_ATTEMPTS = 3
+
+# when migrating with several workers, tables are split into ranges of their key of about this many rows
+DEFAULT_PARTITION_ROWS = 1000000
+
+# the MongoDB error code for a document whose _id is already in its collection
+DUPLICATE_KEY_ERROR = 11000
+
+# the format of the marks saved by Schema.sync, which is changed whenever what they hold changes
+SYNC_VERSION = 1
+
+# formats of the files written by FileSink
+# bson files are the documents one after another, as written by mongodump and read by mongorestore,
+# and jsonl files have one document per line in MongoDB extended JSON, as read by mongoimport
+FILE_FORMATS = ('bson', 'jsonl')
 
 # represents a mongodb schema
 class Schema:
     def __init__(self, graph):
         self.connection = graph.connection
+        self.connect = graph.connect
         self.collections = []
         self.refs = []
         self.graph = graph
+        self.lookup_cache = None
+        self.pipeline = None
 
     # adds a collection to the schema
     def add_collection(self, table):
@@ -22,30 +84,365 @@ class Schema:
         self.refs.append(OneToManyRef(child_name, child_key, parent_path, parent_key, fk_column))
 
     # maps data from MySQL database accordng to this schema and saves it to MongoDB
-    def map(self, mongoclient):
-        db = mongoclient[self.graph.db_name]
+    # documents are buffered per collection and written in unordered batches
+    # with a sink the documents are written there instead of to mongoclient (see Sink), and the sink is closed
+    # once they have all been written
+    # a sink that can't read its documents back to add refs in a second pass always gets inline refs
+    # with typed_rows set, rows are read as tuples and converted for BSON by decoders compiled from each table's
+    # column types (see RowDecoder) rather than by the codecs as each document is written
+    # with a pipeline_queue size, each collection is migrated by a pipeline (see Pipeline) that reads rows, assembles
+    # documents and writes them on separate threads with queues of that many windows or batches between them
+    # with a checkpoint (see Checkpoint), each finished task is recorded so that a migration that fails can be
+    # resumed, skipping what had finished, by calling map again with resume set
+    # tables are then split into ranges of about partition_rows rows even with one worker, and documents get ids
+    # derived from their primary keys so that documents already written by an unfinished task are skipped when it
+    # runs again, while collections without a key are emptied before they are migrated again
+    # with merge_join set, one to many embeds are assembled by the sort-merge engine (see Collection.map_merge),
+    # which needs the graph's connection factory to stream each table it merges
+    # with more than one worker, collections are migrated in parallel on a pool of MySQL connections
+    # and the refs for a collection are added once every collection they read from is complete
+    # large tables are also split into ranges of about partition_rows rows that are migrated in parallel
+    # with inline_refs set, references are written as records are mapped instead of in a second pass,
+    # see set_inline_refs
+    # with metrics (see Metrics), the queries and rows of each table and nesting level, the batches written, the
+    # time taken adding refs and the progress through the collections' rows are recorded in them
+    def map(self, mongoclient, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES,
+            window_size=DEFAULT_WINDOW_SIZE, merge_join=False, cache_size=DEFAULT_CACHE_SIZE,
+            cache_bytes=DEFAULT_CACHE_BYTES, preload_rows=DEFAULT_PRELOAD_ROWS, workers=1,
+            partition_rows=DEFAULT_PARTITION_ROWS, inline_refs=False, sink=None, typed_rows=False,
+            pipeline_queue=0, checkpoint=None, resume=False, metrics=None):
+        if sink == None:
+            sink = MongoSink(mongoclient[self.graph.db_name])
+        if checkpoint != None and not sink.can_resume:
+            raise ValueError('Only migrations to MongoDB can be checkpointed')
+        inline_refs = inline_refs or not sink.can_add_refs
+        sink.metrics = metrics
+        writer = BulkWriter(sink, batch_size, batch_bytes)
+        cache = None
+        if cache_size > 0:
+            cache = LookupCache(cache_size, cache_bytes)
+        self.lookup_cache = cache
+        pipeline = None
+        if pipeline_queue > 0:
+            pipeline = Pipeline(pipeline_queue)
+        self.pipeline = pipeline
+        if self.connect == None:
+            workers = 1
+            if merge_join:
+                print('Merging embeds needs a connection factory to stream the tables, so they are looked up instead')
+        pool = ConnectionPool(self.connect, workers, self.connection)
+
+        # each task returns the writer it used so its results can be added to the migration's writer
+        def on_done(task, result):
+            if isinstance(result, BulkWriter):
+                writer.join(result)
+                print('Migrated %s: %d documents' % (task, result.num_inserted))
+
+        try:
+            if checkpoint != None:
+                if resume:
+                    checkpoint.resume(self)
+                else:
+                    checkpoint.start(self)
+                sink.skip_duplicates = True
+            self.set_inline_refs(inline_refs)
+            if checkpoint != None:
+                for table in self.collections:
+                    table.derived_ids = table.key != None and table.unique_key
+            decoders = {}
+            if typed_rows:
+                decoders = read_row_decoders(self.connection, self.graph.db_name)
+            for table in self.collections:
+                table.set_row_decoders(decoders)
+                table.set_lookup_cache(cache)
+                table.set_metrics(metrics)
+                if cache != None and preload_rows > 0:
+                    table.preload(self.connection, preload_rows, max(window_size, 1))
+            if metrics != None:
+                # the rows of tables that weren't counted leave the total unknown
+                num_rows = [table.num_rows for table in self.collections]
+                metrics.start_progress(None if None in num_rows else sum(num_rows))
+            partition_rows = partition_rows if workers > 1 or checkpoint != None else 0
+            tasks_by_collection = self.collection_tasks(writer, window_size, merge_join, partition_rows, pipeline,
+                checkpoint, metrics)
+            tasks = sum(tasks_by_collection.values(), [])
+            refs = self.second_pass_refs(inline_refs)
+            if sink.can_add_refs:
+                tasks += self.ref_tasks(sink, tasks_by_collection, refs, checkpoint)
+            else:
+                for ref in refs:
+                    print('References from %s to %s aren\'t written, since the primary key of %s has more than one '
+                        'column' % (ref.parent_path[0], ref.child_name, ref.child_name))
+            run_tasks(tasks, pool, workers, on_done)
+        finally:
+            sink.close()
+            self.set_inline_refs(False)
+            for table in self.collections:
+                table.set_row_decoders({})
+                table.set_lookup_cache(None)
+                table.set_metrics(None)
+            pool.close(keep=self.connection)
+        return writer
+
+    # sets up (or clears) writing references as records are mapped
+    # referenced collections get ids derived from their primary keys (see record_id) so the id of a referenced
+    # record is known without reading it back from MongoDB, and each ref is attached to the records it adds
+    # fields to so it can add them before the records are written
+    # only the refs from inline_ref_list are written this way, the others are still added in a second pass
+    def set_inline_refs(self, enabled):
+        refs = self.inline_ref_list()
+        referenced = set(ref.child_name for ref in refs)
+        for table in self.collections:
+            table.clear_inline_refs()
+            table.derived_ids = enabled and table.table_name in referenced
+        if not enabled:
+            return
+        for ref in refs:
+            for table in self.collections:
+                if table.table_name == ref.parent_path[0]:
+                    record = table.find_path(ref.parent_path[1:])
+                    if record != None:
+                        record.inline_refs.append(ref)
+
+    # the refs that can be written as records are mapped, which are the ones to collections whose key tells their
+    # rows apart, since the ids of their documents are derived from it
+    def inline_ref_list(self):
+        referenced = set(table.table_name for table in self.collections if table.key != None and table.unique_key)
+        return [ref for ref in self.refs if ref.child_name in referenced]
+
+    # the refs added to the documents in a second pass once they are written, which with inline_refs set are only
+    # the ones that can't be written as records are mapped
+    def second_pass_refs(self, inline_refs):
+        if not inline_refs:
+            return self.refs
+        inline = self.inline_ref_list()
+        return [ref for ref in self.refs if ref not in inline]
+
+    # the tasks for migrating each collection, keyed by collection name
+    # a collection gets one task for each range of its key if partition_rows is set, otherwise a single task
+    # with a checkpoint, the ranges are the ones it recorded for the collection, and tasks it records as finished
+    # are left out
+    # collections without derived ids aren't split with a checkpoint, since one that is resumed is migrated again
+    # in full
+    # with metrics, the time each task takes is added to its collection's
+    def collection_tasks(self, writer, window_size, merge_join, partition_rows, pipeline=None, checkpoint=None,
+            metrics=None):
+        tasks = {}
         for table in self.collections:
-            table.map(self.connection, mongo_database=db)
+            key_ranges = None if checkpoint == None else checkpoint.key_ranges(table.table_name)
+            if key_ranges == None:
+                num_ranges = 1
+                if partition_rows > 0 and table.num_rows != None and (checkpoint == None or table.derived_ids):
+                    num_ranges = -(-table.num_rows // partition_rows)
+                key_ranges = table.key_ranges(self.connection, num_ranges)
+                if checkpoint != None:
+                    checkpoint.set_key_ranges(table.table_name, key_ranges)
+            for i in range(len(key_ranges)):
+                name = table.table_name
+                if len(key_ranges) > 1:
+                    name = '%s range %d of %d' % (table.table_name, i + 1, len(key_ranges))
+                if checkpoint != None and checkpoint.is_done(name):
+                    continue
+
+                def map_table(connection, table=table, key_range=key_ranges[i], name=name):
+                    # documents without a derived id can't be told apart from the ones an earlier run wrote
+                    if checkpoint != None and checkpoint.resumed and not table.derived_ids:
+                        writer.sink.discard(table.table_name)
+                    table_writer = writer.fork()
+                    start = time.perf_counter()
+                    table.map(connection, writer=table_writer, window_size=window_size, merge_join=merge_join,
+                        connect=self.connect, key_range=key_range, pipeline=pipeline)
+                    table_writer.flush()
+                    if metrics != None:
+                        metrics.add('collection_seconds', time.perf_counter() - start, collection=table.table_name)
+                    # a range with failed batches is left unfinished so a resumed migration writes it again
+                    if checkpoint != None and not table_writer.errors:
+                        checkpoint.set_done(name)
+                    return table_writer
+
+                tasks.setdefault(table.table_name, []).append(Task(name, map_table))
+        return tasks
+
+    # a task for adding the refs to each collection
+    # the refs to the same collection are added together by one task with a single scan of its documents (see
+    # add_refs), which waits for both that collection and the collections its refs reference to be migrated
+    # with a checkpoint, finished tasks are left out and the others go on from the last document they updated
+    def ref_tasks(self, sink, tasks_by_collection, refs, checkpoint=None):
+        collection_tasks = {}
+        for name, tasks in tasks_by_collection.items():
+            collection_tasks[name] = [task.name for task in tasks]
+        groups = OrderedDict()
+        for ref in refs:
+            groups.setdefault(ref.parent_path[0], []).append(ref)
+        tasks = []
+        for collection_name, refs in groups.items():
+            dependencies = set(collection_tasks.get(collection_name, []))
+            for ref in refs:
+                dependencies.update(collection_tasks.get(ref.child_name, []))
+            name = 'refs to %s' % collection_name
+            if checkpoint != None and checkpoint.is_done(name):
+                continue
+
+            def add_group(connection, refs=refs, name=name):
+                if checkpoint == None:
+                    sink.add_refs(refs)
+                    return
+
+                def on_progress(document_id):
+                    checkpoint.set_ref_position(name, document_id)
+
+                sink.add_refs(refs, checkpoint.ref_position(name), on_progress)
+                checkpoint.set_done(name)
+
+            tasks.append(Task(name, add_group, dependencies))
+        return tasks
+
+    # keeps the documents migrated with this schema in step with changes made to MySQL since
+    # finds the rows of every table in the schema that changed since the last sync, then maps the documents of each
+    # collection that embed those rows again and replaces them, deleting documents whose rows are gone
+    # documents that embed a changed row now are found by following foreign keys up from it in MySQL, and the
+    # ones that embedded it before by looking for its key along its embed path in MongoDB, so rows that moved to
+    # another parent leave the old one
+    # a row has changed if its watermark column has grown, or for tables without that column, if its key is above
+    # the highest one seen, which only finds new rows
+    # deleted rows can't be found, and only leave the documents that are mapped again for other reasons
+    # the marks reached for each table are kept by store (see FileCheckpoint and MongoCheckpoint), and a table's
+    # first sync only records its mark, so the first sync should be run before the initial migration
+    # documents whose one to many refs point at changed rows are mapped again too (see ref_parent_keys)
+    # documents are replaced by matching their key, so collections whose key doesn't tell their rows apart (see
+    # Collection.unique_key) aren't synced
+    # inline_refs should be set as it was for the migration; refs that aren't written as records are mapped (see
+    # second_pass_refs) are added to the replaced documents in a second pass
+    # returns the number of documents replaced and deleted in each collection
+    def sync(self, mongoclient, store, watermark=None, window_size=DEFAULT_WINDOW_SIZE, inline_refs=False):
+        db = mongoclient[self.graph.db_name]
+        window_size = max(window_size, 1)
+        state = store.load()
+        if state == None:
+            state = {'version': SYNC_VERSION, 'database': self.graph.db_name, 'schema': schema_signature(self),
+                'marks': {}}
+        elif state.get('version') != SYNC_VERSION or state['database'] != self.graph.db_name or \
+                state['schema'] != schema_signature(self):
+            raise ValueError('The saved sync marks are for a different schema or database')
+        # only the watermark needs the tables' columns
+        decoders = {}
+        if watermark != None:
+            decoders = read_row_decoders(self.connection, self.graph.db_name)
+        changed = {}
+        for table_name, key in self.tables():
+            column = key
+            if watermark != None and watermark in getattr(decoders.get(table_name), 'names', ()):
+                column = watermark
+            if column == None:
+                print('Changes to %s can\'t be found without a watermark column or a key' % table_name)
+                continue
+            saved = state['marks'].get(table_name)
+            started = saved != None and saved['column'] == column
+            mark = load_key(saved['mark']) if started else None
+            rows, mark = changed_rows(self.connection, table_name, column, started, mark, column == watermark)
+            state['marks'][table_name] = {'column': column, 'mark': dump_key(mark)}
+            if rows:
+                changed[table_name] = rows
+
+        results = OrderedDict()
+        try:
+            self.set_inline_refs(inline_refs)
+            # found before anything is replaced, while documents still list the ids of rows that have moved
+            ref_keys = self.ref_parent_keys(db, changed, window_size)
+            rebuilt = {}
+            for table in self.collections:
+                if table.key == None:
+                    continue
+                if not table.unique_key:
+                    print('Documents of %s can\'t be synced, since its primary key has more than one column' %
+                        table.table_name)
+                    continue
+                collection = db.get_collection(table.table_name, codec_options=codec_options.get())
+                keys = table.changed_keys(self.connection, changed, window_size)
+                keys.update(table.embedding_keys(collection, changed, window_size))
+                keys.update(ref_keys.get(table.table_name, ()))
+                if keys:
+                    results[table.table_name] = table.rebuild(self.connection, collection, list(keys), window_size)
+                    rebuilt[table.table_name] = list(keys)
+                    print('Synced %s: %d documents replaced, %d deleted' % ((table.table_name,) +
+                        results[table.table_name]))
+            self.sync_refs(db, rebuilt, self.second_pass_refs(inline_refs))
+        finally:
+            self.set_inline_refs(False)
+        store.save(state)
+        return results
+
+    # the keys of the documents in each collection whose one to many refs point at changed rows, which are mapped
+    # again by sync so their lists of ids are made again, even if nothing embedded in them changed
+    # they are the documents with a record that a changed row's foreign key points at now, and the ones that list
+    # the id of a changed row's document, which it may have moved away from
+    def ref_parent_keys(self, db, changed, window_size):
+        keys = {}
+        collections = dict((table.table_name, table) for table in self.collections)
         for ref in self.refs:
-            ref.add_ref(db)
+            rows = changed.get(ref.child_name)
+            table = collections.get(ref.parent_path[0])
+            if not isinstance(ref, OneToManyRef) or not rows or table == None or table.key == None or \
+                    not table.unique_key:
+                continue
+            collection = db.get_collection(table.table_name, codec_options=codec_options.get())
+            path = list(ref.parent_path[1:])
+            found = keys.setdefault(table.table_name, set())
+            fks = distinct_values(row.get(ref.fk_column) for row in rows)
+            found.update(find_keys(collection, '.'.join(path + [ref.parent_key]), fks, table.key, window_size))
+            ids = ref.child_ids(db, distinct_values(row.get(ref.child_key) for row in rows), window_size)
+            found.update(find_keys(collection, '.'.join(path + [ref.label()]), ids, table.key, window_size))
+        return keys
 
-    # maps a few records according to this schema and writes them to a JSON file
-    def preview(self, file, num):
-        results = {}
+    # the name and key of every table in the schema, whether a collection or embedded in one
+    def tables(self):
+        tables = OrderedDict()
         for table in self.collections:
-            results[table.table_name] = table.map(self.connection, preview=True, num=num)
-        f = open(file, 'w')
-        f.write(json.dumps(results, indent=4, default=str))
+            for record, _path in table.embedded():
+                tables.setdefault(record.table_name, record.key)
+        return list(tables.items())
+
+    # adds refs to the documents replaced by sync, given the keys of those in each collection
+    def sync_refs(self, db, rebuilt, refs):
+        groups = OrderedDict()
+        for ref in refs:
+            groups.setdefault(ref.parent_path[0], []).append(ref)
+        for table in self.collections:
+            refs = groups.get(table.table_name)
+            keys = rebuilt.get(table.table_name)
+            if refs and keys:
+                add_refs(db, refs, query={table.key: {'$in': keys}})
+
+    # maps a random sample of about num records of each collection according to this schema and writes them to a
+    # JSON file, each record as soon as it is mapped
+    def preview(self, file, num, window_size=DEFAULT_WINDOW_SIZE):
+        with open(file, 'w') as f:
+            preview = PreviewFile(f)
+            for table in self.collections:
+                preview.start_list(table.table_name)
+                table.preview(self.connection, num, preview.write, window_size)
+                preview.end_list()
+            preview.close()
 
     def __str__(self):
         return str(self.graph)
 
 # represents a collection in MongoDB
+# num_rows is the number of rows in the table if known
+# unique_key is whether key tells the table's rows apart, which the first column of a composite key doesn't
 class Collection:
-    def __init__(self, table_name, key):
+    def __init__(self, table_name, key, num_rows=None, unique_key=True):
         self.table_name = table_name
         self.key = key
+        self.num_rows = num_rows
+        self.unique_key = unique_key
         self.children = {}
+        self.inline_refs = []
+        self.derived_ids = False
+        self.decoder = None
+        self.typed_rows = False
+        self.metrics = None
+        self.level = 0
 
     # adds an embeded one to many child record to the collection
     def add_one_to_many_child(self, child_table, child_key, fk_column):
@@ -62,26 +459,773 @@ class Collection:
         return child, label
 
     # maps data for this collection from MySQL db
-    def map(self, connection, preview=False, num=None, mongo_database=None):
+    # if no writer is given the collection is written to mongo_database with its own batches
+    # records are read in windows of window_size and the children of a whole window are mapped together
+    # key_range limits the migration to one of the ranges from key_ranges
+    # with a pipeline, windows of rows are read ahead and batches are written on threads of their own while this one
+    # assembles documents, and the writer is flushed before this returns
+    # merge_join is ignored without a connection factory, since each merged table would be buffered whole on the shared
+    # connection
+    def map(self, connection, mongo_database=None, writer=None, window_size=DEFAULT_WINDOW_SIZE, merge_join=False,
+            connect=None, key_range=None, pipeline=None):
+        own_writer = writer == None
+        if own_writer:
+            writer = BulkWriter(MongoSink(mongo_database))
+        timer = None
+        if pipeline != None:
+            timer = pipeline.start()
+            writer.start_pipeline(pipeline, timer)
+        failed = True
+        try:
+            if merge_join and connect != None and self.merge_children():
+                self.map_merge(connection, connect, writer, window_size, key_range, pipeline, timer)
+            else:
+                self.map_scan(connection, connect, writer, window_size, key_range, pipeline, timer)
+            if own_writer or pipeline != None:
+                writer.flush()
+            failed = False
+        finally:
+            if pipeline != None:
+                # an error from the write stage would hide the one this thread is raising
+                writer.finish_pipeline(raise_error=not failed)
+                pipeline.stop('assemble', timer)
+
+    # maps data for this collection with a single scan of the table
+    # children are looked up for each window of records
+    # the scan streams from the server on its own connection so the table is never held in memory,
+    # while the lookups for children use the shared connection
+    # with a pipeline the scan is read ahead on another thread, see read_windows
+    def map_scan(self, connection, connect, writer, window_size, key_range=None, pipeline=None, timer=None):
+        fetch_size = window_size or DEFAULT_WINDOW_SIZE
+        cursor = open_stream_cursor(connection, connect, self.decoder != None)
+        windows = None
+        try:
+            where, params = self.range_condition('`%s`' % self.key, key_range)
+            sql = "SELECT * FROM `%s` %s;" % (self.table_name, where)
+            start = time.perf_counter()
+            cursor.execute(sql, params)
+            self.record_query(start, 0)
+            windows = self.read_windows(cursor, fetch_size, pipeline, timer)
+            for records in windows:
+                self.map_children(connection, records, window_size)
+                for result in records:
+                    self.write(writer, result)
+        finally:
+            if windows != None:
+                windows.close()
+            close_stream_cursor(cursor)
+
+    # the records of a scan, a window of fetch_size at a time
+    # with a pipeline they are read by its extract stage on another thread, which only uses the scan's cursor:
+    # a streaming cursor has its own connection, and any other cursor has read the whole result already
+    def read_windows(self, cursor, fetch_size, pipeline=None, timer=None):
+
+        def windows():
+            records = self.read_records(cursor, cursor.fetchmany(fetch_size))
+            while records:
+                self.record_rows(len(records))
+                yield records
+                records = self.read_records(cursor, cursor.fetchmany(fetch_size))
+
+        if pipeline == None:
+            return windows()
+        return pipeline.run_ahead(windows(), 'extract', timer)
+
+    # maps a random sample of about num records of this collection (see sample), calling on_record with each
+    # one once it is mapped
+    def preview(self, connection, num, on_record, window_size=DEFAULT_WINDOW_SIZE):
+        records = self.sample(connection, num)
+        fetch_size = window_size or DEFAULT_WINDOW_SIZE
+        for start in range(0, len(records), fetch_size):
+            window = records[start:start + fetch_size]
+            self.map_children(connection, window, window_size)
+            for result in window:
+                on_record(result)
+
+    # picks about num random rows of the table without sorting or reading all of it
+    # integer keys are sampled with probes for the first row at or after random keys between the smallest and
+    # largest, all sent as one query, so the cost depends on num rather than the size of the table
+    # rows after large gaps in the keys are more likely to be picked, which doesn't matter for a preview
+    # other tables are scanned keeping each row with a chance that should give more than num rows, and num of those
+    # are picked, so rows from anywhere in the table are as likely to be picked
+    # tables whose rows weren't counted are counted first
+    def sample(self, connection, num):
         with connection.cursor() as cursor:
-            limit = ''
-            if num != None:
-                limit = 'ORDER BY RAND() LIMIT %d' % num
-            sql = "SELECT * FROM `%s` %s;" % (self.table_name, limit)
-            cursor.execute(sql)
-            result = cursor.fetchone()
-            results = []
-            while result != None:
+            if self.key != None:
+                cursor.execute("SELECT MIN(`%s`) AS low, MAX(`%s`) AS high FROM `%s`;" %
+                    (self.key, self.key, self.table_name))
+                bounds = cursor.fetchone()
+                low = bounds['low']
+                high = bounds['high']
+                if low == None:
+                    return []
+                if type(low) is int and type(high) is int and high - low >= num:
+                    return self.sample_keys(cursor, num, low, high)
+            num_rows = self.num_rows
+            if num_rows == None:
+                cursor.execute("SELECT COUNT(*) AS num_rows FROM `%s`;" % self.table_name)
+                num_rows = cursor.fetchone()['num_rows']
+            fraction = min(1, SAMPLE_OVERSHOOT * num / max(num_rows, 1))
+            cursor.execute("SELECT * FROM `%s` WHERE RAND() < %g;" % (self.table_name, fraction))
+            rows = list(cursor.fetchall())
+            if len(rows) > num:
+                rows = random.sample(rows, num)
+            return rows
+
+    # samples rows with keys from low to high with a probe at each of num random keys
+    # probes that find a row already found are tried again with new keys a few times
+    def sample_keys(self, cursor, num, low, high):
+        rows = OrderedDict()
+        probe = "(SELECT * FROM `%s` WHERE `%s` >= %%s ORDER BY `%s` LIMIT 1)" % (self.table_name, self.key,
+            self.key)
+        for _attempt in range(SAMPLE_ATTEMPTS):
+            keys = [random.randint(low, high) for _i in range(num - len(rows))]
+            if not keys:
+                break
+            cursor.execute(' UNION ALL '.join([probe] * len(keys)) + ';', keys)
+            for row in cursor.fetchall():
+                rows.setdefault(row[self.key], row)
+        return list(rows.values())
+
+    # maps the children of a window of records, together unless window_size is 0
+    def map_children(self, connection, records, window_size):
+        if window_size > 0:
+            self.map_children_batch(connection, records, window_size)
+        else:
+            for result in records:
                 for label in self.children.keys():
                     result[label] = self.children[label].map(connection, result, self.key)
-                if preview:
-                    results.append(result)
-                else:
-                    mongo_database.get_collection(
-                        self.table_name, codec_options=codec_options.get()).insert_one(result)
-                result = cursor.fetchone()
-        if preview:
-            return results
+                self.add_inline_refs(connection, [result])
+
+    # maps the children of several records at once using one query per child table
+    def map_children_batch(self, connection, records, window_size):
+        for label in self.children.keys():
+            self.children[label].map_batch(connection, records, self.key, label, window_size)
+        self.add_inline_refs(connection, records)
+
+    # saves a mapped record of this collection to MongoDB
+    def write(self, writer, record):
+        if self.derived_ids:
+            record['_id'] = record_id(self.table_name, record[self.key])
+        if self.typed_rows:
+            self.convert(record)
+        writer.insert(self.table_name, record, converted=self.typed_rows)
+
+    # converts a mapped record and the records embedded in it with their tables' decoders
+    # values are only converted once the record is complete, since keys are used in queries and ids as they
+    # were read from MySQL
+    def convert(self, record):
+        self.decoder.convert(record)
+        for label, child in self.children.items():
+            value = record.get(label)
+            if type(value) is list:
+                for item in value:
+                    child.convert(item)
+            elif value != None:
+                child.convert(value)
+
+    # sets the decoders (see RowDecoder) for the table of this record and of every record embedded in it,
+    # keyed by table name
+    # records are only converted by their decoders if every table in them has one, otherwise they are left for
+    # the codecs
+    def set_row_decoders(self, decoders):
+        self.decoder = decoders.get(self.table_name)
+        complete = self.decoder != None
+        for child in self.children.values():
+            complete = child.set_row_decoders(decoders) and complete
+        self.typed_rows = complete
+        return complete
+
+    # this record and every record embedded in it, each with the path of labels to it from this one
+    def embedded(self, path=()):
+        records = [(self, list(path))]
+        for label, child in self.children.items():
+            records.extend(child.embedded(path + (label,)))
+        return records
+
+    # the keys of this table's rows whose records embed a changed row now, including the changed rows of this
+    # table, found by following foreign keys in MySQL up from the changed rows
+    # changed holds the changed rows of each table, see Schema.sync
+    def changed_keys(self, connection, changed, window_size):
+        keys = set()
+        if self.key != None:
+            keys.update(row[self.key] for row in changed.get(self.table_name, []))
+        for child in self.children.values():
+            keys.update(child.parent_keys(connection, self, changed, window_size))
+        keys.discard(None)
+        return keys
+
+    # the keys of the documents in a collection of this record's documents that embed a changed row, found by
+    # looking for its key along its embed path
+    def embedding_keys(self, collection, changed, window_size):
+        keys = set()
+        for record, path in self.embedded():
+            rows = changed.get(record.table_name)
+            if not path or not rows or record.key == None:
+                continue
+            field = '.'.join(path + [record.key])
+            values = distinct_values(row[record.key] for row in rows)
+            keys.update(find_keys(collection, field, values, self.key, window_size))
+        return keys
+
+    # maps this collection's records with the given keys again and replaces their documents, matched by key,
+    # deleting the documents of keys that no longer have a row
+    # returns the number of documents replaced and deleted
+    def rebuild(self, connection, collection, keys, window_size):
+        num_replaced = 0
+        missing = []
+        for i in range(0, len(keys), window_size):
+            chunk = keys[i:i + window_size]
+            records = self.fetch_in(connection, self.key, chunk, window_size)
+            self.map_children(connection, records, window_size)
+            requests = []
+            for record in records:
+                if self.derived_ids:
+                    record['_id'] = record_id(self.table_name, record[self.key])
+                requests.append(ReplaceOne({self.key: record[self.key]}, record, upsert=True))
+            found = set(record[self.key] for record in records)
+            deleted = [key for key in chunk if key not in found]
+            if deleted:
+                requests.append(DeleteMany({self.key: {'$in': deleted}}))
+            if requests:
+                collection.bulk_write(requests, ordered=False)
+            num_replaced += len(records)
+            missing.extend(deleted)
+        return num_replaced, len(missing)
+
+    # selects every row of this table where column matches one of the given values
+    # values are sent in IN lists of at most window_size values
+    def fetch_in(self, connection, column, values, window_size):
+        results = []
+        with self.row_cursor(connection) as cursor:
+            for i in range(0, len(values), window_size):
+                chunk = values[i:i + window_size]
+                sql = ("select * from `%s` where `%s` in (%s);" %
+                    (self.table_name, column, ', '.join(['%s'] * len(chunk))))
+                start = time.perf_counter()
+                cursor.execute(sql, chunk)
+                rows = cursor.fetchall()
+                self.record_query(start, len(rows))
+                results.extend(self.read_records(cursor, rows))
+        return results
+
+    # a cursor for reading rows of this table, which reads tuples if the table has a decoder
+    def row_cursor(self, connection):
+        if self.decoder == None:
+            return connection.cursor()
+        return connection.cursor(pymysql.cursors.Cursor)
+
+    # makes records from rows read with a cursor from row_cursor or open_stream_cursor
+    def read_records(self, cursor, rows):
+        if self.decoder == None:
+            return rows
+        return self.decoder.records(cursor, rows)
+
+    # adds the fields for the refs attached by Schema.set_inline_refs to mapped records
+    def add_inline_refs(self, connection, records):
+        records = [record for record in records if record != None]
+        for ref in self.inline_refs:
+            ref.add_inline(connection, records)
+
+    def clear_inline_refs(self):
+        self.inline_refs = []
+        for child in self.children.values():
+            child.clear_inline_refs()
+
+    # finds the record embedded at a path of labels below this one
+    def find_path(self, path):
+        record = self
+        for label in path:
+            record = record.children.get(label)
+            if record == None:
+                return None
+        return record
+
+    # sets the cache used by the many to one children embedded anywhere in this record
+    def set_lookup_cache(self, cache):
+        for child in self.children.values():
+            child.set_lookup_cache(cache)
+
+    # sets the metrics the queries for this record and every record embedded in it are recorded in
+    # level is how deep this record is embedded, so queries can be told apart by nesting level as well as table
+    def set_metrics(self, metrics, level=0):
+        self.metrics = metrics
+        self.level = level
+        for child in self.children.values():
+            child.set_metrics(metrics, level + 1)
+
+    # records a query for rows of this record's table that started at start and read num_rows rows
+    def record_query(self, start, num_rows):
+        if self.metrics != None:
+            self.metrics.query(self.table_name, self.level, time.perf_counter() - start, num_rows)
+
+    # records rows read by a query already recorded
+    def record_rows(self, num_rows):
+        if self.metrics != None:
+            self.metrics.rows(self.table_name, self.level, num_rows)
+
+    # loads the many to one children embedded in this record into their cache if their tables are small enough
+    def preload(self, connection, max_rows, window_size):
+        for child in self.children.values():
+            child.preload(connection, max_rows, window_size)
+
+    # splits the table into about num_ranges ranges of its key so they can be migrated in parallel
+    # integer keys are split evenly between their smallest and largest values,
+    # other keys at evenly spaced offsets in key order
+    # each range is a (low, high) pair including low and excluding high, where None leaves that end open
+    # returns [None] (the whole table) if the table can't be split
+    def key_ranges(self, connection, num_ranges):
+        if self.key == None or num_ranges <= 1:
+            return [None]
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT MIN(`%s`) AS low, MAX(`%s`) AS high FROM `%s`;" %
+                (self.key, self.key, self.table_name))
+            bounds = cursor.fetchone()
+            low = bounds['low']
+            high = bounds['high']
+            if low == None:
+                return [None]
+            splits = []
+            if type(low) is int and type(high) is int:
+                step = (high - low + 1) / num_ranges
+                splits = [low + int(step * i) for i in range(1, num_ranges)]
+            elif self.num_rows:
+                for i in range(1, num_ranges):
+                    cursor.execute("SELECT `%s` AS split FROM `%s` ORDER BY `%s` LIMIT 1 OFFSET %d;" %
+                        (self.key, self.table_name, self.key, self.num_rows * i // num_ranges))
+                    row = cursor.fetchone()
+                    if row != None:
+                        splits.append(row['split'])
+        # splits are in key order already, only repeats need removing
+        splits = [splits[i] for i in range(len(splits)) if i == 0 or splits[i] != splits[i - 1]]
+        if not splits:
+            return [None]
+        return list(zip([None] + splits, splits + [None]))
+
+    # the WHERE clause and parameters limiting column to a range from key_ranges
+    def range_condition(self, column, key_range):
+        if key_range == None:
+            return '', None
+        low, high = key_range
+        conditions = []
+        params = []
+        if low != None:
+            conditions.append(column + ' >= %s')
+            params.append(low)
+        if high != None:
+            conditions.append(column + ' < %s')
+            params.append(high)
+        return 'WHERE ' + ' AND '.join(conditions), tuple(params)
+
+    # the one to many children that can be assembled by the sort-merge engine
+    # records need a key to order by so that children can be matched to them
+    def merge_children(self):
+        if self.key == None:
+            return []
+        return [child for child in self.children.values() if isinstance(child, OneToManyChild)]
+
+    # maps data for this collection with the sort-merge engine
+    # the table is scanned ordered by its key, and every one to many child reachable through other one to many
+    # children is scanned once ordered by the keys of its ancestors, so all scans can be walked in lockstep
+    # many to one children and anything embedded below them are still looked up per window with IN queries
+    # memory is bounded by the subtrees of one window of records rather than by the size of any table
+    # with a pipeline only the scan of the collection's table is read ahead, the child scans are read as they are
+    # merged
+    def map_merge(self, connection, connect, writer, window_size, key_range=None, pipeline=None, timer=None):
+        window_size = max(window_size, 1)
+        streams = {}
+        windows = None
+        try:
+            self.open_merge_streams([self], connection, connect, streams, key_range)
+            cursor = open_stream_cursor(connection, connect, self.decoder != None)
+            streams[self] = MergeStream(cursor, 0, window_size)
+            where, params = self.range_condition('`%s`' % self.key, key_range)
+            start = time.perf_counter()
+            cursor.execute("SELECT * FROM `%s` %s ORDER BY `%s`;" % (self.table_name, where, self.key), params)
+            self.record_query(start, 0)
+            windows = self.read_windows(cursor, window_size, pipeline, timer)
+            for records in windows:
+                paths = [(record[self.key],) for record in records]
+                self.merge_window(connection, records, paths, streams, window_size)
+                for result in records:
+                    self.write(writer, result)
+        finally:
+            if windows != None:
+                windows.close()
+            for stream in streams.values():
+                stream.close()
+
+    # starts the ordered scan of each child table that will be merged into this record
+    # chain is the list of records from the collection down to this one
+    def open_merge_streams(self, chain, connection, connect, streams, key_range=None):
+        for child in self.merge_children():
+            cursor = open_stream_cursor(connection, connect)
+            streams[child] = MergeStream(cursor, len(chain), DEFAULT_WINDOW_SIZE)
+            where, params = chain[0].range_condition('t0.`%s`' % chain[0].key, key_range)
+            start = time.perf_counter()
+            cursor.execute(child.merge_sql(chain, where), params)
+            child.record_query(start, 0)
+            child.open_merge_streams(chain + [child], connection, connect, streams, key_range)
+
+    # attaches children to a window of records taken from an ordered scan
+    # paths holds the keys of each record and its ancestors, which is what the child scans are ordered by
+    def merge_window(self, connection, records, paths, streams, window_size):
+        for label in self.children.keys():
+            child = self.children[label]
+            stream = streams.get(child)
+            if stream == None:
+                child.map_batch(connection, records, self.key, label, window_size)
+                continue
+            child_records = []
+            child_paths = []
+            for record, path in zip(records, paths):
+                results = stream.take(path)
+                for result in results:
+                    child_paths.append(path + (result.get(child.key),))
+                    result.pop(child.fk_column)
+                child_records.extend(results)
+                record[label] = results
+            child.record_rows(len(child_records))
+            child.merge_window(connection, child_records, child_paths, streams, window_size)
+        # children are attached in a different order than the other engines use, so restore the key order
+        for record in records:
+            for label in self.children.keys():
+                record[label] = record.pop(label)
+        self.add_inline_refs(connection, records)
+
+# opens a cursor for a long running ordered scan
+# with a connection factory each scan streams rows from the server on its own connection,
+# otherwise the whole result is buffered on the shared connection
+# with tuples set rows are read as tuples rather than dictionaries
+def open_stream_cursor(connection, connect, tuples=False):
+    if connect == None:
+        if tuples:
+            return connection.cursor(pymysql.cursors.Cursor)
+        return connection.cursor()
+    if tuples:
+        return connect().cursor(pymysql.cursors.SSCursor)
+    return connect().cursor(pymysql.cursors.SSDictCursor)
+
+# closes a cursor from open_stream_cursor along with its connection if it has its own
+def close_stream_cursor(cursor):
+    connection = cursor.connection
+    cursor.close()
+    if isinstance(cursor, pymysql.cursors.SSCursor):
+        connection.close()
+
+# rows of an ordered scan, read ahead one window at a time
+# each row carries the keys of its ancestors in MERGE_KEY_PREFIX columns
+class MergeStream:
+    def __init__(self, cursor, depth, fetch_size):
+        self.cursor = cursor
+        self.depth = depth
+        self.fetch_size = fetch_size
+        self.rows = []
+        self.position = 0
+
+    # the ancestor keys of the next row, or None once the scan is finished
+    def next_path(self):
+        if self.position == len(self.rows):
+            self.rows = self.cursor.fetchmany(self.fetch_size)
+            self.position = 0
+            if not self.rows:
+                return None
+        row = self.rows[self.position]
+        return tuple(row[MERGE_KEY_PREFIX + str(i)] for i in range(self.depth))
+
+    # removes and returns the rows whose ancestor keys match path
+    def take(self, path):
+        results = []
+        while self.next_path() == path:
+            row = self.rows[self.position]
+            self.position += 1
+            for i in range(self.depth):
+                row.pop(MERGE_KEY_PREFIX + str(i))
+            results.append(row)
+        return results
+
+    def close(self):
+        close_stream_cursor(self.cursor)
+
+# writes a preview file as the records in it are mapped
+# the file is laid out the way json.dumps with an indent of 4 would lay out a dict of lists of records
+class PreviewFile:
+    def __init__(self, f):
+        self.f = f
+        self.num_lists = 0
+        self.num_records = 0
+
+    def start_list(self, name):
+        self.f.write(('{' if self.num_lists == 0 else ',') + '\n    %s: [' % json.dumps(name))
+        self.num_lists += 1
+        self.num_records = 0
+
+    def write(self, record):
+        text = json.dumps(record, indent=4, default=str).replace('\n', '\n        ')
+        self.f.write((',' if self.num_records else '') + '\n        ' + text)
+        self.num_records += 1
+
+    def end_list(self):
+        self.f.write('\n    ]' if self.num_records else ']')
+
+    def close(self):
+        self.f.write('\n}' if self.num_lists else '{}')
+
+# buffers documents for each collection and writes them to a sink in batches
+# documents are encoded to BSON once when buffered so batches can be limited by size in bytes as well as count
+# writers are given a sink, or a MongoDB database to write to with unordered insert_many calls
+class BulkWriter:
+    def __init__(self, sink, batch_size=DEFAULT_BATCH_SIZE, batch_bytes=DEFAULT_BATCH_BYTES):
+        if not isinstance(sink, Sink):
+            sink = MongoSink(sink)
+        self.sink = sink
+        self.batch_size = max(batch_size, 1)
+        self.batch_bytes = max(batch_bytes, 1)
+        self.buffers = {}
+        self.buffer_bytes = {}
+        self.num_batches = 0
+        self.num_inserted = 0
+        self.errors = []
+        self.consumer = None
+
+    # creates an empty writer with the same sink and limits, for use by another thread
+    def fork(self):
+        return BulkWriter(self.sink, self.batch_size, self.batch_bytes)
+
+    # adds the counts and errors of a forked writer once it has been flushed
+    def join(self, other):
+        self.num_batches += other.num_batches
+        self.num_inserted += other.num_inserted
+        self.errors.extend(other.errors)
+
+    # adds a document to the buffer for a collection, flushing the buffer first if it is full
+    # documents already converted by RowDecoders are encoded without the codecs
+    def insert(self, collection_name, document, converted=False):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        options = DEFAULT_CODEC_OPTIONS if converted else codec_options.get()
+        raw = RawBSONDocument(bson.encode(document, codec_options=options))
+        size = len(raw.raw)
+        buffer = self.buffers.setdefault(collection_name, [])
+        if buffer and self.buffer_bytes[collection_name] + size > self.batch_bytes:
+            self.flush(collection_name)
+            buffer = self.buffers[collection_name]
+        buffer.append(raw)
+        self.buffer_bytes[collection_name] = self.buffer_bytes.get(collection_name, 0) + size
+        if len(buffer) >= self.batch_size or self.buffer_bytes[collection_name] >= self.batch_bytes:
+            self.flush(collection_name)
+
+    # writes out the buffered documents for one collection or for all collections
+    def flush(self, collection_name=None):
+        names = [collection_name] if collection_name != None else list(self.buffers.keys())
+        for name in names:
+            documents = self.buffers.get(name)
+            self.buffers[name] = []
+            self.buffer_bytes[name] = 0
+            if documents:
+                self._write_batch(name, documents)
+
+    # writes batches on the write stage of a pipeline from now on, while this thread goes on buffering documents
+    # the time this thread waits for room in the pipeline's queue is added to timer
+    def start_pipeline(self, pipeline, timer):
+        self.consumer = pipeline.consume(self._write_queued, 'write', timer)
+
+    # waits for the batches queued for the pipeline to be written, then writes on this thread again
+    # the counts and errors aren't complete until this has returned
+    # an error from the write stage is raised here unless raise_error is unset, see Consumer.close
+    def finish_pipeline(self, raise_error=True):
+        consumer = self.consumer
+        self.consumer = None
+        consumer.close(raise_error)
+
+    # writes a single batch, recording any write errors instead of stopping the migration
+    def _write_batch(self, collection_name, documents):
+        self.num_batches += 1
+        if self.consumer != None:
+            self.consumer.put((collection_name, documents, self.num_batches))
+        else:
+            self._write_queued((collection_name, documents, self.num_batches))
+
+    def _write_queued(self, batch):
+        collection_name, documents, batch_number = batch
+        start = time.perf_counter()
+        num_inserted, error = self.sink.write_batch(collection_name, documents, batch_number)
+        if self.sink.metrics != None:
+            self.sink.metrics.batch(collection_name, num_inserted, sum(len(document.raw) for document in documents),
+                time.perf_counter() - start, error != None)
+        self.num_inserted += num_inserted
+        if error != None:
+            self.errors.append(error)
+            print(error)
+
+# where a migration's documents are written
+# one sink is shared by every writer forked for a migration, so it may be used by several worker threads at once
+class Sink:
+    # whether add_refs can read back the documents written so far to add references to them
+    can_add_refs = False
+    # whether a migration can be resumed, which needs discard, and writes that skip documents already written
+    # when skip_duplicates is set
+    can_resume = False
+    skip_duplicates = False
+    # the metrics batches are recorded in, see BulkWriter, and that add_refs records in
+    metrics = None
+
+    # writes a batch of documents encoded as RawBSONDocuments to a collection
+    # returns the number of documents written and a BatchError if some of them failed, or None
+    def write_batch(self, collection_name, documents, batch_number):
+        raise NotImplementedError
+
+    # adds references to documents already written, see add_refs
+    def add_refs(self, refs, after=None, on_progress=None):
+        raise NotImplementedError
+
+    # removes every document written to a collection
+    def discard(self, collection_name):
+        raise NotImplementedError
+
+    # finishes writing once every document has been written
+    def close(self):
+        pass
+
+# writes documents to a MongoDB database with unordered insert_many calls
+class MongoSink(Sink):
+    can_add_refs = True
+    can_resume = True
+
+    def __init__(self, db):
+        self.db = db
+        self.collections = {}
+
+    def write_batch(self, collection_name, documents, batch_number):
+        collection = self.collections.get(collection_name)
+        if collection == None:
+            collection = self.collections[collection_name] = self.db.get_collection(collection_name)
+        try:
+            collection.insert_many(documents, ordered=False)
+            return len(documents), None
+        except BulkWriteError as e:
+            write_errors = e.details.get('writeErrors', [])
+            num_inserted = e.details.get('nInserted', 0)
+            if self.skip_duplicates:
+                # documents an earlier run of a resumed migration wrote already
+                duplicates = [error for error in write_errors if error.get('code') == DUPLICATE_KEY_ERROR]
+                num_inserted += len(duplicates)
+                write_errors = [error for error in write_errors if error.get('code') != DUPLICATE_KEY_ERROR]
+            if not write_errors:
+                return num_inserted, None
+            return num_inserted, BatchError(collection_name, batch_number, len(documents), write_errors)
+
+    def add_refs(self, refs, after=None, on_progress=None):
+        add_refs(self.db, refs, after, on_progress, metrics=self.metrics)
+
+    def discard(self, collection_name):
+        self.db.get_collection(collection_name).delete_many({})
+
+# writes each collection's documents to files in a directory without a MongoDB server, see FILE_FORMATS
+# files are named after their collection, like customers.bson, with .gz added if they are gzip compressed
+# with max_file_bytes set a collection's documents are split between files of about that many bytes before
+# compression, numbered from the second one on like customers.1.bson, each of which can be loaded into the
+# collection on its own with mongorestore --collection or mongoimport --collection
+# references can't be added to documents once they are written, so they are always written inline
+class FileSink(Sink):
+    def __init__(self, directory, file_format='bson', compress=False, max_file_bytes=0):
+        if file_format not in FILE_FORMATS:
+            raise ValueError('Unknown file format %s' % file_format)
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.file_format = file_format
+        self.compress = compress
+        self.max_file_bytes = max_file_bytes
+        self.lock = threading.Lock()
+        # collection name -> [open file, file number, bytes written to it]
+        self.files = {}
+        self.paths = []
+        self.num_bytes = 0
+
+    # the path of a collection's file with the given number
+    def path(self, collection_name, number):
+        name = collection_name if number == 0 else '%s.%d' % (collection_name, number)
+        name += '.' + self.file_format
+        if self.compress:
+            name += '.gz'
+        return os.path.join(self.directory, name)
+
+    # the bytes written to a file for a batch
+    # bson files take the documents as they were encoded, and jsonl files decode them again to write them as JSON
+    # they are decoded to plain BSON types, like Decimal128 rather than Decimal, which extended JSON can represent
+    def encode(self, documents):
+        if self.file_format == 'bson':
+            return b''.join(document.raw for document in documents)
+        lines = []
+        for document in documents:
+            decoded = bson.decode(document.raw)
+            lines.append(json_util.dumps(decoded, json_options=json_util.RELAXED_JSON_OPTIONS) + '\n')
+        return ''.join(lines).encode('utf-8')
+
+    def write_batch(self, collection_name, documents, batch_number):
+        data = self.encode(documents)
+        with self.lock:
+            entry = self.files.get(collection_name)
+            if entry == None:
+                entry = self.open(collection_name, 0)
+            elif self.max_file_bytes > 0 and entry[2] + len(data) > self.max_file_bytes:
+                entry[0].close()
+                entry = self.open(collection_name, entry[1] + 1)
+            entry[0].write(data)
+            entry[2] += len(data)
+            self.num_bytes += len(data)
+        return len(documents), None
+
+    # starts a collection's file with the given number, replacing any file left by an earlier export
+    # the first file also removes the rest of the collection's files, which an earlier export may have left more of
+    def open(self, collection_name, number):
+        if number == 0:
+            self.remove_files(collection_name)
+        path = self.path(collection_name, number)
+        if self.compress:
+            file = gzip.open(path, 'wb')
+        else:
+            file = open(path, 'wb')
+        entry = self.files[collection_name] = [file, number, 0]
+        self.paths.append(path)
+        return entry
+
+    # removes a collection's files in this sink's format from the directory, compressed or not
+    def remove_files(self, collection_name):
+        for name in os.listdir(self.directory):
+            stem = name[:-len('.gz')] if name.endswith('.gz') else name
+            if not stem.endswith('.' + self.file_format):
+                continue
+            stem = stem[:-len('.' + self.file_format)]
+            number = stem[len(collection_name) + 1:]
+            if stem == collection_name or stem.startswith(collection_name + '.') and number.isdigit():
+                os.remove(os.path.join(self.directory, name))
+
+    def close(self):
+        with self.lock:
+            for entry in self.files.values():
+                entry[0].close()
+            self.files = {}
+
+    def __str__(self):
+        return 'Wrote %d files with %d bytes of documents to %s' % (len(self.paths), self.num_bytes, self.directory)
+
+    __repr__ = __str__
+
+# the write errors from a single failed insert_many batch
+class BatchError:
+    def __init__(self, collection_name, batch_number, batch_size, write_errors):
+        self.collection_name = collection_name
+        self.batch_number = batch_number
+        self.batch_size = batch_size
+        self.write_errors = write_errors
+
+    def __str__(self):
+        messages = set(error.get('errmsg', '') for error in self.write_errors)
+        return "Batch %d for %s: %d of %d documents failed (%s)" % (self.batch_number, self.collection_name,
+            len(self.write_errors), self.batch_size, '; '.join(sorted(messages)))
+
+    __repr__ = __str__
 
 # represents an embeded child record
 class Child(Collection):
@@ -89,6 +1233,10 @@ class Child(Collection):
         super().__init__(table_name, key)
         self.fk_column = fk_column
 
+# returns the distinct values that aren't null in the order they first appear
+def distinct_values(values):
+    return list(dict.fromkeys(value for value in values if value != None))
+
 # represents a one to many embeded child record
 class OneToManyChild(Child):
 
@@ -97,28 +1245,204 @@ class OneToManyChild(Child):
         parent_id = parent_record[parent_key]
         with connection.cursor() as cursor:
             sql = "select * from `" + self.table_name + "` where `" + self.fk_column + "`=%s;"
+            start = time.perf_counter()
             cursor.execute(sql, (parent_id,))
             results = cursor.fetchall()
+            self.record_query(start, len(results))
             for result in results:
                 result.pop(self.fk_column)
                 for col in self.children.keys():
                     result[col] = self.children[col].map(connection, result, self.key)
+            self.add_inline_refs(connection, results)
             return results
 
+    # maps data for this child record for a group of parent records
+    # children are fetched with a single IN query and grouped by foreign key
+    def map_batch(self, connection, parent_records, parent_key, label, window_size):
+        parent_ids = distinct_values(record[parent_key] for record in parent_records)
+        results = self.fetch_in(connection, self.fk_column, parent_ids, window_size)
+        groups = {}
+        for result in results:
+            groups.setdefault(result.pop(self.fk_column), []).append(result)
+        self.map_children_batch(connection, results, window_size)
+        for record in parent_records:
+            record[label] = groups.get(record[parent_key], [])
+
+    # the keys of the parent records that embed changed rows of this child or of records embedded in it
+    # the foreign keys of changed rows are known already, the others are read from the rows they embed below
+    def parent_keys(self, connection, parent, changed, window_size):
+        rows = changed.get(self.table_name, [])
+        keys = set(row[self.fk_column] for row in rows)
+        if self.key != None:
+            own = set(row[self.key] for row in rows)
+            below = [key for key in self.changed_keys(connection, changed, window_size) if key not in own]
+            keys.update(row[self.fk_column] for row in self.fetch_in(connection, self.key, below, window_size))
+        return keys
+
+    # builds the ordered scan used by the sort-merge engine
+    # the table is joined up through its ancestors in chain so each row can select the keys of its ancestors,
+    # and rows are ordered by those keys and then by its own key
+    # joining also drops rows whose parent doesn't exist, which could never be matched
+    # where limits the rows by a condition on the collection's table, t0
+    def merge_sql(self, chain, where=''):
+        depth = len(chain)
+        nodes = chain + [self]
+        columns = ['t%d.*' % depth]
+        for i in range(depth):
+            columns.append('t%d.`%s` AS `%s%d`' % (i, nodes[i].key, MERGE_KEY_PREFIX, i))
+        joins = []
+        for i in range(depth, 0, -1):
+            joins.append('JOIN `%s` t%d ON t%d.`%s` = t%d.`%s`' %
+                (nodes[i - 1].table_name, i - 1, i, nodes[i].fk_column, i - 1, nodes[i - 1].key))
+        order = ['`%s%d`' % (MERGE_KEY_PREFIX, i) for i in range(depth)]
+        if self.key != None:
+            order.append('t%d.`%s`' % (depth, self.key))
+        return "SELECT %s FROM `%s` t%d %s %s ORDER BY %s;" % (', '.join(columns), self.table_name, depth,
+            ' '.join(joins), where, ', '.join(order))
+
 # represents a many to one embeded child record
 class ManyToOneChild(Child):
+    def __init__(self, table_name, key, fk_column):
+        super().__init__(table_name, key, fk_column)
+        self.cache = None
 
     # maps data for this child record from MySQL db
     def map(self, connection, parent_record, parent_key):
         child_id = parent_record.pop(self.fk_column)
+        if self.cache != None and child_id != None:
+            found, result = self.cache.get(self, child_id)
+            if found:
+                return result
         with connection.cursor() as cursor:
             sql = ("select * from `%s` where `%s`=" % (self.table_name, self.key)) + "%s;"
+            start = time.perf_counter()
             cursor.execute(sql, (child_id,))
             result = cursor.fetchone()
+            self.record_query(start, 0 if result == None else 1)
             for label in self.children.keys():
                 result[label] = self.children[label].map(connection, result, self.key)
+            self.add_inline_refs(connection, [result])
+            if self.cache != None and child_id != None:
+                self.cache.put(self, child_id, result)
             return result
 
+    # maps data for this child record for a group of parent records
+    # each distinct referenced row is fetched and mapped once and shared by all records that reference it
+    def map_batch(self, connection, parent_records, parent_key, label, window_size):
+        child_ids = [record.pop(self.fk_column) for record in parent_records]
+        by_key = {}
+        missing = []
+        for child_id in distinct_values(child_ids):
+            found, result = (False, None) if self.cache == None else self.cache.get(self, child_id)
+            if found:
+                by_key[child_id] = result
+            else:
+                missing.append(child_id)
+        results = self.fetch_in(connection, self.key, missing, window_size)
+        self.map_children_batch(connection, results, window_size)
+        for result in results:
+            by_key[result[self.key]] = result
+        if self.cache != None:
+            for child_id in missing:
+                self.cache.put(self, child_id, by_key.get(child_id))
+        for record, child_id in zip(parent_records, child_ids):
+            record[label] = by_key.get(child_id)
+
+    def set_lookup_cache(self, cache):
+        self.cache = cache
+        super().set_lookup_cache(cache)
+
+    # the keys of the parent records that embed changed rows of this child or of records embedded in it
+    # they are the parents whose foreign key points at one of those rows
+    def parent_keys(self, connection, parent, changed, window_size):
+        keys = list(self.changed_keys(connection, changed, window_size))
+        if parent.key == None or not keys:
+            return set()
+        return set(row[parent.key] for row in parent.fetch_in(connection, self.fk_column, keys, window_size))
+
+    # loads every row of this child's table into the cache if the table has no more than max_rows rows
+    # a fully loaded table doesn't need to be queried for keys that aren't in the cache
+    def preload(self, connection, max_rows, window_size):
+        super().preload(connection, max_rows, window_size)
+        if self.key == None:
+            return
+        with connection.cursor() as cursor:
+            start = time.perf_counter()
+            cursor.execute("SELECT * FROM `%s` LIMIT %d;" % (self.table_name, max_rows + 1))
+            results = cursor.fetchall()
+            self.record_query(start, len(results))
+        if len(results) > max_rows:
+            return
+        self.map_children_batch(connection, results, window_size)
+        keys = [result[self.key] for result in results]
+        for key, result in zip(keys, results):
+            self.cache.put(self, key, result)
+        self.cache.mark_complete(self, keys)
+
+# a size and byte bounded LRU cache of mapped many to one records
+# one cache is shared by all many to one children during a migration, with entries keyed by child and key value
+# records are copied going in and coming out, since mapping pops and adds keys on the records it is given
+# the cache may be used by several worker threads at once
+class LookupCache:
+    def __init__(self, max_entries=DEFAULT_CACHE_SIZE, max_bytes=DEFAULT_CACHE_BYTES):
+        self.lock = threading.Lock()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.complete = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # returns whether the record was found and a copy of it
+    # a record may be found and be None if it doesn't exist in MySQL
+    def get(self, child, key):
+        with self.lock:
+            entry = self.entries.get((child, key))
+            if entry == None:
+                if child in self.complete:
+                    self.hits += 1
+                    return True, None
+                self.misses += 1
+                return False, None
+            self.entries.move_to_end((child, key))
+            self.hits += 1
+        return True, copy.deepcopy(entry[0])
+
+    # adds a record, evicting the least recently used records if the cache is over its limits
+    def put(self, child, key, record):
+        size = 0
+        if record != None:
+            size = len(bson.encode(record, codec_options=codec_options.get()))
+        record = copy.deepcopy(record)
+        with self.lock:
+            old = self.entries.pop((child, key), None)
+            if old != None:
+                self.num_bytes -= old[1]
+            if size > self.max_bytes:
+                self.complete.discard(child)
+                return
+            self.entries[(child, key)] = (record, size)
+            self.num_bytes += size
+            while len(self.entries) > self.max_entries or self.num_bytes > self.max_bytes:
+                (evicted_child, _key), (_record, evicted_size) = self.entries.popitem(last=False)
+                self.num_bytes -= evicted_size
+                self.evictions += 1
+                self.complete.discard(evicted_child)
+
+    # records that every row of a child's table is in the cache if all of the given keys are still cached
+    # stops applying as soon as one of its records is evicted
+    def mark_complete(self, child, keys):
+        with self.lock:
+            if all((child, key) in self.entries for key in keys):
+                self.complete.add(child)
+
+    def __str__(self):
+        return "Lookup cache: %d hits, %d misses, %d evictions" % (self.hits, self.misses, self.evictions)
+
+    __repr__ = __str__
+
 # represents a reference in MongoDB
 class Ref():
     def __init__(self, child_name, child_key, parent_path, parent_key, fk_column):
@@ -128,64 +1452,229 @@ class Ref():
         self.parent_key = parent_key
         self.fk_column = fk_column
 
-    # adds appropriate reference to all applicable records
-    def do_update(self, db):
-        collection = db[self.parent_path[0]]
-        for record in collection.find():
-            self.find_parents(record, self.parent_path[1:], db)
-            collection.replace_one({'_id': record['_id']}, record)
+    # adds the reference to records in MongoDB
+    def add_ref(self, db, metrics=None):
+        add_refs(db, [self], metrics=metrics)
+
+    # the field read from the collection to find and update the records that get this reference
+    def projection_field(self):
+        return '.'.join(self.parent_path[1:] + [self.lookup_field()])
 
     # finds the records (may be nested) that should have a reference added
-    def find_parents(self, record, path, db):
+    # the new reference fields are added to updates, keyed by their dotted path from the top level record
+    def find_parents(self, record, path, db, prefix, updates):
         if len(path) == 0:
             if type(record) is list:
-                for rec in record:
-                    self.update_value(rec, db)
+                for i in range(len(record)):
+                    self.update_record(record[i], db, '%s%d.' % (prefix, i), updates)
             else:
-                self.update_value(record, db)
+                self.update_record(record, db, prefix, updates)
         else:
             new_recs = record.get(path[0], [])
             new_path = path[1:]
+            new_prefix = prefix + path[0] + '.'
             if type(new_recs) is list:
-                for new_rec in new_recs:
-                    self.find_parents(new_rec, new_path, db)
-            else:
-                self.find_parents(new_recs, new_path, db)
+                for i in range(len(new_recs)):
+                    self.find_parents(new_recs[i], new_path, db, '%s%d.' % (new_prefix, i), updates)
+            elif new_recs != None:
+                self.find_parents(new_recs, new_path, db, new_prefix, updates)
+
+    # adds the reference to a record and records the new field in updates
+    def update_record(self, record, db, prefix, updates):
+        if record == None:
+            return
+        label = self.update_value(record, db)
+        if label != None:
+            updates[prefix + label] = record[label]
+
+# adds a group of refs that all add fields to records in the same collection
+# each ref first maps the keys of the records it references to their ids, then the collection is read once,
+# projected to the fields the refs need, and each document that changed gets a single $set of the new fields
+# with the position of each nested record in its array
+# with on_progress set, documents are read in order of their ids, starting after the id after if it is set, and
+# on_progress is called with the id of the last one read each time the updates so far have been written
+# query limits the documents the refs are added to
+# with metrics, the time taken to prepare each ref and write each batch, and the documents read and updated, are
+# recorded in them
+# returns the number of documents updated
+def add_refs(db, refs, after=None, on_progress=None, query=None, metrics=None):
+    collection_name = refs[0].parent_path[0]
+    for ref in refs:
+        start = time.perf_counter()
+        ref.prepare(db)
+        if metrics != None:
+            metrics.observe('ref_prepare_seconds', time.perf_counter() - start, collection=collection_name,
+                ref=ref.child_name)
+    collection = db[collection_name]
+    # a field inside another projected field is already included, and projecting both is an error
+    fields = set(ref.projection_field() for ref in refs)
+    projection = {}
+    for field in fields:
+        if not any(field.startswith(other + '.') for other in fields):
+            projection[field] = True
+    requests = []
+    num_updated = 0
+    query = dict(query or {})
+    if after != None:
+        query['_id'] = {'$gt': after}
+    records = collection.find(query, projection)
+    if on_progress != None:
+        records = records.sort('_id')
+    num_read = 0
+    for record in records:
+        num_read += 1
+        updates = {}
+        for ref in refs:
+            ref.find_parents(record, ref.parent_path[1:], db, '', updates)
+        if updates:
+            requests.append(UpdateOne({'_id': record['_id']}, {'$set': updates}))
+            num_updated += 1
+        if len(requests) >= DEFAULT_BATCH_SIZE:
+            write_updates(collection, collection_name, requests, metrics)
+            requests = []
+            if on_progress != None:
+                on_progress(record['_id'])
+    if requests:
+        write_updates(collection, collection_name, requests, metrics)
+    if metrics != None:
+        metrics.add('ref_documents_read', num_read, collection=collection_name)
+        metrics.add('ref_documents_updated', num_updated, collection=collection_name)
+    return num_updated
+
+# writes a batch of ref updates, recording how long it took in metrics if they are given
+def write_updates(collection, collection_name, requests, metrics):
+    start = time.perf_counter()
+    collection.bulk_write(requests, ordered=False)
+    if metrics != None:
+        metrics.observe('ref_write_seconds', time.perf_counter() - start, collection=collection_name)
+
+# the id of the document for the row of table with primary key value key
+# derived from a hash of the two so references to it can be written without looking it up
+def record_id(table_name, key):
+    digest = hashlib.sha1(('%s\0%r' % (table_name, key)).encode('utf-8')).digest()
+    return ObjectId(digest[:12])
+
+# the rows of a table whose column is above mark, and the highest value of the column to use as the next mark
+# with inclusive set rows at the mark are included too, since rows may change again within the same watermark
+# a table's first sync (started not set) returns no rows and only finds its mark
+def changed_rows(connection, table_name, column, started, mark, inclusive):
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT MAX(`%s`) AS mark FROM `%s`;" % (column, table_name))
+        new_mark = cursor.fetchone()['mark']
+        if not started or new_mark == None:
+            return [], new_mark if new_mark != None else mark
+        sql = "SELECT * FROM `%s` WHERE `%s` <= %%s" % (table_name, column)
+        params = [new_mark]
+        if mark != None:
+            sql += " AND `%s` %s %%s" % (column, '>=' if inclusive else '>')
+            params.append(mark)
+        cursor.execute(sql + ';', params)
+        return list(cursor.fetchall()), new_mark
+
+# the keys of the documents in a collection where field matches one of the given values
+# values are sent in $in lists of at most window_size values
+def find_keys(collection, field, values, key, window_size):
+    keys = set()
+    for i in range(0, len(values), window_size):
+        for document in collection.find({field: {'$in': values[i:i + window_size]}}, {key: True}):
+            keys.add(hashable(document.get(key)))
+    keys.discard(None)
+    return keys
+
+# converts a value read from MongoDB into one that can be used as a dictionary key
+def hashable(value):
+    if isinstance(value, Decimal128):
+        return value.to_decimal()
+    return value
 
 # represents a one to many reference in MongoDB
 class OneToManyRef(Ref):
 
-    # adds the reference to records in MongoDB
-    def add_ref(self, db):
-        # first map referenced record ids to the key values of the records that should reference them
+    # maps referenced record ids to the key values of the records that should reference them
+    # the ids are grouped by the server so only the foreign keys and ids are sent back
+    def prepare(self, db):
         self.children = {}
-        for child in db[self.child_name].find():
-            fk = child[self.fk_column]
+        pipeline = [{'$group': {'_id': '$' + self.fk_column, 'ids': {'$push': '$_id'}}}]
+        for group in db[self.child_name].aggregate(pipeline, allowDiskUse=True):
+            fk = group['_id']
             if fk:
-                self.children[fk] = self.children.get(fk, [])
-                self.children[fk].append(child['_id'])
+                self.children[hashable(fk)] = group['ids']
+
+    # the field of the referencing records that is needed to add the reference
+    def lookup_field(self):
+        return self.parent_key
 
-        self.do_update(db)
+    # the field the reference adds, holding the ids of the referenced records
+    def label(self):
+        return "%s_%s_ref" % (self.fk_column, self.child_name)
 
-    # adds reference to a single (oftentimes nested) record
+    # the ids of the referenced documents of rows with the given keys, read from the referenced collection
+    def child_ids(self, db, keys, window_size):
+        collection = db.get_collection(self.child_name, codec_options=codec_options.get())
+        ids = []
+        for i in range(0, len(keys), window_size):
+            for child in collection.find({self.child_key: {'$in': keys[i:i + window_size]}}, {'_id': True}):
+                ids.append(child['_id'])
+        return ids
+
+    # adds the reference to records as they are mapped from MySQL, with ids from record_id
+    # the keys of the referenced rows are fetched with one IN query per window of records, in key order
+    # which is the order the second pass would find them in
+    def add_inline(self, connection, records):
+        label = self.label()
+        keys = distinct_values(record.get(self.parent_key) for record in records)
+        children = {}
+        with connection.cursor() as cursor:
+            for i in range(0, len(keys), DEFAULT_WINDOW_SIZE):
+                chunk = keys[i:i + DEFAULT_WINDOW_SIZE]
+                sql = ("select `%s` as child_key, `%s` as fk from `%s` where `%s` in (%s) order by `%s`;" %
+                    (self.child_key, self.fk_column, self.child_name, self.fk_column,
+                    ', '.join(['%s'] * len(chunk)), self.child_key))
+                cursor.execute(sql, chunk)
+                for row in cursor.fetchall():
+                    children.setdefault(row['fk'], []).append(record_id(self.child_name, row['child_key']))
+        for record in records:
+            key = record.get(self.parent_key)
+            record[label] = children.get(key, []) if key else []
+
+    # adds reference to a single (oftentimes nested) record and returns the name of the new field
     def update_value(self, record, db):
-        label = "%s_%s_ref" % (self.fk_column ,self.child_name)
-        key = record[self.parent_key]
-        record[label] = self.children.get(key, [])
+        label = self.label()
+        key = record.get(self.parent_key)
+        record[label] = self.children.get(hashable(key), [])
+        return label
 
 # represents a many to one reference in MongoDB
 class ManyToOneRef(Ref):
 
-    # adds the reference to records in MongoDB
-    def add_ref(self, db):
-        self.do_update(db)
+    # maps the key of each referenced record to its id with one scan of just those two fields
+    def prepare(self, db):
+        self.children = {}
+        for child in db[self.child_name].find({}, {self.child_key: True}):
+            key = child.get(self.child_key)
+            if key != None:
+                self.children.setdefault(hashable(key), child['_id'])
 
-    # adds reference to a single (oftentimes nested) record
+    # the field of the referencing records that is needed to add the reference
+    def lookup_field(self):
+        return self.fk_column
+
+    # adds the reference to records as they are mapped from MySQL, with ids from record_id
+    def add_inline(self, connection, records):
+        label = "%s_ref" % self.fk_column
+        for record in records:
+            fk = record.get(self.fk_column)
+            if fk:
+                record[label] = record_id(self.child_name, fk)
+
+    # adds reference to a single (oftentimes nested) record and returns the name of the new field
     def update_value(self, record, db):
-        fk = record[self.fk_column]
+        fk = record.get(self.fk_column)
         if not fk:
-            return
-        child = db[self.child_name].find_one({self.child_key: fk})
-        _id = child['_id']
+            return None
+        _id = self.children.get(hashable(fk))
+        if _id == None:
+            return None
         label = "%s_ref" % self.fk_column
-        record[label] = _id
\ No newline at end of file
+        record[label] = _id
+        return label
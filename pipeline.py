@@ -0,0 +1,185 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+
+# default number of windows of rows, or batches of documents, waiting between two stages of a pipeline
+DEFAULT_QUEUE_SIZE = 4
+
+# the stages of a pipelined migration: reading windows of rows from MySQL, assembling them into documents with
+# their embedded records, and writing batches of documents
+STAGES = ('extract', 'assemble', 'write')
+
+# how often a stage waiting on a queue checks whether the stage on the other side has stopped
+POLL_SECONDS = 0.1
+
+# marks the end of what a stage puts on a queue
+END = object()
+
+# how long one stage spent working, waiting for the stage before it and waiting for the stage after it to make room
+# for its output, added up over every collection that used the stage
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    # the fraction of the stage's time spent working
+    def utilization(self):
+        total = self.busy + self.starved + self.blocked
+        return self.busy / total if total > 0 else 0
+
+    def __str__(self):
+        total = max(self.busy + self.starved + self.blocked, 1e-9)
+        return "%s: %d items, %.0f%% busy, %.0f%% waiting for input, %.0f%% waiting for output" % (self.name,
+            self.items, 100 * self.busy / total, 100 * self.starved / total, 100 * self.blocked / total)
+
+    __repr__ = __str__
+
+# the time one thread spent in a stage, added to the stage's stats when the thread is done with it
+class StageTimer:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.items = 0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+# runs the stages of migrating a collection on separate threads joined by bounded queues, so reading from MySQL,
+# assembling documents and writing them overlap instead of each waiting on the others
+# a full queue holds back the stage feeding it, so memory is bounded by the queue sizes
+# one pipeline is shared by every collection in a migration and may be used by several worker threads at once
+class Pipeline:
+    def __init__(self, queue_size=DEFAULT_QUEUE_SIZE):
+        self.queue_size = max(queue_size, 1)
+        self.lock = threading.Lock()
+        self.stages = OrderedDict((name, StageStats(name)) for name in STAGES)
+
+    # starts a timer for a thread working in the stage
+    def start(self):
+        return StageTimer()
+
+    # adds a finished timer to a stage's stats
+    def stop(self, stage, timer):
+        elapsed = time.perf_counter() - timer.start
+        with self.lock:
+            stats = self.stages[stage]
+            stats.items += timer.items
+            stats.starved += timer.starved
+            stats.blocked += timer.blocked
+            stats.busy += max(elapsed - timer.starved - timer.blocked, 0)
+
+    # iterates over items on a new thread as the producer stage, yielding them on this thread to be used while
+    # the producer goes on to the next ones
+    # the time this thread spends waiting for them is added to timer
+    def run_ahead(self, items, producer, timer):
+        handoff = Handoff(self.queue_size)
+
+        def produce():
+            producer_timer = self.start()
+            try:
+                for item in items:
+                    producer_timer.items += 1
+                    if not handoff.put(item, producer_timer):
+                        return
+            except BaseException as e:
+                handoff.error = e
+            finally:
+                handoff.put(END, producer_timer)
+                self.stop(producer, producer_timer)
+
+        thread = threading.Thread(target=produce, name=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = handoff.get(timer)
+                if item is END:
+                    break
+                timer.items += 1
+                yield item
+            if handoff.error != None:
+                raise handoff.error
+        finally:
+            handoff.closed = True
+            thread.join()
+
+    # starts a consumer stage on a new thread that calls function with each item put on it
+    # the time this thread spends waiting for room on its queue is added to timer
+    def consume(self, function, consumer, timer):
+        return Consumer(self, function, consumer, timer)
+
+    def __str__(self):
+        return 'Pipeline stages:\n' + '\n'.join('  %s' % stats for stats in self.stages.values())
+
+    __repr__ = __str__
+
+# a bounded queue between two stages
+# each side adds the time it spends waiting on the other to its timer
+# either side stops waiting once the other has stopped, closed by the consumer or with an error from either
+class Handoff:
+    def __init__(self, size):
+        self.queue = queue.Queue(size)
+        self.closed = False
+        self.error = None
+
+    # returns False if the consumer has stopped, so the item will never be used
+    def put(self, item, timer):
+        start = time.perf_counter()
+        try:
+            while not self.closed:
+                try:
+                    self.queue.put(item, timeout=POLL_SECONDS)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            timer.blocked += time.perf_counter() - start
+
+    def get(self, timer):
+        start = time.perf_counter()
+        try:
+            return self.queue.get()
+        finally:
+            timer.starved += time.perf_counter() - start
+
+# a stage that uses the items another stage puts on its queue on a thread of its own
+class Consumer:
+    def __init__(self, pipeline, function, consumer, timer):
+        self.pipeline = pipeline
+        self.function = function
+        self.consumer = consumer
+        self.timer = timer
+        self.handoff = Handoff(pipeline.queue_size)
+        self.thread = threading.Thread(target=self.run, name=consumer, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        timer = self.pipeline.start()
+        try:
+            while True:
+                item = self.handoff.get(timer)
+                if item is END:
+                    break
+                timer.items += 1
+                self.function(item)
+        except BaseException as e:
+            self.handoff.error = e
+            self.handoff.closed = True
+        finally:
+            self.pipeline.stop(self.consumer, timer)
+
+    # queues an item, waiting while the queue is full
+    # raises the consumer's error if it has stopped with one
+    def put(self, item):
+        if not self.handoff.put(item, self.timer):
+            raise self.handoff.error
+
+    # waits for every queued item to be used and stops the consumer, raising its error if it had one
+    # with raise_error unset the error isn't raised, for a thread that is already raising one of its own
+    def close(self, raise_error=True):
+        if self.handoff.put(END, self.timer):
+            self.thread.join()
+        if raise_error and self.handoff.error != None:
+            raise self.handoff.error
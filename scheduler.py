@@ -0,0 +1,106 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import queue
+import threading
+
+# a fixed size pool of MySQL connections shared by the migration's worker threads
+# connections are opened with the connect factory the first time they are needed
+class ConnectionPool:
+    def __init__(self, connect, size, connection=None):
+        self.connect = connect
+        self.size = size
+        self.idle = queue.Queue()
+        self.opened = []
+        self.lock = threading.Lock()
+        if connection != None:
+            self.opened.append(connection)
+            self.idle.put(connection)
+
+    # takes a connection from the pool, opening a new one if the pool isn't full yet
+    def acquire(self):
+        with self.lock:
+            if self.idle.empty() and len(self.opened) < self.size:
+                connection = self.connect()
+                self.opened.append(connection)
+                return connection
+        return self.idle.get()
+
+    def release(self, connection):
+        self.idle.put(connection)
+
+    # closes the connections this pool opened, leaving the one it was given open
+    def close(self, keep=None):
+        for connection in self.opened:
+            if connection is not keep:
+                connection.close()
+
+# a unit of work run by the scheduler
+# function is called with a MySQL connection and runs once all tasks named in dependencies have finished
+class Task:
+    def __init__(self, name, function, dependencies=()):
+        self.name = name
+        self.function = function
+        self.dependencies = set(dependencies)
+
+    def __str__(self):
+        return self.name
+
+    __repr__ = __str__
+
+# runs tasks on a pool of worker threads, starting each one as soon as its dependencies have finished
+# tasks become ready in the order they are given, and on_done is called from this thread with each
+# finished task and its result
+# with a single worker tasks run one after another on this thread
+def run_tasks(tasks, pool, workers, on_done=None):
+    pending = list(tasks)
+    finished = set()
+    names = set(task.name for task in tasks)
+    if workers <= 1:
+        while pending:
+            task = _next_ready(pending, finished, names)
+            result = _run(task, pool)
+            finished.add(task.name)
+            if on_done != None:
+                on_done(task, result)
+        return
+
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            while error == None and pending:
+                task = _next_ready(pending, finished, names, block=bool(running))
+                if task == None:
+                    break
+                running[executor.submit(_run, task, pool)] = task
+            if not running:
+                break
+            done, _not_done = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = running.pop(future)
+                if future.exception() != None:
+                    error = error or future.exception()
+                    continue
+                finished.add(task.name)
+                if on_done != None:
+                    on_done(task, future.result())
+    if error != None:
+        raise error
+
+# removes and returns the first pending task whose dependencies have all finished
+# dependencies on names that aren't tasks are ignored
+# returns None if nothing is ready but other tasks are still running and may unblock something
+def _next_ready(pending, finished, names, block=False):
+    for i, task in enumerate(pending):
+        if all(name in finished or name not in names for name in task.dependencies):
+            return pending.pop(i)
+    if block:
+        return None
+    raise ValueError('Tasks have circular dependencies: %s' % pending)
+
+# runs a task with a connection borrowed from the pool
+def _run(task, pool):
+    connection = pool.acquire()
+    try:
+        return task.function(connection)
+    finally:
+        pool.release(connection)
@@ -1,6 +1,16 @@
 from mongodb_schema import *
+from graph_state import SearchSpace, find_bridges, original_id
 from statistics import mean
+from collections import deque
+from itertools import groupby
+from concurrent.futures import ProcessPoolExecutor
 import copy
+import hashlib
+import heapq
+import json
+import os
+import time
+import pymysql
 
 # scale factors used when calculating schema scores
 # bigger means it is a more important consideration/ worse
@@ -8,97 +18,252 @@ data_storage_cost = 1
 data_loss_cost = 10
 ref_cost = 7
 
-TABLES_LIST_SQL = "SELECT TABLE_NAME FROM information_schema.tables WHERE TABLE_SCHEMA = %s AND TABLE_TYPE != 'VIEW';"
-PK_SQL = "SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s \
-AND COLUMN_KEY = 'PRI';"
-TABLE_SIZE_SQL = "SELECT DATA_LENGTH FROM information_schema.tables WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s;"
-NUM_ROWS_SQL = "SELECT COUNT(*) AS NUM_ROWS FROM `%s`;"
-FKEYS_SQL = "SELECT COLUMN_NAME, REFERENCED_TABLE_NAME FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE WHERE \
-REFERENCED_TABLE_SCHEMA = %s AND TABLE_NAME = %s;"
-NULL_FK_COUNT = "SELECT COUNT(*) AS NULL_COUNT FROM `%s` WHERE `%s` IS NULL;"
+# the database's tables, primary keys and foreign keys are each read with one query for every table at once
+TABLES_SQL = "SELECT TABLE_NAME, DATA_LENGTH, TABLE_ROWS FROM information_schema.tables WHERE TABLE_SCHEMA = %s \
+AND TABLE_TYPE != 'VIEW' ORDER BY TABLE_NAME;"
+PKS_SQL = "SELECT TABLE_NAME, COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = %s AND COLUMN_KEY = 'PRI' \
+ORDER BY TABLE_NAME, ORDINAL_POSITION;"
+FKEYS_SQL = "SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME FROM INFORMATION_SCHEMA.KEY_COLUMN_USAGE WHERE \
+TABLE_SCHEMA = %s AND REFERENCED_TABLE_SCHEMA = %s ORDER BY TABLE_NAME, CONSTRAINT_NAME, ORDINAL_POSITION;"
+# counts a table's rows and the nulls in each of its foreign key columns in one scan
+TABLE_COUNTS_SQL = "SELECT COUNT(*) AS NUM_ROWS%s FROM `%s`;"
+# the same counts for a sample of a table's rows
+SAMPLE_COUNTS_SQL = "SELECT COUNT(*) AS NUM_ROWS%s FROM (%s) AS sample;"
+# a table with an integer key is sampled in blocks of rows spread evenly between its smallest and largest keys,
+# each read from the key's index, and other tables by picking rows at random, which reads all of them
+KEY_BOUNDS_SQL = "SELECT MIN(`%s`) AS low, MAX(`%s`) AS high FROM `%s`;"
+SAMPLE_BLOCK_SQL = "(SELECT %s FROM `%s` WHERE `%s` >= %d AND `%s` < %d ORDER BY `%s` LIMIT %d)"
+RANDOM_SAMPLE_SQL = "SELECT %s FROM `%s` WHERE RAND() < %g"
+SAMPLE_BLOCKS = 10
+NULL_COUNT_SQL = ", SUM(`%s` IS NULL) AS NULL_COUNT_%d"
+
+# how the number of rows in each table and of nulls in each foreign key are found
+# exact scans every table once, estimate takes row counts from information_schema and only scans tables with
+# foreign keys, and sample also estimates null counts from rows sampled across each table (see SAMPLE_BLOCK_SQL),
+# so only tables without an integer key are scanned
+ROW_STATS = ('exact', 'estimate', 'sample')
+DEFAULT_SAMPLE_ROWS = 10000
+
+# what a snapshot of the tables and foreign keys of a database (see Graph.save_snapshot) was last changed by
+# a table's create and update times, along with the keys read by init_tables, are cheap to read and change
+# whenever its definition or data does
+FINGERPRINT_SQL = "SELECT TABLE_NAME, CREATE_TIME, UPDATE_TIME FROM information_schema.tables WHERE TABLE_SCHEMA = %s \
+AND TABLE_TYPE != 'VIEW' ORDER BY TABLE_NAME;"
+# MySQL 8 caches those times for information_schema_stats_expiry seconds (a day by default), so the cache is
+# turned off for the session first
+# older servers and MariaDB have no such cache, or the variable, and the error setting it is ignored
+STATS_EXPIRY_SQL = "SET SESSION information_schema_stats_expiry = 0;"
+# the format of snapshot files, which is changed whenever what they hold changes
+SNAPSHOT_VERSION = 2
+
+# how many parts the search is split into for each worker process, so a worker that finishes a small part
+# early can take another
+PLAN_PARTS_PER_WORKER = 4
 
 # a graph model used to convert a MySQL schema to a MongoDB schema
 class Graph:
 
-    def __init__(self, connection, db_name, current_id=0, steps=[]):
+    # connect optionally opens new connections to the database, which the migration uses for streaming scans
+    # row_stats and sample_rows say how tables are counted when they are read from the database (see ROW_STATS)
+    # snapshot is the path of a snapshot file the tables are read from if it is up to date, and otherwise saved
+    # to after reading them from the database, and with no connection the tables are always read from it
+    # metrics (see Metrics) records the queries that read the tables and how the search for options went
+    def __init__(self, connection, db_name, current_id=0, steps=[], connect=None, row_stats='exact',
+        sample_rows=DEFAULT_SAMPLE_ROWS, snapshot=None, metrics=None):
         self.db_name = db_name
         self.connection = connection
+        self.connect = connect
+        self.metrics = metrics
         self.nodes = {}
         self.edges = {}
         self.current_id = current_id
         self.steps = steps
         if current_id == 0:
-            self.init_tables()
+            self.read_tables(row_stats, sample_rows, snapshot)
 
     # we can keep track of the steps used to generate a graph
     # useful for debugging
     def add_step(self, step):
         self.steps = self.steps + [step]
+
+    def num_steps(self):
+        return len(self.steps)
         
+    # reads the tables and foreign keys from a snapshot or the database
+    # what was read and how long it took are kept in introspection
+    def read_tables(self, row_stats, sample_rows, snapshot):
+        self.introspection = Introspection(self.metrics)
+        start = time.perf_counter()
+        if snapshot == None:
+            self.init_tables(row_stats, sample_rows)
+        elif self.connection == None:
+            self.load_snapshot(snapshot)
+        else:
+            with self.connection.cursor() as cursor:
+                fingerprint = self.fingerprint(cursor)
+            if self.snapshot_current(snapshot, fingerprint, row_stats, sample_rows):
+                self.load_snapshot(snapshot)
+            else:
+                self.init_tables(row_stats, sample_rows)
+                self.save_snapshot(snapshot, fingerprint, row_stats, sample_rows)
+        self.introspection.num_tables = len(self.nodes)
+        self.introspection.num_fkeys = len(self.edges)
+        self.introspection.seconds = time.perf_counter() - start
+
     # initializes the graph where each table is a node and each foreign key is an edge
-    def init_tables(self):
-        nodes = {}
+    def init_tables(self, row_stats='exact', sample_rows=DEFAULT_SAMPLE_ROWS):
         with self.connection.cursor() as cursor:
-            cursor.execute(TABLES_LIST_SQL, (self.db_name,))
-            tables = cursor.fetchall()
+            tables = self.introspection.query(cursor, TABLES_SQL, (self.db_name,))
+            pks = {}
+            composite_keys = set()
+            for result in self.introspection.query(cursor, PKS_SQL, (self.db_name,)):
+                # the first column of a composite key
+                if result['TABLE_NAME'] in pks:
+                    composite_keys.add(result['TABLE_NAME'])
+                pks.setdefault(result['TABLE_NAME'], result['COLUMN_NAME'])
+            fkeys = {}
+            for result in self.introspection.query(cursor, FKEYS_SQL, (self.db_name, self.db_name)):
+                fkeys.setdefault(result['TABLE_NAME'], []).append(result)
+
+            nodes = {}
+            null_fk_counts = {}
             for result in tables:
                 table = result['TABLE_NAME']
-                cursor.execute(PK_SQL, (self.db_name, table))
-                pk = (cursor.fetchone() or {}).get('COLUMN_NAME')
-                cursor.execute(TABLE_SIZE_SQL, (self.db_name, table))
-                tbl_size = cursor.fetchone()['DATA_LENGTH']
-                cursor.execute(NUM_ROWS_SQL % table)
-                num_rows = cursor.fetchone()['NUM_ROWS']
-                rowsize = (tbl_size or num_rows * 32) / max(num_rows, 1e-9)
-                nodes[table] = Node(self, table, pk, rowsize, num_rows)
+                columns = [fkey['COLUMN_NAME'] for fkey in fkeys.get(table, [])]
+                num_rows, null_fk_counts[table] = self.count_rows(cursor, table, pks.get(table),
+                    result['TABLE_ROWS'], columns, row_stats, sample_rows)
+                rowsize = (result['DATA_LENGTH'] or num_rows * 32) / max(num_rows, 1e-9)
+                nodes[table] = Node(self, table, pks.get(table), rowsize, num_rows,
+                    unique_key=table not in composite_keys)
             for result in tables:
                 table = result['TABLE_NAME']
-                node = nodes[table]
-                cursor.execute(FKEYS_SQL, (self.db_name, table))
-                for result in cursor.fetchall():
-                    refed_table = nodes[result['REFERENCED_TABLE_NAME']]
-                    cursor.execute(NULL_FK_COUNT % (table, result['COLUMN_NAME']))
-                    null_fk_count = cursor.fetchone()['NULL_COUNT']
-                    node.add_fkey(self, result['COLUMN_NAME'], refed_table, null_fk_count)
-
-    # called when a graph is not a valid schema (either has a cycle or node with multiple parents)
-    # generates new graphs where each new graph has one thing changed
-    # hopefully one of the new graphs will be valid
-    def generate(self, graphs):
-        multiparent_node = self.get_multi_parent_node()
-        if multiparent_node != None:
-
-            if not multiparent_node.dont_dup:
-                copy = self.copy_graph()
-                copy.nodes[multiparent_node.id].duplicate(copy)
-                graphs.append(copy)
-
-            problem_edges = multiparent_node.parent_edges
+                for fkey, null_fk_count in zip(fkeys.get(table, []), null_fk_counts[table]):
+                    nodes[table].add_fkey(self, fkey['COLUMN_NAME'], nodes[fkey['REFERENCED_TABLE_NAME']],
+                        null_fk_count)
 
+    # returns the number of rows in a table and the number of nulls in each of columns
+    # table_rows is information_schema's estimate of the number of rows, which may be None
+    # key is the first column of the table's primary key, if it has one
+    def count_rows(self, cursor, table, key, table_rows, columns, row_stats, sample_rows):
+        nulls = ''.join([NULL_COUNT_SQL % (column, i) for i, column in enumerate(columns)])
+        if row_stats == 'exact' or table_rows == None:
+            counts = self.introspection.scan(cursor, TABLE_COUNTS_SQL % (nulls, table))
+            return counts['NUM_ROWS'], null_counts(counts, len(columns))
+        if len(columns) == 0:
+            return table_rows, []
+        if row_stats == 'estimate':
+            counts = self.introspection.scan(cursor, TABLE_COUNTS_SQL % (nulls, table))
+            return table_rows, null_counts(counts, len(columns))
+        # the same column can be in more than one foreign key, but can only be selected once
+        selected = ', '.join(['`%s`' % column for column in dict.fromkeys(columns)])
+        sample = None
+        if key != None:
+            sample = self.sample_blocks(cursor, table, key, selected, sample_rows)
+        if sample != None:
+            counts = self.introspection.query(cursor, SAMPLE_COUNTS_SQL % (nulls, sample))[0]
         else:
-            problem_edges = self.get_cycle() or []
-
-        # Try reversing an edge
-        for edge in problem_edges:
-            if not edge.reversed:
-                copy = self.copy_graph()
-                copy.edges[edge.id].reverse(copy)
-                graphs.append(copy)
-
-        # Try making an edge a ref edge
-        for edge in problem_edges:
-            if not edge.reference:
-                copy = self.copy_graph()
-                copy.edges[edge.id].make_ref(copy)
-                graphs.append(copy)
+            sample = RANDOM_SAMPLE_SQL % (selected, table, sample_rows / max(table_rows, 1))
+            counts = self.introspection.scan(cursor, SAMPLE_COUNTS_SQL % (nulls, sample))
+        # the sample's null counts are scaled up to the size of the table
+        fraction = table_rows / max(counts['NUM_ROWS'], 1)
+        return table_rows, [round(count * fraction) for count in null_counts(counts, len(columns))]
+
+    # the query for about sample_rows rows of a table read in SAMPLE_BLOCKS blocks, each starting at an evenly spaced
+    # value of its integer key and ending where the next one starts, so no row is read twice
+    # returns None if the key isn't an integer or the table is empty
+    def sample_blocks(self, cursor, table, key, selected, sample_rows):
+        bounds = self.introspection.query(cursor, KEY_BOUNDS_SQL % (key, key, table))[0]
+        low = bounds['low']
+        high = bounds['high']
+        if type(low) is not int or type(high) is not int:
+            return None
+        step = (high - low + 1) / SAMPLE_BLOCKS
+        starts = sorted(set(low + int(step * i) for i in range(SAMPLE_BLOCKS))) + [high + 1]
+        block_rows = -(-sample_rows // SAMPLE_BLOCKS)
+        return ' UNION ALL '.join([SAMPLE_BLOCK_SQL % (selected, table, key, starts[i], key, starts[i + 1], key,
+            block_rows) for i in range(len(starts) - 1)])
+
+    # a hash of the database's table definitions and update times, which changes when a snapshot goes out of date
+    def fingerprint(self, cursor):
+        try:
+            cursor.execute(STATS_EXPIRY_SQL)
+        except pymysql.MySQLError:
+            pass
+        fingerprint = hashlib.sha256()
+        for sql, args in [(FINGERPRINT_SQL, (self.db_name,)), (PKS_SQL, (self.db_name,)),
+            (FKEYS_SQL, (self.db_name, self.db_name))]:
+            for result in self.introspection.query(cursor, sql, args):
+                fingerprint.update(repr(sorted((key, str(value)) for key, value in result.items())).encode())
+        return fingerprint.hexdigest()
+
+    # saves the graph's tables and foreign keys, as read by init_tables, to a JSON file
+    # fingerprint, row_stats, and sample_rows are what the snapshot is checked against before it is used again
+    # the file is written under another name first so that a snapshot is never left half written
+    def save_snapshot(self, path, fingerprint=None, row_stats='exact', sample_rows=DEFAULT_SAMPLE_ROWS):
+        snapshot = {
+            'version': SNAPSHOT_VERSION,
+            'database': self.db_name,
+            'fingerprint': fingerprint,
+            'row_stats': row_stats,
+            'sample_rows': sample_rows,
+            'tables': [[node.name, node.pk, node.rowsize, node.num_rows, node.unique_key]
+                for node in sorted(self.nodes.values(), key=lambda node: node.id)],
+            'fkeys': [[edge.fkey_table, edge.fkey_col, edge.from_node.name, edge.null_fk_count]
+                for edge in sorted(self.edges.values(), key=lambda edge: edge.id)],
+        }
+        with open(path + '.tmp', 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(path + '.tmp', path)
+
+    # checks that a snapshot was taken of this database in its current state with the same row statistics
+    def snapshot_current(self, path, fingerprint, row_stats, sample_rows):
+        try:
+            snapshot = read_snapshot(path)
+        except (OSError, ValueError):
+            return False
+        return (snapshot['database'] == self.db_name and snapshot['fingerprint'] == fingerprint and
+            snapshot['row_stats'] == row_stats and (row_stats != 'sample' or snapshot['sample_rows'] == sample_rows))
+
+    # initializes the graph from a snapshot saved by save_snapshot, in the same order init_tables would
+    def load_snapshot(self, path):
+        snapshot = read_snapshot(path)
+        if self.db_name == None:
+            self.db_name = snapshot['database']
+        elif snapshot['database'] != self.db_name:
+            raise ValueError('Snapshot %s is of database %s, not %s' % (path, snapshot['database'], self.db_name))
+        nodes = {}
+        for table, pk, rowsize, num_rows, unique_key in snapshot['tables']:
+            nodes[table] = Node(self, table, pk, rowsize, num_rows, unique_key=unique_key)
+        for table, column, referenced_table, null_fk_count in snapshot['fkeys']:
+            nodes[table].add_fkey(self, column, nodes[referenced_table], null_fk_count)
+        self.introspection.snapshot = path
 
     # generates and ranks the possible schema options for MySQL database
-    def get_opts(self):
+    # options are returned as SchemaOptions, which only makes an option's MongoDB schema when it is looked at
+    # with top set, a best first search finds the best top options and gives each one as soon as it is known
+    # to be among the best (see search_best), otherwise every option is found and then ranked
+    # time_budget is a number of seconds after which the search stops and offers the options it has found
+    # workers is the number of processes used to search for every option (see search_parallel)
+    # with a profiler (a cProfile.Profile), the search is profiled in this process whenever it runs, which is
+    # also as options are looked at, so the profiler's stats should be read once the options have been viewed
+    # the work done by worker processes isn't profiled
+    def get_opts(self, top=0, time_budget=0, workers=1, profiler=None):
+        if profiler != None:
+            profiler.enable()
+        try:
+            return self.find_opts(top, time_budget, workers, profiler)
+        finally:
+            if profiler != None:
+                profiler.disable()
+
+    # sets up the search for get_opts and starts it on the options it finds first
+    def find_opts(self, top, time_budget, workers, profiler):
         # make any table with a fk pointing to itself a ref since there is no other option
         for edge in self.edges.values():
             if edge.from_node == edge.to_node:
                 edge.make_ref(self)
 
+        cycle_nodes = self.undirected_cycle_nodes()
         for node in self.nodes.values():
             # nodes that start out with multiple parents shouldn't be duplicated
             if len(node.parent_edges) > 1:
@@ -110,51 +275,221 @@ class Graph:
                             node.dont_dup = True
                         else:
                             nonref = True
-            if not node.in_undirected_cycle():
+            if not node in cycle_nodes:
                 # only allow duplication if node is part of a cycle were the graph undirected
                 node.dont_dup = True
         
-        tree_opts = []
-        graphs = [self]
-        num_edges = len(self.edges)
-        while not len(graphs) == 0:
-            curr = graphs.pop()
+        # the search works on compact states instead of copies of the graph (see graph_state.py)
+        # and only the valid schemas it finds are turned back into graphs
+        space = SearchSpace(self)
+        # states reached by the search so that no graph is explored twice
+        self.states = StateSet()
+        self.states.add(space.initial)
+        deadline = time.perf_counter() + time_budget if time_budget else None
+        if top:
+            graphs = self.search_best(space, top, deadline)
+        elif workers > 1:
+            graphs = self.search_parallel(space, workers, deadline)
+        else:
+            graphs = self.search_all(space, deadline)
+        return SchemaOptions(graphs, self.states, self.metrics, profiler)
+
+    # finds every option and yields them ranked by score
+    def search_all(self, space, deadline):
+        # the valid schemas found, so that none is offered as an option twice
+        found = StateSet(by_steps=False)
+        trees = self.search_trees([space.initial], found, len(self.edges) * (2/3), deadline)
+        self.states.num_pruned += found.num_pruned
+        tree_opts = self.lossy_opts(trees, deadline)
+        yield from Graph.rank_opts(tree_opts)
+
+    # explores the states reachable from states and returns the valid ones that aren't already in found
+    # states more than max_steps steps in aren't changed any further
+    def search_trees(self, states, found, max_steps, deadline):
+        trees = []
+        while not len(states) == 0 and not self.out_of_time(deadline):
+            curr = states.pop()
             if curr.is_valid():
-                tree_opts.append(curr)
-            elif len(curr.steps) < num_edges * (2/3):
-                curr.generate(graphs)
+                if found.add(curr):
+                    trees.append(curr)
+            elif curr.num_steps() < max_steps:
+                curr.generate(states, self.states)
+        return trees
+
+    # turns valid states into graphs and adds the options made from them by handling their lossy edges
+    def lossy_opts(self, trees, deadline):
+        tree_opts = [self.state_graph(state) for state in trees]
+        opt_states = StateSet(by_steps=False)
         for opt in tree_opts:
+            opt_states.add(opt)
             for root in opt.root_nodes():
                 root.adjust_child_size()
-        for opt in tree_opts:
-            opt.handle_lossy_edges(tree_opts)
-        Graph.scale_opt_scores(tree_opts)
-        index = [[tree_opts[i].score, i] for i in range(len(tree_opts))]
-        index.sort()
-        return [tree_opts[i].make_mongodb_schema() for _h, i in index]
+        for opt in list(tree_opts):
+            if self.out_of_time(deadline):
+                break
+            opt.handle_lossy_edges(tree_opts, opt_states)
+        self.states.num_pruned += opt_states.num_pruned
+        return tree_opts
+
+    # finds every option like search_all, with the work split between worker processes
+    # the search runs here until it has enough states to share out, then the workers explore from their share
+    # of them for valid states, and then handle the lossy edges of the valid states, all without a database
+    # connection
+    # workers don't know what the others have explored, so some states are explored more than once, but the
+    # options reachable from the states they are given together are the options search_all finds, and they
+    # are ranked the same way however many workers there are
+    def search_parallel(self, space, workers, deadline):
+        states = deque([space.initial])
+        found = StateSet(by_steps=False)
+        trees = []
+        max_steps = len(self.edges) * (2/3)
+        num_parts = workers * PLAN_PARTS_PER_WORKER
+        # breadth first so the states shared out are few steps in and lead to different parts of the search
+        while states and len(states) < num_parts and not self.out_of_time(deadline):
+            curr = states.popleft()
+            if curr.is_valid():
+                if found.add(curr):
+                    trees.append(curr)
+            elif curr.num_steps() < max_steps:
+                curr.generate(states, self.states)
+        trees = [state.pack() for state in trees]
+
+        with ProcessPoolExecutor(max_workers=workers, initializer=start_worker, initargs=(space,)) as executor:
+            # each worker starts out knowing the states reached so far, which are all either explored already
+            # or shared out to one of the workers
+            states = [state.pack() for state in states]
+            parts = [(states[i::num_parts], self.states.steps, max_steps, self.time_left(deadline))
+                for i in range(num_parts)]
+            for part_trees, stats in executor.map(search_trees_part, *zip(*parts)):
+                self.add_stats(stats)
+                for packed in part_trees:
+                    # the first three parts of a packed state are its signature
+                    if found.add_signature(packed[:3], packed[4]):
+                        trees.append(packed)
+            self.states.num_pruned += found.num_pruned
+
+            # making refs of lossy edges doesn't change which nodes and edges a graph has, so valid states with
+            # different layouts never lead to the same option, and sharing out whole layouts means no option is
+            # found twice
+            layouts = {}
+            for packed in trees:
+                layouts.setdefault(packed[0], []).append(packed)
+            parts = [[] for _i in range(num_parts)]
+            for layout_trees in sorted(layouts.values(), key=len, reverse=True):
+                min(parts, key=len).extend(layout_trees)
+            opts = []
+            for part_opts, stats in executor.map(lossy_opts_part, parts, [self.time_left(deadline)] * num_parts):
+                self.add_stats(stats)
+                opts += part_opts
+        if len(opts) == 0:
+            return
+
+        # the workers work out each option's costs and sort key, so options are ranked the way rank_opts
+        # ranks them and only turned into graphs here when they are looked at
+        scores = Graph.scale_costs([costs for _packed, costs, _sort_key in opts])
+        for i in sorted(range(len(opts)), key=lambda i: (sum(scores[i]), opts[i][2])):
+            opt = self.state_graph(space.unpack(opts[i][0]))
+            for root in opt.root_nodes():
+                root.adjust_child_size()
+            opt.set_scores(scores[i])
+            yield opt
+
+    # the seconds left before the deadline, or 0 for no deadline
+    def time_left(self, deadline):
+        if deadline == None:
+            return 0
+        return max(deadline - time.perf_counter(), 1e-9)
+
+    # adds up the number of states explored and pruned by a worker process, and whether it ran out of time
+    def add_stats(self, stats):
+        num_states, num_pruned, out_of_time = stats
+        self.states.num_states += num_states
+        self.states.num_pruned += num_pruned
+        self.states.out_of_time = self.states.out_of_time or out_of_time
+
+    # searches for the best top options, exploring the states with the lowest bound on their score first
+    # each option is yielded as soon as no state left to explore could lead to a better one, so the search
+    # stops early once it has top options
+    # scale_opt_scores compares options to the average of all of them, which isn't known until every option
+    # is found, so options are scored against the size of the database instead (see fixed_score)
+    # if the time budget runs out, the best options found so far are yielded
+    def search_best(self, space, top, deadline):
+        num_edges = len(self.edges)
+        scale = self.score_scale()
+        # a table's rows are either stored or lost, so the data loss and storage parts of a score add up to at
+        # least the smaller of their scale factors
+        min_data_score = min(data_loss_cost, data_storage_cost)
+        # states are explored in order of (bound, steps, order added) and options kept in order of
+        # (score, order found), so ties are broken the same way every time
+        frontier = [(min_data_score, space.initial.num_steps(), 0, space.initial)]
+        options = []
+        count = 1
+        found = StateSet(by_steps=False)
+        opt_states = StateSet(by_steps=False)
+        yielded = 0
+        while yielded < top:
+            while options and (not frontier or options[0][0] <= frontier[0][0]) and yielded < top:
+                yield heapq.heappop(options)[2]
+                yielded += 1
+            if not frontier or self.out_of_time(deadline):
+                break
+            curr = heapq.heappop(frontier)[3]
+            if curr.is_valid():
+                if found.add(curr):
+                    opt = self.state_graph(curr)
+                    if opt_states.add(opt):
+                        for root in opt.root_nodes():
+                            root.adjust_child_size()
+                        opts = [opt]
+                        opt.handle_lossy_edges(opts, opt_states)
+                        for opt in opts:
+                            heapq.heappush(options, (opt.fixed_score(scale), count, opt))
+                            count += 1
+            elif curr.num_steps() < num_edges * (2/3):
+                states = []
+                curr.generate(states, self.states)
+                for state in states:
+                    # the number of refs never goes down as a state is changed
+                    bound = min_data_score + ref_cost * state.num_refs() / scale[1]
+                    heapq.heappush(frontier, (bound, state.num_steps(), count, state))
+                    count += 1
+        self.states.num_pruned += found.num_pruned + opt_states.num_pruned
+        while options and yielded < top:
+            yield heapq.heappop(options)[2]
+            yielded += 1
+
+    # checks whether the search has run past its deadline, noting that it stopped early if it has
+    def out_of_time(self, deadline):
+        if deadline != None and time.perf_counter() > deadline:
+            self.states.out_of_time = True
+        return self.states.out_of_time
 
     # some edges may lose data
     # the ones with a root node on one end can be converted to refs to avoid data loss
-    def handle_lossy_edges(self, tree_opts):
-        for root in self.root_nodes():
-            for edge in root.child_edges:
+    # opt_states holds the options already found, which aren't added or explored again
+    # roots and edges are taken in ID order so the options found don't depend on set ordering
+    def handle_lossy_edges(self, tree_opts, opt_states):
+        for root in sorted(self.root_nodes(), key=lambda node: node.id):
+            for edge in sorted(root.child_edges, key=lambda edge: edge.id):
                 if self.data_loss_cost(edge.to_node.name) != 0:
+                    # self is valid, and making one of its edges a ref can't make it invalid
                     copy = self.copy_graph()
                     copy.edges[edge.id].make_ref(copy)
-                    if copy.is_valid():
+                    if opt_states.add(copy):
                         for root in copy.root_nodes():
                             root.adjust_child_size()
                         tree_opts.append(copy)
-                        copy.handle_lossy_edges(tree_opts)
+                        copy.handle_lossy_edges(tree_opts, opt_states)
 
                     # now try reversing the ref edge
+                    # this only gives the root another ref parent, so only the root can be made invalid
                     copy = copy.copy_graph()
                     copy.edges[edge.id].reverse(copy)
-                    if copy.is_valid():
+                    if copy.edges[edge.id].to_node.refs_valid() and opt_states.add(copy):
                         for root in copy.root_nodes():
                             root.adjust_child_size()
                         tree_opts.append(copy)
-                        copy.handle_lossy_edges(tree_opts)
+                        copy.handle_lossy_edges(tree_opts, opt_states)
 
     # turns the graph into a mongodb schema
     def make_mongodb_schema(self):
@@ -207,24 +542,61 @@ class Graph:
                 num_refs += 1
         return num_refs
 
+    # the total size of the data in the original database and its number of foreign keys
+    # used to score options without comparing them to each other
+    def score_scale(self):
+        total_size = sum([node.rowsize * node.orig_num_rows for node in self.nodes.values()])
+        return max(total_size, 1e-9), max(len(self.edges), 1)
+
+    # scores a graph against the size of the original database rather than against the other options
+    # data loss and storage are measured as fractions of the database's size and refs as a fraction of its
+    # foreign keys
+    def fixed_score(self, scale):
+        total_size, num_fkeys = scale
+        self.scaled_data_loss = data_loss_cost * self.data_loss_cost() / total_size
+        self.scaled_data_storage = data_storage_cost * self.data_storage_cost() / total_size
+        self.scaled_refs = ref_cost * self.ref_cost() / num_fkeys
+        self.score = self.scaled_data_loss + self.scaled_data_storage + self.scaled_refs
+        return self.score
+
+    # the data loss, data storage, and ref costs that scale_opt_scores compares between options
+    def costs(self):
+        return self.data_loss_cost(), self.data_storage_cost(), self.ref_cost()
+
     # scales the scores for data loss, data storage, and refs based on average for all options
     def scale_opt_scores(schema_opts):
-        data_loss = []
-        data_storage = []
-        refs = []
-        for graph in schema_opts:
-            data_loss.append(graph.data_loss_cost())
-            data_storage.append(graph.data_storage_cost())
-            refs.append(graph.ref_cost())
+        scores = Graph.scale_costs([graph.costs() for graph in schema_opts])
+        for graph, graph_scores in zip(schema_opts, scores):
+            graph.set_scores(graph_scores)
+
+    # scales the costs of every option (see costs) based on the average for all of them
+    # returns the scaled data loss, data storage, and refs of each option
+    def scale_costs(costs):
+        data_loss, data_storage, refs = zip(*costs)
         average_data_loss = max(mean(data_loss), 1e-9)
         average_data_storage = max(mean(data_storage), 1e-9)
         average_refs = max(mean(refs), 1e-9)
-        for i in range(len(schema_opts)):
-            graph = schema_opts[i]
-            graph.scaled_data_loss = data_loss_cost * data_loss[i] / average_data_loss
-            graph.scaled_data_storage = data_storage_cost * data_storage[i] / average_data_storage
-            graph.scaled_refs = ref_cost * refs[i] / average_refs
-            graph.score = graph.scaled_data_loss + graph.scaled_data_storage + graph.scaled_refs
+        return [(data_loss_cost * loss / average_data_loss, data_storage_cost * storage / average_data_storage,
+            ref_cost * num_refs / average_refs) for loss, storage, num_refs in costs]
+
+    def set_scores(self, scores):
+        self.scaled_data_loss, self.scaled_data_storage, self.scaled_refs = scores
+        self.score = self.scaled_data_loss + self.scaled_data_storage + self.scaled_refs
+
+    # scores the options and returns them sorted from best to worst
+    # options with the same score are sorted by their signatures so that the order doesn't depend on the order
+    # they were found in
+    def rank_opts(schema_opts):
+        if len(schema_opts) == 0:
+            return []
+        Graph.scale_opt_scores(schema_opts)
+        ranked = []
+        for _score, graphs in groupby(sorted(schema_opts, key=lambda graph: graph.score), lambda graph: graph.score):
+            graphs = list(graphs)
+            if len(graphs) > 1:
+                graphs.sort(key=lambda graph: graph.sort_key())
+            ranked += graphs
+        return ranked
 
     # returns a cycle if the graph contains one
     def get_cycle(self):
@@ -249,23 +621,69 @@ class Graph:
 
     # nodes that shouldn't be duplicated shouldn't have more than one ref to them
     def refs_valid(self):
-        # having multiple refs to a node can create to same problem as duplicating it
         for node in self.nodes.values():
-            if node.dont_dup and len(node.parent_edges) > 1:
-                # don't actually count a recursive edge as a ref
-                nonrec = False
-                for edge in node.parent_edges:
-                    if edge.to_node != edge.from_node:
-                        if nonrec:
-                            return False
-                        else:
-                            nonrec = True
+            if not node.refs_valid():
+                return False
         return True
 
     # checks that a graph represents a valid MongoDB schema
     def is_valid(self):
         return self.get_cycle() == None and self.get_multi_parent_node() == None and self.refs_valid()
 
+    # a description of the graph that is the same for equivalent graphs however they were generated
+    # made up of the reversed and ref flags of every edge and where each duplicated node came from,
+    # using origins rather than IDs since duplicates get new IDs in the order they are made
+    def signature(self):
+        nodes = frozenset(node.origin for node in self.nodes.values())
+        edges = frozenset((edge.origin, edge.from_node.origin, edge.to_node.origin, edge.reversed, edge.reference)
+            for edge in self.edges.values())
+        return nodes, edges
+
+    # the signature as something that can be sorted
+    def sort_key(self):
+        nodes, edges = self.signature()
+        return sorted(map(repr, nodes)), sorted(map(repr, edges))
+
+    # builds the graph a search state represents (see graph_state.py)
+    # original nodes and edges keep their IDs and duplicates get new ones
+    def state_graph(self, state):
+        layout = state.layout
+        space = layout.space
+        graph = Graph(self.connection, self.db_name, current_id=self.current_id, steps=state.step_list(),
+            connect=self.connect)
+        nodes = []
+        for i, origin in enumerate(layout.node_origins):
+            table = layout.node_tables[i]
+            name, pk, rowsize, num_rows, unique_key = space.tables[table]
+            nodes.append(Node(graph, name, pk, rowsize, num_rows, node_id=original_id(origin),
+                dont_dup=space.dont_dup[table], origin=origin, unique_key=unique_key))
+        for i, origin in enumerate(layout.edge_origins):
+            fkey_col, fkey_table, null_fk_count = space.fkeys[layout.edge_fkeys[i]]
+            reversed = bool(state.reversed >> i & 1)
+            from_node, to_node = nodes[layout.edge_from[i]], nodes[layout.edge_to[i]]
+            if reversed:
+                from_node, to_node = to_node, from_node
+            Edge(graph, from_node, to_node, fkey_col, fkey_table, null_fk_count, edge_id=original_id(origin),
+                reversed=reversed, reference=bool(state.reference >> i & 1), origin=origin)
+        return graph
+
+    # returns the nodes that are part of an "undirected cycle"
+    # essentially that means, would the node be part of a cycle if all edge's directionality was ignored
+    # this turns out to be important to determining if a node should be duplicated
+    # a node is in an undirected cycle exactly when one of its edges isn't a bridge, so every node is found with
+    # one pass over the graph (ref edges are left out since they don't embed anything)
+    def undirected_cycle_nodes(self):
+        nodes = list(self.nodes.values())
+        index = {node.id: i for i, node in enumerate(nodes)}
+        edges = [edge for edge in self.edges.values() if not edge.reference]
+        bridges = find_bridges(len(nodes), [(index[edge.from_node.id], index[edge.to_node.id]) for edge in edges])
+        cycle_nodes = set()
+        for i, edge in enumerate(edges):
+            if not i in bridges:
+                cycle_nodes.add(edge.from_node)
+                cycle_nodes.add(edge.to_node)
+        return cycle_nodes
+
     # returns the next available ID
     # nodes and edges are assigned IDs that persist when the graph is copied
     def get_next_id(self):
@@ -275,7 +693,7 @@ class Graph:
     # makes a deep copy of a graph
     # need custom function since not all references get copied correctly otherwise
     def copy_graph(self):
-        cp = Graph(self.connection, self.db_name, current_id=self.current_id, steps=self.steps)
+        cp = Graph(self.connection, self.db_name, current_id=self.current_id, steps=self.steps, connect=self.connect)
         for node in self.nodes.values():
             node.copy_node(cp)
         for edge in self.edges.values():
@@ -288,13 +706,190 @@ class Graph:
 
     __repr__ = __str__
 
+# the set of graphs already reached while searching for schema options
+# with by_steps set, a graph is worth exploring again if it was reached in fewer steps than before,
+# since the search is limited by the number of steps taken
+class StateSet:
+    def __init__(self, by_steps=True):
+        self.by_steps = by_steps
+        self.steps = {}
+        self.num_states = 0
+        self.num_pruned = 0
+        self.out_of_time = False
+
+    # adds a graph and returns whether it is new, otherwise counting it as pruned
+    def add(self, graph):
+        return self.add_signature(graph.signature(), graph.num_steps())
+
+    # adds a graph by its signature, for graphs that aren't in this process (see GraphState.pack)
+    def add_signature(self, signature, num_steps):
+        steps = self.steps.get(signature)
+        if steps != None and (steps <= num_steps or not self.by_steps):
+            self.num_pruned += 1
+            return False
+        if steps == None:
+            self.num_states += 1
+        self.steps[signature] = num_steps
+        return True
+
+    def __str__(self):
+        text = "%d schema states explored, %d repeated states pruned" % (self.num_states, self.num_pruned)
+        if self.out_of_time:
+            text += ", search stopped by the time budget"
+        return text
+
+    __repr__ = __str__
+
+# the null counts selected with NULL_COUNT_SQL, which are NULL for an empty table
+def null_counts(counts, num_columns):
+    return [int(counts['NULL_COUNT_%d' % i] or 0) for i in range(num_columns)]
+
+# reads a snapshot file saved by Graph.save_snapshot
+def read_snapshot(path):
+    with open(path) as f:
+        snapshot = json.load(f)
+    if snapshot.get('version') != SNAPSHOT_VERSION:
+        raise ValueError('Snapshot %s has version %s, but only version %d can be read' % (path,
+            snapshot.get('version'), SNAPSHOT_VERSION))
+    return snapshot
+
+# what reading the tables and foreign keys of a database took
+# snapshot is the snapshot file they were read from, if they weren't read from the database
+# with metrics, each query and how long it took is recorded in them as well
+class Introspection:
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self.snapshot = None
+        self.num_tables = 0
+        self.num_fkeys = 0
+        self.num_queries = 0
+        self.num_scans = 0
+        self.seconds = 0
+
+    # runs a query and returns all of its results
+    def query(self, cursor, sql, args=None):
+        self.num_queries += 1
+        start = time.perf_counter()
+        cursor.execute(sql, args)
+        results = cursor.fetchall()
+        if self.metrics != None:
+            self.metrics.add('introspection_queries')
+            self.metrics.observe('introspection_query_seconds', time.perf_counter() - start)
+        return results
+
+    # runs a query that scans a whole table and returns its one result
+    def scan(self, cursor, sql):
+        self.num_scans += 1
+        return self.query(cursor, sql)[0]
+
+    def __str__(self):
+        source = " from snapshot %s" % self.snapshot if self.snapshot != None else ""
+        return "Read %d tables and %d foreign keys%s in %.2f sec (%d queries, %d table scans)" % (self.num_tables,
+            self.num_fkeys, source, self.seconds, self.num_queries, self.num_scans)
+
+    __repr__ = __str__
+
+# the ranked schema options for a database, whose MongoDB schemas are only made when they are looked at
+# graphs is an iterator of graphs in rank order, so the search for later options may not have run yet
+# states is the StateSet of the search, and the time taken to find each option and the states explored so far
+# are recorded in metrics if they are given
+# the search for each option runs under profiler if it is given, see Graph.get_opts
+class SchemaOptions:
+    def __init__(self, graphs, states=None, metrics=None, profiler=None):
+        self.graphs = graphs
+        self.states = states
+        self.metrics = metrics
+        self.profiler = profiler
+        self.schemas = []
+
+    # makes sure the first num options have been found, returning whether there are that many
+    def has(self, num):
+        while len(self.schemas) < num:
+            graph = self.next_graph()
+            if graph == None:
+                return False
+            self.schemas.append(graph.make_mongodb_schema())
+        return True
+
+    def next_graph(self):
+        start = time.perf_counter()
+        if self.profiler != None:
+            self.profiler.enable()
+        try:
+            graph = next(self.graphs, None)
+        finally:
+            if self.profiler != None:
+                self.profiler.disable()
+        if self.metrics != None:
+            if graph != None:
+                self.metrics.add('plan_options')
+                self.metrics.observe('plan_option_seconds', time.perf_counter() - start)
+            if self.states != None:
+                self.metrics.set('plan_states', self.states.num_states)
+                self.metrics.set('plan_pruned_states', self.states.num_pruned)
+        return graph
+
+    def __getitem__(self, i):
+        if i < 0 or not self.has(i + 1):
+            raise IndexError('There are only %d schema options' % len(self))
+        return self.schemas[i]
+
+    def __len__(self):
+        while self.has(len(self.schemas) + 1):
+            pass
+        return len(self.schemas)
+
+# the search space of the worker process this runs in, set when a parallel search starts the process
+worker_space = None
+
+def start_worker(space):
+    global worker_space
+    worker_space = space
+
+# a graph with no connection or nodes of its own, used by a worker process to search and turn states into graphs
+def worker_graph(time_budget):
+    graph = Graph(None, None, current_id=worker_space.current_id)
+    graph.states = StateSet()
+    deadline = time.perf_counter() + time_budget if time_budget else None
+    return graph, deadline
+
+# the number of states a worker process explored and pruned, and whether it ran out of time
+def worker_stats(graph):
+    return graph.states.num_states, graph.states.num_pruned, graph.states.out_of_time
+
+# explores from some of the states of a parallel search in a worker process (see Graph.search_parallel)
+# states are packed (see GraphState.pack), and seen is the steps of the states reached before they were
+# shared out
+# returns the valid states found, packed, and the worker's stats
+def search_trees_part(states, seen, max_steps, time_budget):
+    graph, deadline = worker_graph(time_budget)
+    graph.states.steps = dict(seen)
+    found = StateSet(by_steps=False)
+    trees = graph.search_trees([worker_space.unpack(state) for state in states], found, max_steps, deadline)
+    graph.states.num_pruned += found.num_pruned
+    return [state.pack() for state in trees], worker_stats(graph)
+
+# handles the lossy edges of some of the valid states found by a parallel search in a worker process
+# returns the options made from them, each packed along with its costs and sort key, and the worker's stats
+def lossy_opts_part(trees, time_budget):
+    graph, deadline = worker_graph(time_budget)
+    opts = graph.lossy_opts([worker_space.unpack(state) for state in trees], deadline)
+    return [(worker_space.graph_state(opt).pack(), opt.costs(), opt.sort_key()) for opt in opts], worker_stats(graph)
+
 # a graph node representing a MySQL table or MongoDB record (including embeded)
 class Node:
 
-    def __init__(self, graph, table, pk, rowsize, num_rows, node_id=None, dont_dup=False):
+    # origin identifies the node across copies of the graph (see Graph.signature)
+    # a table's original node is identified by its ID, and a duplicate by the edge it was made for
+    # pk is the first column of the table's primary key, and unique_key is whether it is the only one, so that its
+    # values tell the table's rows apart
+    def __init__(self, graph, table, pk, rowsize, num_rows, node_id=None, dont_dup=False, origin=None,
+            unique_key=True):
         self.id = (node_id or graph.get_next_id())
+        self.origin = origin or ('node', self.id)
         self.name = table
         self.pk = pk
+        self.unique_key = unique_key
         self.rowsize = rowsize
         self.num_rows = num_rows
         self.orig_num_rows = num_rows
@@ -312,7 +907,7 @@ class Node:
     # maps node to a mongodb collection 
     def make_collection(self):
         self.path = [self.name]
-        table = Collection(self.name, self.pk)
+        table = Collection(self.name, self.pk, self.orig_num_rows, self.unique_key)
         self._embed_children(table)
         return table
 
@@ -373,58 +968,27 @@ class Node:
                         return cycle
             return None
 
-    # determines if node is part of an "undirected cycle"
-    # essentially that means, would the node be part of a cycle if all edge's directionality was ignored
-    # this turns out to be important to determining if a node should be duplicated
-    def in_undirected_cycle(self):
-        return self.undirected_search_for(self, [], set())
-
-    # DFS for a node ignoring the directionality of all edges
-    def undirected_search_for(self, search_for, used_edges, visited_nodes):
-        visited_nodes.add(self)
-
-        for edge in self.child_edges:
-            if edge.reference or edge in used_edges :
-                continue
-            else:
-                if edge.to_node == search_for:
-                    return True
-                elif not edge.to_node in visited_nodes:
-                    if edge.to_node.undirected_search_for(search_for, used_edges + [edge], visited_nodes):
-                        return True
-        for edge in self.parent_edges:
-            if edge.reference or edge in used_edges :
-                continue
-            else:
-                if edge.from_node == search_for:
-                    return True
-                elif not edge.from_node in visited_nodes:
-                    if edge.from_node.undirected_search_for(search_for, used_edges + [edge], visited_nodes):
-                        return True
-        return False
-
-    # duplicates a node that has multiple parents
-    # for each parent a new node will be created that has only one parent
-    # each of the duplicates will have the same children as the original node
-    def duplicate(self, graph):
-        graph.nodes.pop(self.id)
-        for edge in self.child_edges:
-            graph.edges.pop(edge.id)
-            edge.to_node.parent_edges.remove(edge)
-        for edge in self.parent_edges:
-            copy = Node(graph, self.name, self.pk, self.rowsize, self.num_rows)
-            edge.to_node = copy
-            copy.parent_edges.add(edge)
-            for edge in self.child_edges:
-                edge_copy = Edge(graph, copy, edge.to_node, edge.fkey_col, edge.fkey_table, edge.null_fk_count)
-                edge_copy.reversed = edge.reversed
-                edge_copy.reference = edge.reference
-        graph.add_step("Duplicated node: %s" % self.name)
+    # a node that shouldn't be duplicated shouldn't have more than one ref to it
+    # having multiple refs to a node can create to same problem as duplicating it
+    def refs_valid(self):
+        if self.dont_dup and len(self.parent_edges) > 1:
+            # don't actually count a recursive edge as a ref
+            nonrec = False
+            for edge in self.parent_edges:
+                if edge.to_node != edge.from_node:
+                    if nonrec:
+                        return False
+                    else:
+                        nonrec = True
+        return True
 
     # makes a copy of a node
     # again, can't use existing deepcopy because references don't get copied right
+    # the copy starts with the table's original number of rows, so sizes are worked out from scratch when the
+    # copy's children are adjusted rather than from the sizes in the graph it was copied from
     def copy_node(self, graph):
-        Node(graph, self.name, self.pk, self.rowsize, self.num_rows, node_id=self.id, dont_dup=self.dont_dup)
+        Node(graph, self.name, self.pk, self.rowsize, self.orig_num_rows, node_id=self.id, dont_dup=self.dont_dup,
+            origin=self.origin, unique_key=self.unique_key)
 
     def __str__(self):
         edges = []
@@ -444,8 +1008,10 @@ class Node:
 # edge representing a foreign key in MySQL or an embedded record or reference in MongoDB
 class Edge:
 
+    # origin identifies the edge across copies of the graph (see Graph.signature)
+    # a foreign key's original edge is identified by its ID, and a copy by the edge and duplicate node it was made for
     def __init__(self, graph, from_node, to_node, fkey_col, fkey_table, null_fk_count, edge_id=None, reversed=False, 
-        reference=False):
+        reference=False, origin=None):
 
         self.from_node = from_node
         self.to_node = to_node
@@ -457,6 +1023,7 @@ class Edge:
         self.from_node.child_edges.add(self)
         self.to_node.parent_edges.add(self)
         self.id = (edge_id or graph.get_next_id())
+        self.origin = origin or ('edge', self.id)
         graph.edges[self.id] = self
 
     # reverses the edge so the parent becomes the child and the child becomes the parent
@@ -485,7 +1052,7 @@ class Edge:
         from_node = graph.nodes[self.from_node.id]
         to_node = graph.nodes[self.to_node.id]
         Edge(graph, from_node, to_node, self.fkey_col, self.fkey_table, self.null_fk_count, edge_id=self.id, 
-            reversed=self.reversed, reference=self.reference)
+            reversed=self.reversed, reference=self.reference, origin=self.origin)
 
     def __str__(self):
         return "(%s -> %s) via %s.%s" % (self.from_node.name, self.to_node.name, self.fkey_table, self.fkey_col)
@@ -0,0 +1,71 @@
+import bson
+from pymongo import DeleteMany, ReplaceOne, UpdateOne
+from mongodb_schema import MongoSink
+
+# a MySQL connection for the queries the migration runs, backed by sqlite
+class Cursor:
+    def __init__(self, connection):
+        self.cursor = connection.db.cursor()
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        pass
+
+    def execute(self, sql, params=None):
+        self.cursor.execute(sql.replace('`', '"').replace('%s', '?'), tuple(params or ()))
+        self.description = self.cursor.description
+
+    def row(self, row):
+        return None if row == None else dict(zip([column[0] for column in self.description], row))
+
+    def fetchone(self):
+        return self.row(self.cursor.fetchone())
+
+    def fetchall(self):
+        return [self.row(row) for row in self.cursor.fetchall()]
+
+    def fetchmany(self, size=1):
+        return [self.row(row) for row in self.cursor.fetchmany(size)]
+
+class Connection:
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self, cursor_class=None):
+        return Cursor(self)
+
+    def close(self):
+        pass
+
+class Graph:
+    def __init__(self, connection, name):
+        self.connection = connection
+        self.connect = None
+        self.db_name = 'sales'
+        self.name = name
+
+    # schemas are told apart by how their graph is shown, see schema_signature
+    def __str__(self):
+        return self.name
+
+# mongomock only inserts dictionaries, so batches are decoded before they are written
+class DecodingSink(MongoSink):
+    def write_batch(self, collection_name, documents, batch_number):
+        documents = [bson.decode(document.raw) for document in documents]
+        return super().write_batch(collection_name, documents, batch_number)
+
+# mongomock can't read the operations of newer versions of pymongo, so they are run one at a time
+def bulk_write(collection, requests, ordered=True):
+    for request in requests:
+        if isinstance(request, ReplaceOne):
+            collection.replace_one(request._filter, request._doc, upsert=request._upsert)
+        elif isinstance(request, UpdateOne):
+            collection.update_one(request._filter, request._doc)
+        elif isinstance(request, DeleteMany):
+            collection.delete_many(request._filter)
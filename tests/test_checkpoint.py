@@ -0,0 +1,88 @@
+import sqlite3
+import pytest
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+import codec_options
+from checkpoint import FileCheckpoint
+from fakes import Connection, DecodingSink, Graph
+from mongodb_schema import BatchError, Collection, Schema
+
+mongomock = pytest.importorskip('mongomock')
+
+# orders have a key of one column and their lines a key of two, the first of which is the order's
+def make_connection():
+    connection = Connection(sqlite3.connect(':memory:'))
+    connection.db.executescript('''
+        CREATE TABLE orders (id INTEGER PRIMARY KEY, note TEXT);
+        CREATE TABLE lines (id INTEGER, line INTEGER, quantity INTEGER, PRIMARY KEY (id, line));
+        INSERT INTO orders VALUES (1, 'first'), (2, 'second'), (3, 'third');
+        INSERT INTO lines VALUES (1, 1, 10), (1, 2, 20), (2, 1, 30), (3, 1, 40);
+    ''')
+    return connection
+
+def make_schema(connection):
+    schema = Schema(Graph(connection, 'orders and lines'))
+    schema.add_collection(Collection('orders', 'id', num_rows=3))
+    schema.add_collection(Collection('lines', 'id', num_rows=4, unique_key=False))
+    return schema
+
+# a sink that fails once it has written a number of batches of a collection, as a migration that stops would
+class FailingSink(DecodingSink):
+    def __init__(self, db, collection_name, num_batches):
+        super().__init__(db)
+        self.collection_name = collection_name
+        self.num_batches = num_batches
+
+    def write_batch(self, collection_name, documents, batch_number):
+        if collection_name == self.collection_name:
+            if self.num_batches == 0:
+                raise RuntimeError('Lost the connection to MongoDB')
+            self.num_batches -= 1
+        return super().write_batch(collection_name, documents, batch_number)
+
+# a sink whose first batch of a collection isn't written, but reported as failed
+class RejectingSink(DecodingSink):
+    def __init__(self, db, collection_name):
+        super().__init__(db)
+        self.collection_name = collection_name
+
+    def write_batch(self, collection_name, documents, batch_number):
+        if collection_name == self.collection_name:
+            self.collection_name = None
+            return 0, BatchError(collection_name, batch_number, len(documents), [{'code': 2, 'errmsg': 'rejected'}])
+        return super().write_batch(collection_name, documents, batch_number)
+
+def rows(db, collection_name, fields):
+    return sorted(tuple(document[field] for field in fields) for document in db[collection_name].find())
+
+@pytest.fixture(autouse=True)
+def plain_codecs(monkeypatch):
+    # mongomock can't use the codecs, and the tables have no decimals or dates for them to convert
+    monkeypatch.setattr(codec_options, 'get', lambda: DEFAULT_CODEC_OPTIONS)
+
+def test_resume_migrates_every_row_of_a_composite_key_table(tmp_path):
+    connection = make_connection()
+    client = mongomock.MongoClient()
+    path = str(tmp_path / 'checkpoint.json')
+    with pytest.raises(RuntimeError):
+        make_schema(connection).map(client, batch_size=1, partition_rows=2, checkpoint=FileCheckpoint(path),
+            sink=FailingSink(client['sales'], 'lines', 1))
+
+    writer = make_schema(connection).map(client, batch_size=1, partition_rows=2, checkpoint=FileCheckpoint(path),
+        resume=True, sink=DecodingSink(client['sales']))
+    assert writer.errors == []
+    assert rows(client['sales'], 'lines', ['id', 'line']) == [(1, 1), (1, 2), (2, 1), (3, 1)]
+    assert rows(client['sales'], 'orders', ['id']) == [(1,), (2,), (3,)]
+
+def test_resume_retries_a_range_with_write_errors(tmp_path):
+    connection = make_connection()
+    client = mongomock.MongoClient()
+    path = str(tmp_path / 'checkpoint.json')
+    writer = make_schema(connection).map(client, batch_size=1, partition_rows=2, checkpoint=FileCheckpoint(path),
+        sink=RejectingSink(client['sales'], 'orders'))
+    assert len(writer.errors) == 1
+    assert rows(client['sales'], 'orders', ['id']) == [(2,), (3,)]
+
+    writer = make_schema(connection).map(client, batch_size=1, partition_rows=2, checkpoint=FileCheckpoint(path),
+        resume=True, sink=DecodingSink(client['sales']))
+    assert writer.errors == []
+    assert rows(client['sales'], 'orders', ['id']) == [(1,), (2,), (3,)]
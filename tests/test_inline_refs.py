@@ -0,0 +1,33 @@
+import sqlite3
+import pytest
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+import codec_options
+from fakes import Connection, DecodingSink, Graph, bulk_write
+from mongodb_schema import Collection, Schema
+
+mongomock = pytest.importorskip('mongomock')
+
+def test_refs_to_a_composite_key_collection_are_added_in_a_second_pass(monkeypatch):
+    # mongomock can't use the codecs, and the tables have no decimals or dates for them to convert
+    monkeypatch.setattr(codec_options, 'get', lambda: DEFAULT_CODEC_OPTIONS)
+    monkeypatch.setattr(mongomock.Collection, 'bulk_write', bulk_write)
+    connection = Connection(sqlite3.connect(':memory:'))
+    connection.db.executescript('''
+        CREATE TABLE orders (id INTEGER PRIMARY KEY, note TEXT);
+        CREATE TABLE lines (id INTEGER, line INTEGER, quantity INTEGER, PRIMARY KEY (id, line));
+        INSERT INTO orders VALUES (1, 'first'), (2, 'second');
+        INSERT INTO lines VALUES (1, 1, 10), (1, 2, 20), (2, 1, 30);
+    ''')
+    schema = Schema(Graph(connection, 'orders and lines'))
+    schema.add_collection(Collection('orders', 'id'))
+    schema.add_collection(Collection('lines', 'id', unique_key=False))
+    schema.add_one_to_many_ref('lines', 'id', ['orders'], 'id', 'id')
+    client = mongomock.MongoClient()
+    writer = schema.map(client, inline_refs=True, sink=DecodingSink(client['sales']))
+
+    assert writer.errors == []
+    lines = dict((document['_id'], (document['id'], document['line'])) for document in client['sales']['lines'].find())
+    assert sorted(lines.values()) == [(1, 1), (1, 2), (2, 1)]
+    orders = dict((document['id'], sorted(lines[ref] for ref in document['id_lines_ref']))
+        for document in client['sales']['orders'].find())
+    assert orders == {1: [(1, 1), (1, 2)], 2: [(2, 1)]}
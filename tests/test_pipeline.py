@@ -0,0 +1,36 @@
+import sqlite3
+import threading
+import pytest
+from fakes import Connection
+from mongodb_schema import BulkWriter, Collection, Sink
+from pipeline import Pipeline
+
+# a sink whose first batch fails, letting the test know once it has
+class FailingSink(Sink):
+    def __init__(self):
+        self.failed = threading.Event()
+
+    def write_batch(self, collection_name, documents, batch_number):
+        self.failed.set()
+        raise RuntimeError('Lost the connection to MongoDB')
+
+def test_map_raises_the_assemble_error_over_the_write_error(monkeypatch):
+    connection = Connection(sqlite3.connect(':memory:', check_same_thread=False))
+    connection.db.executescript('''
+        CREATE TABLE orders (id INTEGER PRIMARY KEY, note TEXT);
+        INSERT INTO orders VALUES (1, 'first'), (2, 'second');
+    ''')
+    sink = FailingSink()
+    write = Collection.write
+
+    # the second record fails to assemble once the write of the first has failed
+    def write_record(table, writer, record):
+        if record['id'] == 2:
+            sink.failed.wait()
+            raise ValueError('Bad record')
+        write(table, writer, record)
+
+    monkeypatch.setattr(Collection, 'write', write_record)
+    with pytest.raises(ValueError):
+        Collection('orders', 'id').map(connection, writer=BulkWriter(sink, batch_size=1), window_size=1,
+            pipeline=Pipeline())
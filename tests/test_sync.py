@@ -0,0 +1,109 @@
+import sqlite3
+import pytest
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+import codec_options
+import mongodb_schema
+from checkpoint import FileCheckpoint
+from fakes import Connection, DecodingSink, Graph, bulk_write
+from mongodb_schema import Collection, Schema
+from row_decoder import RowDecoder
+
+mongomock = pytest.importorskip('mongomock')
+
+def make_connection():
+    connection = Connection(sqlite3.connect(':memory:'))
+    connection.db.executescript('''
+        CREATE TABLE employees (id INTEGER PRIMARY KEY, name TEXT, updated_at INTEGER DEFAULT 1);
+        CREATE TABLE customers (id INTEGER PRIMARY KEY, name TEXT, salesRep INTEGER, updated_at INTEGER DEFAULT 1);
+    ''')
+    connection.db.executemany('INSERT INTO employees (id, name) VALUES (?, ?)',
+        [(i, 'employee %d' % i) for i in range(1, 4)])
+    connection.db.executemany('INSERT INTO customers (id, name, salesRep) VALUES (?, ?, ?)',
+        [(i, 'customer %d' % i, i % 3 + 1) for i in range(1, 10)])
+    # rows at the mark are read again by the next sync, so employee 1 is kept there and the others below it
+    connection.db.execute('UPDATE employees SET updated_at = 2 WHERE id = 1')
+    return connection
+
+# the column types sync reads to find the watermark column, from sqlite's table info
+def read_row_decoders(connection, db_name):
+    decoders = {}
+    for (table_name,) in connection.db.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+        columns = connection.db.execute('PRAGMA table_info(%s)' % table_name).fetchall()
+        decoders[table_name] = RowDecoder(table_name, [(column[1], column[2].lower()) for column in columns])
+    return decoders
+
+# employees list their customers with a one to many ref, and customers point back with a many to one ref
+def make_schema(connection):
+    schema = Schema(Graph(connection, 'employees and customers'))
+    schema.add_collection(Collection('employees', 'id'))
+    schema.add_collection(Collection('customers', 'id'))
+    schema.add_one_to_many_ref('customers', 'id', ['employees'], 'id', 'salesRep')
+    schema.add_many_to_one_ref('employees', 'id', ['customers'], 'id', 'salesRep')
+    return schema
+
+# the documents of a collection with the referenced documents' keys in place of their ids
+def documents(db, collection_name):
+    keys = {}
+    for name in ['employees', 'customers']:
+        for document in db[name].find():
+            keys[document['_id']] = document['id']
+    results = {}
+    for document in db[collection_name].find():
+        document.pop('_id')
+        for field, value in document.items():
+            if field.endswith('_ref'):
+                document[field] = sorted(keys[v] for v in value) if type(value) is list else keys[value]
+        results[document['id']] = document
+    return results
+
+@pytest.mark.parametrize('inline_refs', [False, True])
+def test_sync_updates_one_to_many_refs_of_untouched_parents(tmp_path, monkeypatch, inline_refs):
+    # mongomock can't use the codecs, and the tables have no decimals or dates for them to convert
+    monkeypatch.setattr(codec_options, 'get', lambda: DEFAULT_CODEC_OPTIONS)
+    monkeypatch.setattr(mongodb_schema, 'read_row_decoders', read_row_decoders)
+    monkeypatch.setattr(mongomock.Collection, 'bulk_write', bulk_write)
+    connection = make_connection()
+    client = mongomock.MongoClient()
+    path = str(tmp_path / 'sync.json')
+    make_schema(connection).sync(client, FileCheckpoint(path), watermark='updated_at', inline_refs=inline_refs)
+    make_schema(connection).map(client, inline_refs=inline_refs, sink=DecodingSink(client['sales']))
+    employees = documents(client['sales'], 'employees')
+    assert employees[2]['salesRep_customers_ref'] == [1, 4, 7]
+    assert employees[3]['salesRep_customers_ref'] == [2, 5, 8]
+
+    # a new customer of employee 2, and customer 1 moved from employee 2 to employee 3, neither of which changes
+    # the employees' rows
+    connection.db.execute("INSERT INTO customers VALUES (999, 'customer 999', 2, 2)")
+    connection.db.execute('UPDATE customers SET salesRep = 3, updated_at = 2 WHERE id = 1')
+    make_schema(connection).sync(client, FileCheckpoint(path), watermark='updated_at', inline_refs=inline_refs)
+
+    employees = documents(client['sales'], 'employees')
+    assert employees[2]['salesRep_customers_ref'] == [4, 7, 999]
+    assert employees[3]['salesRep_customers_ref'] == [1, 2, 5, 8]
+    fresh = mongomock.MongoClient()
+    make_schema(connection).map(fresh, inline_refs=inline_refs, sink=DecodingSink(fresh['sales']))
+    assert employees == documents(fresh['sales'], 'employees')
+    assert documents(client['sales'], 'customers') == documents(fresh['sales'], 'customers')
+
+def test_sync_leaves_collections_with_a_composite_key(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(codec_options, 'get', lambda: DEFAULT_CODEC_OPTIONS)
+    monkeypatch.setattr(mongodb_schema, 'read_row_decoders', read_row_decoders)
+    monkeypatch.setattr(mongomock.Collection, 'bulk_write', bulk_write)
+    connection = Connection(sqlite3.connect(':memory:'))
+    connection.db.executescript('''
+        CREATE TABLE visits (customer INTEGER, day INTEGER, note TEXT, updated_at INTEGER DEFAULT 1,
+            PRIMARY KEY (customer, day));
+        INSERT INTO visits (customer, day, note) VALUES (1, 1, 'first'), (1, 2, 'second');
+    ''')
+    schema = Schema(Graph(connection, 'visits'))
+    schema.add_collection(Collection('visits', 'customer', unique_key=False))
+    client = mongomock.MongoClient()
+    path = str(tmp_path / 'sync.json')
+    schema.sync(client, FileCheckpoint(path), watermark='updated_at')
+    schema.map(client, sink=DecodingSink(client['sales']))
+
+    connection.db.execute("UPDATE visits SET note = 'changed', updated_at = 2 WHERE day = 2")
+    assert schema.sync(client, FileCheckpoint(path), watermark='updated_at') == {}
+    assert 'visits can\'t be synced' in capsys.readouterr().out
+    assert sorted((document['day'], document['note']) for document in client['sales']['visits'].find()) == \
+        [(1, 'first'), (2, 'second')]